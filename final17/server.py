@@ -9,10 +9,12 @@ import web
 PORT = 8000
 
 socketserver.TCPServer.allow_reuse_address = True
+# The connections are kept alive: serve each one in its own thread
+socketserver.ThreadingTCPServer.daemon_threads = True
 
 # Class to handle the HTTP requests from web clients
 Handler = web.OpenFDAHTTPRequestHandler
 
-httpd = socketserver.TCPServer(("", PORT), Handler)
+httpd = socketserver.ThreadingTCPServer(("", PORT), Handler)
 print("serving at port", PORT)
 httpd.serve_forever()
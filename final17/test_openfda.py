@@ -170,6 +170,14 @@ class TestOpenFDA(unittest.TestCase):
         parser.feed(resp.text)
         self.assertEqual(parser.items_number, 10)
 
+    def test_main_page_not_modified(self):
+        # The main page is not sent again if the client already has it
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        etag = requests.get(url).headers['ETag']
+        resp = requests.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.text, '')
+
     def test_not_found(self):
         url = 'http://localhost:' + str(self.TEST_PORT)
         url += '/not_exists_resource'
@@ -1,10 +1,21 @@
 import http.server
-import http.client
 import json
+import math
+import os
+import urllib.parse
+
+from static import StaticPage
+from upstream import (OPENFDA_KEY_LIMITS, OPENFDA_LIMITS, THROTTLED_PAUSE, HTTPSConnectionPool, QuotaExceeded,
+                      RateLimiter, SingleFlight, UpstreamUnavailable)
 
 OPENFDA_BASIC = True  # Implement the basic or complete requirements
+IDLE_TIMEOUT = 15  # Seconds a kept-alive connection waits for its next request
+MAX_REQUESTS = 100  # Requests served using a connection before closing it
 
 class OpenFDAHTML():
+    main_page = StaticPage("openfda.html")
+    main_basic_page = StaticPage("openfda_basic.html")
+    not_found_page = StaticPage("not_found.html")
 
     def get_list_html(self, items):
         """ Convert a python list to a HTML list """
@@ -31,40 +42,55 @@ class OpenFDAHTML():
 
     def get_main_page(self):
         """ Return the HTML with the main HTML page """
+        return self.get_main_static_page().text
+
+    def get_main_static_page(self):
+        """ Return the StaticPage with the main HTML page, kept in memory """
         if OPENFDA_BASIC:
-            with open("openfda_basic.html") as html_file:
-                html = html_file.read()
+            return self.main_basic_page.get()
         else:
-            with open("openfda.html") as html_file:
-                html = html_file.read()
-
-        return html
+            return self.main_page.get()
 
     def get_not_found_page(self):
-        with open("not_found.html") as html_file:
-            html = html_file.read()
+        return self.not_found_page.get().text
+
 
-        return html
 
+class EventRecord():
+    """ Fields of an event used by the web, without the rest of the event data """
+
+    __slots__ = ('patientsex', 'medicinalproduct', 'companynumb')
+
+    def __init__(self, patientsex=None, medicinalproduct=None, companynumb=None):
+        self.patientsex = patientsex
+        self.medicinalproduct = medicinalproduct
+        self.companynumb = companynumb
+
+    @classmethod
+    def from_event(cls, event):
+        """ Get the record with the fields of an <event> from OpenFDA """
+        patient = event.get('patient') or {}
+        drugs = patient.get('drug') or [{}]
+        return cls(patient.get('patientsex'), drugs[0].get('medicinalproduct'), event.get('companynumb'))
 
 
 class OpenFDAParser():
     def get_genders_from_events(self, events):
         genders = []
         for event in events:
-            genders += [event['patient']['patientsex']]
+            genders += [event.patientsex]
         return genders
 
     def get_drugs_from_events(self, events):
         drugs = []
         for event in events:
-            drugs += [event['patient']['drug'][0]['medicinalproduct']]
+            drugs += [event.medicinalproduct]
         return drugs
 
     def get_companies_from_events(self, events):
         companies = []
         for event in events:
-            companies += [event['companynumb']]
+            companies += [event.companynumb]
         return companies
 
 
@@ -73,19 +99,35 @@ class OpenFDAClient():
     OPENFDA_API_URL = "api.fda.gov"
     OPENFDA_API_EVENT = "/drug/event.json"
 
+    pool = HTTPSConnectionPool(OPENFDA_API_URL)  # Kept-alive connections shared by all the requests
+    flights = SingleFlight()  # Requests in flight to OpenFDA
+    api_key = os.environ.get('OPENFDA_API_KEY')  # OpenFDA API key, for a bigger quota of requests
+    limiter = RateLimiter(OPENFDA_KEY_LIMITS if api_key else OPENFDA_LIMITS)  # Quota shared by all the requests
+
     def get_events(self, limit=10, query=None):
         """ Get the <limit> events from OpenFDA using <query>"""
 
-        conn = http.client.HTTPSConnection(self.OPENFDA_API_URL)
         request = self.OPENFDA_API_EVENT + "?limit=" + str(limit)
         if query is not None:
             request += "&" + query
-        conn.request("GET", request)
-        events_search = conn.getresponse()
-        raw_data = events_search.read()
+        # The same request done by other clients at the same time is sent only once
+        return self.flights.do(request, self.fetch_events, request)
+
+    def fetch_events(self, request):
+        """ Get the events from OpenFDA for the <request> url """
+
+        if self.api_key:
+            request += "&api_key=" + urllib.parse.quote(self.api_key)
+        # Each attempt the circuit breaker lets through takes its own token from the quota
+        status, reason, raw_data = self.pool.request(request, acquire=self.limiter.acquire)
+        if status == 429:
+            # Not events: it must not be shown as an empty list
+            self.limiter.pause(THROTTLED_PAUSE)
+            raise QuotaExceeded("OpenFDA quota exceeded", THROTTLED_PAUSE)
         events_str = raw_data.decode("utf8")
         events = json.loads(events_str)
-        events = events['results']
+        # Only the fields used are kept of each event
+        events = [EventRecord.from_event(event) for event in events['results']]
 
         return events
 
@@ -117,64 +159,97 @@ class OpenFDAHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         - listGender
     """
 
+    # Keep-alive connections: the responses are sent with their Content-Length
+    protocol_version = "HTTP/1.1"
+    # The headers and the content are written separately: don't wait for the ACK of the headers
+    disable_nagle_algorithm = True
+    timeout = IDLE_TIMEOUT  # The connection is closed if no request arrives in time
+    max_requests = MAX_REQUESTS
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
 
     # GET
     def do_GET(self):
 
         html_res = ''  # html string to be returned to the client
+        static_page = None  # or the StaticPage to be returned
         limit = 10
         url_auth = False
         url_found = True
         url_redirect = False
+        retry_after = None  # or the seconds to wait for the quota of OpenFDA requests
 
         client = OpenFDAClient()
         parser = OpenFDAParser()
         html = OpenFDAHTML()
 
-        if self.path == '/':
-            html_res = html.get_main_page()
-        elif self.path.startswith('/listGender'):
-            if len(self.path.split("=")) > 1 and not OPENFDA_BASIC:
-                limit = self.path.split("=")[1]
-            events = client.get_events(limit)
-            genders = parser.get_genders_from_events(events)
-            html_res = html.get_list_html(genders)
-        elif self.path.startswith('/listDrugs'):
-            if len(self.path.split("=")) > 1 and not OPENFDA_BASIC:
-                limit = self.path.split("=")[1]
-            events = client.get_events(limit)
-            drugs = parser.get_drugs_from_events(events)
-            html_res = html.get_list_html(drugs)
-        elif 'searchDrug' in self.path:
-            # Get the companies for a drug
-            drug = self.path.split("=")[1]
-            events = client.get_events_search_drug(drug)
-            drugs = parser.get_companies_from_events(events)
-            html_res = html.get_list_html(drugs)
-        elif self.path.startswith('/listCompanies'):
-            if len(self.path.split("=")) > 1 and not OPENFDA_BASIC:
-                limit = self.path.split("=")[1]
-            events = client.get_events(limit)
-            companies = parser.get_companies_from_events(events)
-            html_res = html.get_list_html(companies)
-        elif 'searchCompany' in self.path:
-            # Get the drugs for a company
-            company = self.path.split("=")[1]
-            events = client.get_events_search_company(company)
-            drugs = parser.get_drugs_from_events(events)
-            html_res = html.get_list_html(drugs)
-        elif 'redirect' in self.path and not OPENFDA_BASIC:
-            url_redirect = True
-        elif 'secret' in self.path and not OPENFDA_BASIC:
-            url_auth = True
+        try:
+            if self.path == '/':
+                static_page = html.get_main_static_page()
+            elif self.path.startswith('/listGender'):
+                if len(self.path.split("=")) > 1 and not OPENFDA_BASIC:
+                    limit = self.path.split("=")[1]
+                events = client.get_events(limit)
+                genders = parser.get_genders_from_events(events)
+                html_res = html.get_list_html(genders)
+            elif self.path.startswith('/listDrugs'):
+                if len(self.path.split("=")) > 1 and not OPENFDA_BASIC:
+                    limit = self.path.split("=")[1]
+                events = client.get_events(limit)
+                drugs = parser.get_drugs_from_events(events)
+                html_res = html.get_list_html(drugs)
+            elif 'searchDrug' in self.path:
+                # Get the companies for a drug
+                drug = self.path.split("=")[1]
+                events = client.get_events_search_drug(drug)
+                drugs = parser.get_companies_from_events(events)
+                html_res = html.get_list_html(drugs)
+            elif self.path.startswith('/listCompanies'):
+                if len(self.path.split("=")) > 1 and not OPENFDA_BASIC:
+                    limit = self.path.split("=")[1]
+                events = client.get_events(limit)
+                companies = parser.get_companies_from_events(events)
+                html_res = html.get_list_html(companies)
+            elif 'searchCompany' in self.path:
+                # Get the drugs for a company
+                company = self.path.split("=")[1]
+                events = client.get_events_search_company(company)
+                drugs = parser.get_drugs_from_events(events)
+                html_res = html.get_list_html(drugs)
+            elif 'redirect' in self.path and not OPENFDA_BASIC:
+                url_redirect = True
+            elif 'secret' in self.path and not OPENFDA_BASIC:
+                url_auth = True
+            else:
+                if not OPENFDA_BASIC:
+                    url_found = False
+                    static_page = html.not_found_page.get()
+        except UpstreamUnavailable as error:
+            retry_after = math.ceil(error.retry_after)
+            # The error can tell about the network of the server: it is only logged
+            print("OpenFDA is not available:", repr(error))
+            html_res = "<h1>Service unavailable</h1><p>OpenFDA is not available now. Please try again later.</p>"
+
+        not_modified = static_page is not None and url_found and \
+            static_page.is_not_modified(self.headers.get('If-None-Match'))
+
+        if not_modified:
+            content = b''
+        elif static_page is not None:
+            content = static_page.content
         else:
-            if not OPENFDA_BASIC:
-                url_found = False
-                html_res = html.get_not_found_page()
+            content = bytes(html_res, "utf8")
 
         # Send response status code
-        if not url_found:
+        if not_modified:
+            self.send_response(304)
+        elif not url_found:
             self.send_response(404)
+        elif retry_after is not None:
+            self.send_response(503)
+            self.send_header('Retry-After', str(retry_after))
         elif url_redirect:
             self.send_response(302)
             self.send_header('Location', 'http://localhost:8000/')
@@ -185,9 +260,21 @@ class OpenFDAHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             self.send_response(200)
         # Send headers
         self.send_header('Content-type', 'text/html')
+        if static_page is not None:
+            self.send_header('ETag', static_page.etag)
+            # Browsers must check the ETag before using their copy
+            self.send_header('Cache-Control', 'no-cache')
+        if not not_modified:
+            self.send_header('Content-Length', str(len(content)))
+        self.requests_served += 1
+        if self.requests_served >= self.max_requests:
+            self.send_header('Connection', 'close')
+        elif self.request_version == 'HTTP/1.0' and not self.close_connection:
+            # HTTP/1.0 clients asking for keep-alive need to know they got it
+            self.send_header('Connection', 'keep-alive')
         self.end_headers()
 
         # Write content as utf-8 data
-        self.wfile.write(bytes(html_res, "utf8"))
+        self.wfile.write(content)
 
         return
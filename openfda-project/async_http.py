@@ -0,0 +1,636 @@
+# HTTP/1.1 over asyncio streams for the asyncio engine of server.py
+
+
+import asyncio
+import collections
+import email.utils
+import http
+import re
+import ssl
+import sys
+import time
+import traceback
+
+from upstream import (CONNECT_TIMEOUT, MAX_IDLE, MAX_LIFETIME, READ_TIMEOUT, CircuitBreaker, RetryPolicy,
+                      UpstreamUnavailable)
+
+IDLE_TIMEOUT = 60  # Seconds an idle keep-alive connection is kept open
+MAX_REQUESTS = 100  # Requests served using a keep-alive connection before closing it
+MAX_LINE = 65536  # Max length of the request line and of each header line
+MAX_HEADERS = 100
+READ_SIZE = 64 * 1024  # Max bytes of a response body read at once
+MAX_CONCURRENCY = 256  # Requests served at the same time
+MAX_QUEUE = 256  # Requests waiting to be served, the next ones are rejected
+SHED_RETRY_AFTER = 1  # Seconds the rejected clients are asked to wait
+
+
+class AsyncHTTPSConnectionPool():
+    """
+    Keep-alive HTTPS connections to a host shared by all the coroutines of the event loop
+    """
+
+    def __init__(self, host, port=443, max_connections=100, size=20, max_idle=MAX_IDLE, max_lifetime=MAX_LIFETIME,
+                 use_ssl=True, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retry=None, breaker=None):
+        """
+        :param host: host to connect to
+        :param port: port to connect to
+        :param max_connections: max number of requests in flight at the same time
+        :param size: max number of idle connections kept open
+        :param max_idle: seconds an idle connection is kept open
+        :param max_lifetime: seconds since its creation a connection is reused
+        :param use_ssl: connect using TLS
+        :param connect_timeout: seconds to connect
+        :param read_timeout: seconds to wait for each piece of a response
+        :param retry: RetryPolicy of the failed requests
+        :param breaker: CircuitBreaker of the host, it can be shared with other pools
+        """
+
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.ssl_context = ssl.create_default_context() if use_ssl else None
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.idle = []  # (reader, writer, creation time, last use time), the last used at the end
+        # Counted from the event loop only, like the rest of the state
+        self.retried = 0
+        self.failed = 0
+        self.semaphore = asyncio.Semaphore(max_connections)
+
+    async def request(self, url, headers=None, decoder=None, acquire=None):
+        """
+        Send a GET request. The failed requests (errors, timeouts and 5xx responses) are
+        retried, unless part of the body has been fed to the decoder.
+
+        :param url: url (path and query) to get
+        :param headers: dict with extra request headers
+        :param decoder: object with a feed(data) method and a size attribute (bytes fed). If
+                        it is passed, the body of the responses that are not failures is fed
+                        to it while it is read instead of returned.
+        :param acquire: coroutine function awaited before each attempt to wait for the quota of the host
+        :return: tuple (status, reason, body), body is None if it has been fed to the decoder
+        :raise UpstreamUnavailable: if the request failed, the circuit is open or there is no quota
+        """
+
+        if re.search(r'[\x00-\x20\x7f]', url):
+            # The same check http.client does before sending a request
+            raise ValueError("URL can't contain control characters or spaces: %r" % url)
+
+        request = "GET %s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: identity\r\n" % (url, self.host)
+        for name, value in (headers or {}).items():
+            request += "%s: %s\r\n" % (name, value)
+        request = (request + "\r\n").encode("latin-1")
+
+        self.breaker.check()
+        if acquire is not None:
+            try:
+                # Only the requests the breaker lets through take a token from the quota
+                await acquire()
+            except BaseException:
+                self.breaker.cancel()
+                raise
+        success = False
+        try:
+            attempt = 0
+            while True:
+                try:
+                    result = await self.send_request(request, decoder)
+                    if not self.retry.is_retryable(result[0]):
+                        success = True
+                        return result
+                    error = "%d %s" % result[:2]
+                except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as exception:
+                    # asyncio.TimeoutError is an OSError only since Python 3.11
+                    error = repr(exception)
+                if attempt >= self.retry.retries or (decoder is not None and decoder.size):
+                    break
+                await asyncio.sleep(self.retry.get_backoff(attempt))
+                attempt += 1
+                self.retried += 1
+                if acquire is not None:
+                    # A retry counts against the quota like any other request
+                    await acquire()
+
+            self.failed += 1
+            raise UpstreamUnavailable("OpenFDA failed: " + error, self.breaker.recovery_time)
+        finally:
+            self.breaker.record(success)
+
+    async def send_request(self, request, decoder=None):
+        """
+        Send a request once, and again if the kept-alive connection used was closed by the server
+
+        :return: tuple (status, reason, body)
+        """
+
+        async with self.semaphore:
+            while True:
+                connection = self.get_connection()
+                if connection is None:
+                    break
+                # A kept-alive connection could have been closed by the server meanwhile: try a new one then
+                try:
+                    return await self.send(*connection, request, decoder)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if decoder is not None and decoder.size:
+                        # Part of the body has been decoded: it can't be sent again
+                        raise
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.ssl_context, limit=MAX_LINE),
+                self.connect_timeout)
+            return await self.send(reader, writer, time.monotonic(), request, decoder)
+
+    def get_connection(self):
+        """
+        Get an idle connection, closing the ones idle or open for too long and the ones closed by the server
+
+        :return: tuple (reader, writer, creation time) or None if there are no valid idle connections
+        """
+
+        now = time.monotonic()
+
+        while self.idle:
+            reader, writer, created, last_used = self.idle.pop()
+            if (now - last_used < self.max_idle and now - created < self.max_lifetime
+                    and not writer.is_closing() and not reader.at_eof()):
+                return reader, writer, created
+            writer.close()
+
+        return None
+
+    async def send(self, reader, writer, created, request, decoder=None):
+        """
+        Send the request using a connection and read the response
+
+        :param created: creation time of the connection
+
+        :return: tuple (status, reason, body)
+        """
+
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+            if not status_line:
+                raise ConnectionError("Connection closed by %s" % self.host)
+            version, status, reason = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [''])[:3]
+            status = int(status)
+            headers = await asyncio.wait_for(read_headers(reader), self.read_timeout)
+
+            # The failures are not fed to the decoder, so they can be retried
+            body = BodyReader(None if self.retry.is_retryable(status) else decoder, self.read_timeout)
+            if 'chunked' in headers.get('transfer-encoding', '').lower():
+                while True:
+                    size = int((await asyncio.wait_for(reader.readline(), self.read_timeout)).split(b';')[0], 16)
+                    if size == 0:
+                        await asyncio.wait_for(read_headers(reader), self.read_timeout)
+                        break
+                    await body.read(reader, size)
+                    await asyncio.wait_for(reader.readexactly(2), self.read_timeout)
+                will_close = headers.get('connection', '').lower() == 'close'
+            elif 'content-length' in headers:
+                await body.read(reader, int(headers['content-length']))
+                will_close = headers.get('connection', '').lower() == 'close'
+            else:
+                await body.read(reader)
+                will_close = True
+        except BaseException:
+            writer.close()
+            raise
+
+        if will_close or version == 'HTTP/1.0' or len(self.idle) >= self.size:
+            writer.close()
+        else:
+            self.idle.append((reader, writer, created, time.monotonic()))
+
+        return status, reason, body.get()
+
+
+    def stats(self):
+        """
+        :return: dict with the settings and the counters of the requests to the host
+        """
+
+        stats = {
+            'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout,
+            'circuit_breaker': self.breaker.stats()
+        }
+        stats.update(self.retry.stats(), retried=self.retried, failed=self.failed)
+
+        return stats
+
+
+class BodyReader():
+    """
+    Body of a response, kept or fed to a decoder while it is read
+    """
+
+    def __init__(self, decoder=None, timeout=None):
+        """
+        :param decoder: decoder fed with the body (see AsyncHTTPSConnectionPool.request)
+        :param timeout: seconds to wait for each piece of the body
+        """
+
+        self.decoder = decoder
+        self.timeout = timeout
+        self.chunks = []
+
+    async def read(self, reader, size=None):
+        """
+        Read size bytes of the body, or the rest of the connection data if size is None
+        """
+
+        while size is None or size > 0:
+            data = await asyncio.wait_for(reader.read(READ_SIZE if size is None else min(size, READ_SIZE)),
+                                          self.timeout)
+            if not data:
+                if size is not None:
+                    raise asyncio.IncompleteReadError(b'', size)
+                return
+            if size is not None:
+                size -= len(data)
+            if self.decoder is not None:
+                self.decoder.feed(data)
+            else:
+                self.chunks.append(data)
+
+    def get(self):
+        """
+        :return: the body or None if it has been fed to the decoder
+        """
+
+        if self.decoder is not None:
+            return None
+
+        return b''.join(self.chunks)
+
+
+class AsyncSingleFlight():
+    """
+    Coalesce identical calls in flight in the event loop: the calls for a key
+    that is already running await its result (or its exception)
+    """
+
+    def __init__(self):
+        self.calls = {}  # key -> task running
+        self.coalesced = 0
+        self.background = 0
+
+    async def do(self, key, function, *args):
+        """
+        Await function(*args) unless a call for the same key is already running
+
+        :param key: key identifying the call
+        :param function: coroutine function to call
+        :return: the result of the call
+        """
+
+        task = self.calls.get(key)
+        if task is None:
+            task = self.start(key, function, *args)
+        else:
+            self.coalesced += 1
+
+        # A waiter cancelled (client gone) must not cancel the call for the rest
+        return await asyncio.shield(task)
+
+    def do_in_background(self, key, function, *args):
+        """
+        Start function(*args) without awaiting it unless a call for the same key is already running
+
+        :param key: key identifying the call
+        :param function: coroutine function to call
+        :return: True if the call has been started
+        """
+
+        if key in self.calls:
+            return False
+
+        self.background += 1
+        task = self.start(key, function, *args)
+        task.add_done_callback(lambda done_task: self.check_background(key, done_task))
+
+        return True
+
+    def check_background(self, key, task):
+        # Nobody awaits the background calls: report their errors here
+        if not task.cancelled() and task.exception() is not None:
+            print("Background call failed for", key, repr(task.exception()))
+
+    def start(self, key, function, *args):
+        task = self.calls[key] = asyncio.ensure_future(function(*args))
+        task.add_done_callback(lambda done_task: self.calls.pop(key, None))
+
+        return task
+
+
+async def read_headers(reader):
+    """
+    Read HTTP headers until the empty line
+
+    :return: dict with the headers (lower case names)
+    """
+
+    headers = {}
+    for _ in range(MAX_HEADERS + 1):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    raise ValueError("Too many headers")
+
+
+def format_trailers(get_trailers):
+    """
+    :param get_trailers: function returning the list of (name, value) trailers of a chunked content, or None
+    :return: the trailers to be sent after the last chunk
+    """
+
+    if get_trailers is None:
+        return b""
+
+    return "".join("%s: %s\r\n" % trailer for trailer in get_trailers()).encode("latin-1")
+
+
+class AsyncHTTPServer():
+    """
+    HTTP/1.1 server with keep-alive connections, all of them served from one event loop.
+    When max_concurrency requests are being served the next ones wait in a bounded queue,
+    and when it is full they are rejected at once with 503, so a burst does not make all the
+    clients time out.
+    """
+
+    server_version = "BaseHTTP/0.6 Python/" + sys.version.split()[0]
+
+    def __init__(self, handler, idle_timeout=IDLE_TIMEOUT, max_requests=MAX_REQUESTS,
+                 max_concurrency=MAX_CONCURRENCY, max_queue=MAX_QUEUE):
+        """
+        :param handler: coroutine function called with the path and the headers (dict with
+                        lower case names) of each GET request returning a tuple (code, headers, content). The content is bytes
+                        or an iterator (or an async iterator) with the chunks of bytes to be sent chunked. The tuple can have a
+                        function returning the trailers sent after the chunks too.
+        :param idle_timeout: seconds an idle connection is kept open, and to receive the headers of a request
+        :param max_requests: requests served using a connection before closing it
+        :param max_concurrency: requests served at the same time
+        :param max_queue: requests waiting to be served before the next ones are rejected
+        """
+
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.server = None
+        self.draining = False
+        self.connections = set()  # Tasks serving the connections
+        self.idle = set()  # Writers of the connections waiting for a request
+        self.active = 0  # Requests being served
+        self.waiters = collections.deque()  # Futures of the requests waiting to be served
+        self.rejected = 0
+        self.disconnected = 0
+
+    async def serve(self, host, port, backlog=100, sock=None):
+        """
+        Serve the connections until drain is called and the requests in progress are finished
+
+        :param sock: listening socket to accept the connections from, instead of host and port
+        """
+
+        if sock is not None:
+            self.server = await asyncio.start_server(self.handle_connection, sock=sock, backlog=backlog,
+                                                     limit=MAX_LINE)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port, backlog=backlog,
+                                                     limit=MAX_LINE, reuse_address=True)
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                if not self.draining:
+                    raise
+
+        if self.connections:
+            await asyncio.wait(self.connections)
+
+    def drain(self):
+        """
+        Stop accepting connections, close the idle ones and the rest once their current request is served
+        """
+
+        self.draining = True
+        if self.server is not None:
+            self.server.close()
+        for writer in self.idle:
+            writer.close()
+
+    async def admit(self):
+        """
+        Wait until the request can be served
+
+        :return: False if it must be rejected because the queue is full
+        """
+
+        if self.active < self.max_concurrency and not self.waiters:
+            self.active += 1
+            return True
+
+        if len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            # The request finished passes its slot
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+            raise
+
+        return True
+
+    def release(self):
+        """
+        Free the slot of a request admitted, for the first one waiting
+        """
+
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self):
+        """
+        :return: dict with the limits, the requests served and waiting and the counters of the requests not served
+        """
+
+        return {
+            'concurrency': self.max_concurrency,
+            'active': self.active,
+            'max_queue': self.max_queue,
+            'queued': len(self.waiters),
+            'rejected': self.rejected,
+            'disconnected': self.disconnected
+        }
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve the requests sent using a connection until it is closed
+        """
+
+        client_address = writer.get_extra_info('peername')
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            for served in range(1, self.max_requests + 1):
+                if not await self.handle_request(reader, writer, client_address, served == self.max_requests):
+                    break
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            print('-' * 40, file=sys.stderr)
+            print('Exception occurred during processing of request from', client_address, file=sys.stderr)
+            traceback.print_exc()
+            print('-' * 40, file=sys.stderr)
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def handle_request(self, reader, writer, client_address, last=False):
+        """
+        Serve one request
+
+        :param last: it is the last request served using the connection
+        :return: True if the connection must be kept open
+        """
+
+        if self.draining:
+            return False
+
+        try:
+            self.idle.add(writer)
+            try:
+                request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+            finally:
+                self.idle.discard(writer)
+            if not request_line:
+                return False
+            request_line = request_line.decode("latin-1").rstrip("\r\n")
+            words = request_line.split()
+            if len(words) != 3 or not words[2].startswith('HTTP/'):
+                raise ValueError("Bad request line %r" % request_line)
+            command, path, version = words
+            # A client sending its headers slowly must not keep the connection open for ever
+            headers = await asyncio.wait_for(read_headers(reader), self.idle_timeout)
+        except ValueError:
+            # Too long lines or a malformed request
+            await self.send(writer, client_address, '-', 'HTTP/1.1', 400, [], b'', True)
+            return False
+
+        connection = headers.get('connection', '').lower()
+        close_connection = last or self.draining or connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive')
+
+        if command != 'GET':
+            await self.send(writer, client_address, request_line, version, 501, [], b'', True)
+            return False
+
+        # Without a free slot the request waits in the queue
+        waited = self.active >= self.max_concurrency or bool(self.waiters)
+        if not await self.admit():
+            await self.send(writer, client_address, request_line, version, 503,
+                            [('Retry-After', str(SHED_RETRY_AFTER))], b'', True)
+            return False
+
+        try:
+            if waited and reader.exception() is not None:
+                # The client reset the connection while the request was waiting: nobody would get the
+                # response. Its end of file is not enough, it may have only shut down its side.
+                self.disconnected += 1
+                return False
+            code, response_headers, content, *get_trailers = await self.handler(path, headers)
+            if not isinstance(content, bytes) and version == 'HTTP/1.0':
+                # No chunks for HTTP/1.0: the end of the content is the end of the connection
+                close_connection = True
+            await self.send(writer, client_address, request_line, version, code, response_headers, content,
+                            close_connection, *get_trailers)
+        finally:
+            self.release()
+
+        return not close_connection
+
+    async def send(self, writer, client_address, request_line, version, code, headers, content, close_connection,
+                   get_trailers=None):
+        """
+        Write the response, with the same headers than http.server plus its framing
+
+        :param get_trailers: function returning the list of (name, value) trailers, called once the content is sent
+        """
+
+        chunked = not isinstance(content, bytes) and version != 'HTTP/1.0'
+
+        response = "HTTP/1.1 %d %s\r\n" % (code, http.HTTPStatus(code).phrase)
+        response += "Server: %s\r\n" % self.server_version
+        response += "Date: %s\r\n" % email.utils.formatdate(time.time(), usegmt=True)
+        for header in headers:
+            response += "%s: %s\r\n" % header
+        if isinstance(content, bytes):
+            if code != 304:
+                response += "Content-Length: %d\r\n" % len(content)
+        elif chunked:
+            response += "Transfer-Encoding: chunked\r\n"
+        if close_connection:
+            response += "Connection: close\r\n"
+        elif version == 'HTTP/1.0':
+            # HTTP/1.0 clients asking for keep-alive need to know they got it
+            response += "Connection: keep-alive\r\n"
+        response += "\r\n"
+
+        if isinstance(content, bytes):
+            writer.write(response.encode("latin-1") + content)
+        else:
+            writer.write(response.encode("latin-1"))
+            if hasattr(content, '__aiter__'):
+                try:
+                    async for chunk in content:
+                        await self.write_chunk(writer, chunk, chunked)
+                finally:
+                    # Closed at once if the client is gone, not when the event loop finalizes it
+                    await content.aclose()
+            else:
+                for chunk in content:
+                    await self.write_chunk(writer, chunk, chunked)
+            if chunked:
+                writer.write(b"0\r\n" + format_trailers(get_trailers) + b"\r\n")
+        await writer.drain()
+
+        sys.stderr.write('%s - - [%s] "%s" %d -\n' % (client_address[0], time.strftime("%d/%b/%Y %H:%M:%S"),
+                                                      request_line, code))
+
+    @staticmethod
+    async def write_chunk(writer, chunk, chunked):
+        """
+        Write a chunk of a content, waiting for the slow clients to read it
+
+        :param chunked: the content is sent with the chunked transfer encoding
+        """
+
+        if not chunk:
+            return
+        if chunked:
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        else:
+            writer.write(chunk)
+        # Don't buffer the whole content if the client is slow
+        await writer.drain()
@@ -0,0 +1,439 @@
+# Caches for the results of the OpenFDA queries
+
+
+import asyncio
+import collections
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+CACHE_SIZE = 64 * 1024 * 1024  # Max bytes of OpenFDA responses kept in memory
+CACHE_TTL = 600  # Seconds a cached result is valid
+MAX_STALE = 3600  # Seconds an expired result can still be served while it is refreshed
+DISK_CACHE_SIZE = 256 * 1024 * 1024  # Max bytes of the results stored on disk
+DISK_CACHE_VERSION = 2  # Version of the tables of the disk cache, the files of other versions are emptied
+LAST_USED_PRECISION = 60  # Seconds the stored last use time of a result on disk can be behind
+
+
+class QueryCache():
+    """
+    LRU cache of the OpenFDA query results with a time to live. Entries are evicted
+    when the total size of the cached responses is over the limit, so a few big
+    results (limit=1000) don't make the cache use a lot of memory.
+    Expired results are kept max_stale seconds more so they can be served stale
+    while they are refreshed. It is safe to share it between threads.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL, max_stale=MAX_STALE, disk=None):
+        """
+        :param max_size: max total size in bytes of the cached responses
+        :param ttl: seconds a result is valid
+        :param max_stale: seconds an expired result can still be served stale
+        :param disk: DiskCache to get the results not found in memory from and to store the new ones
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.disk = disk
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (value, size, expiration), the least recently used first
+        self.size = 0
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def get_key(query):
+        """
+        Canonical form of a query: the same params in any order are the same query
+
+        :param query: query string sent to OpenFDA
+        :return: the key for the query
+        """
+
+        if not query:
+            return ''
+
+        return "&".join(sorted(param for param in query.split("&") if param))
+
+    def get(self, query):
+        """
+        :param query: query string sent to OpenFDA
+        :return: the cached result or None if it is not cached or it has expired
+        """
+
+        value, expired = self.get_stale(query, False)
+
+        return value
+
+    def get_stale(self, query, stale=True):
+        """
+        Get a result even if it has expired, as long as it expired less than max_stale seconds ago
+
+        :param query: query string sent to OpenFDA
+        :param stale: return the expired results too
+        :return: tuple (cached result or None, True if the result has expired)
+        """
+
+        key = self.get_key(query)
+
+        entry = self.get_entry(key)
+        if entry is None and self.disk is not None:
+            # Maybe stored by a previous run or by other server process
+            entry = self.load(key)
+
+        return self.check_entry(entry, stale)
+
+    async def get_stale_async(self, query, stale=True, executor=None):
+        """
+        Like get_stale, but reading the disk cache in a thread without blocking the event loop
+
+        :param executor: concurrent.futures.Executor to read the disk cache in, the default one if None
+        """
+
+        key = self.get_key(query)
+
+        entry = self.get_entry(key)
+        if entry is None and self.disk is not None:
+            entry = await asyncio.get_running_loop().run_in_executor(executor, self.load, key)
+
+        return self.check_entry(entry, stale)
+
+    def get_entry(self, key):
+        """
+        :param key: key of the query
+        :return: tuple (value, size, expiration) kept in memory or None if it is not kept or it is too old
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] + self.max_stale <= time.monotonic():
+                self.remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        return entry
+
+    def check_entry(self, entry, stale):
+        """
+        Count a hit or a miss for an entry found or not
+
+        :param entry: tuple (value, size, expiration) or None if it was not found
+        :param stale: return the expired results too
+        :return: tuple (cached result or None, True if the result has expired)
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None, False
+            value, size, expiration = entry
+            expired = expiration <= now
+            if expired and not stale:
+                # Kept for the requests that accept stale results
+                self.misses += 1
+                return None, False
+            if expired:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+
+        return value, expired
+
+    def load(self, key):
+        """
+        Load into memory a result from the disk cache
+
+        :param key: key of the query
+        :return: tuple (value, size, expiration) or None if it is not stored or it is too old
+        """
+
+        stored = self.disk.get(key)
+        if stored is None:
+            return None
+
+        value, size, expiration = stored
+        # The disk uses the wall clock to be valid between restarts
+        expiration = time.monotonic() + expiration - time.time()
+        if expiration + self.max_stale <= time.monotonic():
+            return None
+
+        with self.lock:
+            self.disk_hits += 1
+        self.store(key, value, size, expiration)
+
+        return value, size, expiration
+
+    def put(self, query, value, size):
+        """
+        Cache the result of a query
+
+        :param query: query string sent to OpenFDA
+        :param value: result of the query
+        :param size: size in bytes of the response with the result
+        """
+
+        key = self.get_key(query)
+
+        self.store(key, value, size, time.monotonic() + self.ttl)
+
+        if self.disk is not None:
+            self.disk.put(key, value, size, time.time() + self.ttl)
+
+    async def put_async(self, query, value, size, executor=None):
+        """
+        Like put, but writing the disk cache in a thread without blocking the event loop
+
+        :param executor: concurrent.futures.Executor to write the disk cache in, the default one if None
+        """
+
+        key = self.get_key(query)
+
+        self.store(key, value, size, time.monotonic() + self.ttl)
+
+        if self.disk is not None:
+            await asyncio.get_running_loop().run_in_executor(executor, self.disk.put, key, value, size,
+                                                             time.time() + self.ttl)
+
+    def store(self, key, value, size, expiration):
+        """
+        Keep a result in memory evicting the least recently used ones if needed
+        """
+
+        if size > self.max_size:
+            # It would evict the whole cache
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, size, expiration)
+            self.size += size
+            while self.size > self.max_size:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        # Must be called with the lock held
+        value, size, expiration = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self):
+        """
+        :return: dict with the counters of the cache
+        """
+
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+
+class DiskCache():
+    """
+    Results of the OpenFDA queries stored in a SQLite file so they survive restarts.
+    SQLite locking makes it safe to share the file between several server processes,
+    and the least recently used results are evicted when the file is over max_size.
+    The number of results and their total size are kept up to date by triggers in the
+    usage table, so a put doesn't scan the whole file while it holds the write lock.
+    """
+
+    def __init__(self, path, max_size=DISK_CACHE_SIZE, max_stale=MAX_STALE, dump=None, load=None):
+        """
+        :param path: path of the SQLite file
+        :param max_size: max total size in bytes of the stored results
+        :param max_stale: seconds an expired result is kept
+        :param dump: function to convert a result to a JSON serializable value, if it is not
+        :param load: function to convert back a result converted with dump
+        """
+
+        self.path = path
+        self.max_size = max_size
+        self.max_stale = max_stale
+        self.dump = dump
+        self.load = load
+        self.local = threading.local()  # A SQLite connection for each thread
+
+        conn = self.get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] != DISK_CACHE_VERSION:
+                self.create_tables(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def create_tables(conn):
+        """
+        Create the tables, dropping the ones of other version: it is only a cache
+        """
+
+        conn.execute("DROP TABLE IF EXISTS results")
+        conn.execute("DROP TABLE IF EXISTS usage")
+        # size is the size of the response with the result and length the bytes stored
+        conn.execute("CREATE TABLE results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, length INTEGER, "
+                     "expiration REAL, last_used REAL)")
+        conn.execute("CREATE INDEX results_last_used ON results (last_used)")
+        conn.execute("CREATE INDEX results_expiration ON results (expiration)")
+        conn.execute("CREATE TABLE usage (entries INTEGER, length INTEGER)")
+        conn.execute("INSERT INTO usage VALUES (0, 0)")
+        conn.execute("CREATE TRIGGER results_insert AFTER INSERT ON results BEGIN "
+                     "UPDATE usage SET entries = entries + 1, length = length + new.length; END")
+        conn.execute("CREATE TRIGGER results_update AFTER UPDATE OF length ON results BEGIN "
+                     "UPDATE usage SET length = length - old.length + new.length; END")
+        conn.execute("CREATE TRIGGER results_delete AFTER DELETE ON results BEGIN "
+                     "UPDATE usage SET entries = entries - 1, length = length - old.length; END")
+        conn.execute("PRAGMA user_version = %d" % DISK_CACHE_VERSION)
+
+    def get_connection(self):
+        """
+        :return: the SQLite connection for the current thread
+        """
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Wait for the locks of the other processes instead of failing at once
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            # Readers don't block the writer and the writer doesn't block the readers
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+
+        return conn
+
+    def get(self, key):
+        """
+        :param key: key of the query
+        :return: tuple (value, size, expiration time) or None if it is not stored
+        """
+
+        try:
+            conn = self.get_connection()
+            row = conn.execute("SELECT value, size, expiration, last_used FROM results WHERE key = ?",
+                               (key,)).fetchone()
+            if row is None:
+                return None
+            value, size, expiration, last_used = row
+            now = time.time()
+            if now - last_used >= LAST_USED_PRECISION:
+                # Only for the eviction order: the write lock shared by the processes is not taken in each read
+                conn.execute("UPDATE results SET last_used = ? WHERE key = ? AND last_used = ?",
+                             (now, key, last_used))
+        except sqlite3.Error as error:
+            print("Can not read the disk cache", self.path, error)
+            return None
+
+        try:
+            value = json.loads(zlib.decompress(value).decode("utf-8"))
+            if self.load is not None:
+                value = self.load(value)
+        except (zlib.error, ValueError, TypeError) as error:
+            # A corrupt or truncated result is a miss, and it is not read again
+            print("Can not decode the result of the disk cache", key, repr(error))
+            self.delete(key)
+            return None
+
+        return value, size, expiration
+
+    def delete(self, key):
+        """
+        :param key: key of the query whose result is removed
+        """
+
+        try:
+            self.get_connection().execute("DELETE FROM results WHERE key = ?", (key,))
+        except sqlite3.Error as error:
+            print("Can not write the disk cache", self.path, error)
+
+    def put(self, key, value, size, expiration):
+        """
+        Store a result, evicting the least recently used ones if the cache is full
+
+        :param key: key of the query
+        :param value: result of the query
+        :param size: size in bytes of the response with the result
+        :param expiration: time when the result expires
+        """
+
+        if self.dump is not None:
+            value = self.dump(value)
+        data = zlib.compress(json.dumps(value).encode("utf-8"))
+        if len(data) > self.max_size:
+            return
+
+        now = time.time()
+
+        try:
+            conn = self.get_connection()
+            # Take the write lock now so other processes can't add results while evicting
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # An upsert, as the delete of INSERT OR REPLACE doesn't fire the triggers
+                conn.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                             "value = excluded.value, size = excluded.size, length = excluded.length, "
+                             "expiration = excluded.expiration, last_used = excluded.last_used",
+                             (key, data, size, len(data), expiration, now))
+                conn.execute("DELETE FROM results WHERE expiration < ?", (now - self.max_stale,))
+                self.evict(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as error:
+            print("Can not write the disk cache", self.path, error)
+
+    def evict(self, conn):
+        """
+        Remove the least recently used results until the stored ones fit in max_size
+        """
+
+        total_size = conn.execute("SELECT length FROM usage").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        evicted = []
+        for key, length in conn.execute("SELECT key, length FROM results ORDER BY last_used"):
+            evicted.append((key,))
+            total_size -= length
+            if total_size <= self.max_size:
+                break
+
+        conn.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def stats(self):
+        """
+        :return: dict with the counters of the disk cache
+        """
+
+        try:
+            entries, size = self.get_connection().execute("SELECT entries, length FROM usage").fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+
+        return {
+            'path': self.path,
+            'entries': entries,
+            'size': int(size) if size is not None else None,
+            'max_size': self.max_size
+        }
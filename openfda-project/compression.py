@@ -0,0 +1,154 @@
+# Compression of the responses negotiated with the clients
+
+
+import zlib
+
+from static import PageVersion, StaticPage
+
+MIN_SIZE = 1024  # Responses smaller than this are sent not compressed
+ENCODINGS = ('gzip', 'deflate')  # Supported encodings, the preferred first
+LEVEL = 6
+
+
+def choose_encoding(accept_encoding):
+    """
+    Choose the compression of a response using the Accept-Encoding header of the request
+
+    :param accept_encoding: value of the Accept-Encoding header
+    :return: 'gzip', 'deflate' or None to send the response not compressed
+    """
+
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            param_name, _, param_value = param.strip().partition("=")
+            if param_name == 'q':
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0
+        qualities[name.strip().lower()] = quality
+
+    encoding = None
+    encoding_quality = 0
+    for supported in ENCODINGS:
+        quality = qualities.get(supported, qualities.get('*', 0))
+        if quality > encoding_quality:
+            encoding = supported
+            encoding_quality = quality
+
+    return encoding
+
+
+def get_compressor(encoding):
+    """
+    :param encoding: 'gzip' or 'deflate' (zlib format, as HTTP defines it)
+    :return: zlib compress object for the encoding
+    """
+
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+
+    return zlib.compressobj(LEVEL, zlib.DEFLATED, wbits)
+
+
+def compress(content, encoding):
+    """
+    :param content: data to compress
+    :param encoding: 'gzip' or 'deflate'
+    :return: the compressed data
+    """
+
+    compressor = get_compressor(encoding)
+
+    return compressor.compress(content) + compressor.flush()
+
+
+def iter_compressed(chunks, encoding):
+    """
+    Compress a content while it is generated. Each chunk is flushed so the client
+    can show it without waiting for the rest.
+
+    :param chunks: iterator with the content
+    :param encoding: 'gzip' or 'deflate'
+    :return: generator with the compressed chunks
+    """
+
+    compressor = get_compressor(encoding)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+async def aiter_compressed(chunks, encoding):
+    """
+    iter_compressed for the content generated by an async iterator
+
+    :param chunks: async iterator with the content
+    :param encoding: 'gzip' or 'deflate'
+    :return: async generator with the compressed chunks
+    """
+
+    compressor = get_compressor(encoding)
+
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def get_variants(content):
+    """
+    :param content: data to be sent
+    :return: dict with the content for each encoding (None for not compressed)
+    """
+
+    variants = {None: content}
+
+    if len(content) >= MIN_SIZE:
+        for encoding in ENCODINGS:
+            variants[encoding] = compress(content, encoding)
+
+    return variants
+
+
+class CompressedPageVersion(PageVersion):
+    """
+    PageVersion also kept compressed with each encoding
+    """
+
+    __slots__ = ('variants',)
+
+    def __init__(self, text, content, etag, mtime):
+        super().__init__(text, content, etag, mtime)
+        self.variants = get_variants(content)
+
+    def get_etag(self, encoding):
+        """
+        :param encoding: encoding used to send the page
+        :return: the ETag of the page sent with the encoding (each variant has its own one)
+        """
+
+        if encoding not in self.variants or encoding is None:
+            return self.etag
+
+        return self.etag[:-1] + '-' + encoding + '"'
+
+
+class CompressedStaticPage(StaticPage):
+    """
+    StaticPage also kept compressed with each encoding, so sending it costs no CPU. The
+    variants are built before the new version is swapped in, so they always match its ETag.
+    """
+
+    version_class = CompressedPageVersion
@@ -0,0 +1,185 @@
+# Incremental decoding of the OpenFDA JSON responses while they are received
+
+
+import codecs
+import json
+import re
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+NUMBER_START = '-0123456789'
+DELIMITERS = ' \t\n\r,]}'  # Chars that can follow a complete number
+INCOMPLETE = object()  # Value not received completely yet
+
+
+class JSONItemsDecoder():
+    """
+    Decode the items of an array of a JSON object ({"meta": {...}, "results": [...]}) fed in
+    pieces, as they are read from the socket. Each item is decoded as soon as all its data
+    has been received, so the whole response is never kept in memory: only the data of
+    the item being received. The rest of the object is decoded and discarded.
+    """
+
+    def __init__(self, key='results', transform=None, timing=None):
+        """
+        :param key: key of the array with the items in the top level object
+        :param transform: function called with each decoded item returning what is kept of it
+        :param timing: RequestTiming to measure the decoding (decode span) and the transform (extract span)
+        """
+
+        self.key = key
+        self.transform = transform
+        self.timing = timing
+        self.items = []  # Items decoded (and transformed)
+        self.size = 0  # Bytes fed
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0  # Position in the buffer of the data not decoded yet
+        self.state = 'object'
+        self.name = None  # Key of the value being decoded
+        self.closed = False
+
+    def feed(self, data):
+        """
+        Decode the items completed with data
+
+        :param data: bytes of the JSON document following the fed ones
+        """
+
+        if self.timing is not None:
+            self.timing.start('decode')
+
+        try:
+            self.size += len(data)
+            text = self.text_decoder.decode(data)
+            # The decoded data is dropped from the buffer
+            self.buffer = self.buffer[self.pos:] + text
+            self.pos = 0
+
+            while self.step():
+                pass
+        finally:
+            if self.timing is not None:
+                self.timing.stop()
+
+    def pop_items(self):
+        """
+        Take the items decoded until now, so they are not kept by the decoder
+
+        :return: list with the items
+        """
+
+        items, self.items = self.items, []
+
+        return items
+
+    def close(self):
+        """
+        Decode the rest of the data once the whole document has been fed
+
+        :return: list with the decoded items not taken with pop_items
+        """
+
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(b"", final=True)
+        self.pos = 0
+        self.closed = True
+
+        while self.step():
+            pass
+
+        if self.state != 'end' or self.pos < len(self.buffer):
+            raise ValueError("Incomplete or invalid JSON document (%s)" % self.state)
+
+        return self.items
+
+    def step(self):
+        """
+        Decode the next token of the document
+
+        :return: False if more data is needed to go on
+        """
+
+        self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+        if self.pos == len(self.buffer):
+            return False
+
+        char = self.buffer[self.pos]
+        state = self.state
+
+        if state == 'object':
+            self.expect(char, '{')
+            self.state = 'first_key'
+        elif state == 'first_key' and char == '}':
+            self.pos += 1
+            self.state = 'end'
+        elif state in ('first_key', 'key'):
+            self.name = self.decode()
+            if self.name is INCOMPLETE:
+                return False
+            if not isinstance(self.name, str):
+                raise ValueError("Invalid key in JSON document")
+            self.state = 'colon'
+        elif state == 'colon':
+            self.expect(char, ':')
+            self.state = 'value'
+        elif state == 'value' and self.name == self.key and char == '[':
+            self.pos += 1
+            self.state = 'first_item'
+        elif state == 'first_item' and char == ']':
+            self.pos += 1
+            self.state = 'after_value'
+        elif state in ('first_item', 'item'):
+            item = self.decode()
+            if item is INCOMPLETE:
+                return False
+            if self.transform is not None:
+                # The item is released here if only part of it is kept
+                if self.timing is not None:
+                    self.timing.start('extract')
+                    item = self.transform(item)
+                    self.timing.stop()
+                else:
+                    item = self.transform(item)
+            self.items.append(item)
+            self.state = 'after_item'
+        elif state == 'after_item':
+            self.expect(char, ',]')
+            self.state = 'item' if char == ',' else 'after_value'
+        elif state == 'value':
+            # Not the items: decoded and discarded
+            if self.decode() is INCOMPLETE:
+                return False
+            self.state = 'after_value'
+        elif state == 'after_value':
+            self.expect(char, ',}')
+            self.state = 'key' if char == ',' else 'end'
+        else:
+            raise ValueError("Unexpected data after the JSON document")
+
+        return True
+
+    def expect(self, char, expected):
+        if char not in expected:
+            raise ValueError("Expecting %r in JSON document, found %r" % (expected, char))
+        self.pos += 1
+
+    def decode(self):
+        """
+        :return: the JSON value starting at pos or INCOMPLETE if it has not been received completely
+        """
+
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            if self.closed:
+                raise
+            return INCOMPLETE
+
+        if not self.closed and self.buffer[self.pos] in NUMBER_START and \
+                (end == len(self.buffer) or self.buffer[end] not in DELIMITERS):
+            # The number could go on in the next data (12 of 12.5)
+            return INCOMPLETE
+
+        self.pos = end
+
+        return value
@@ -0,0 +1,253 @@
+# Metrics of the server in the Prometheus text format
+
+
+import bisect
+import math
+import threading
+import weakref
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Seconds
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)  # Bytes
+
+
+def format_value(value):
+    """
+    :param value: int or float
+    :return: the value as written in the Prometheus text format
+    """
+
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+
+    return repr(value)
+
+
+def format_labels(names, values):
+    """
+    :param names: names of the labels
+    :param values: values of the labels, in the same order
+    :return: the labels of a sample, like {route="/listDrugs",code="200"}, or "" if there are none
+    """
+
+    if not names:
+        return ""
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+
+    return "{%s}" % ",".join('%s="%s"' % label for label in zip(names, escaped))
+
+
+def format_samples(name, kind, documentation, samples):
+    """
+    Format a metric whose values are taken from the stats of a component when it is collected
+
+    :param name: name of the metric
+    :param kind: counter or gauge
+    :param documentation: help of the metric
+    :param samples: list of tuples (dict with the labels, value)
+    :return: list with the lines of the metric
+    """
+
+    lines = ["# HELP %s %s" % (name, documentation), "# TYPE %s %s" % (name, kind)]
+    for labels, value in samples:
+        lines.append("%s%s %s" % (name, format_labels(tuple(labels), tuple(labels.values())), format_value(value)))
+
+    return lines
+
+
+class Shard():
+    """
+    Values of a thread in ShardedValues, dropped with the thread
+    """
+
+    __slots__ = ('values', '__weakref__')
+
+    def __init__(self, size):
+        self.values = [0] * size
+
+
+class ShardedValues():
+    """
+    Values updated by several threads without taking a lock: each thread updates its own
+    copy (shard), and the shards are added up when the values are collected. The lock is
+    only taken the first time a thread updates them, and when the thread ends: its values
+    are added to the ones of the finished threads, so the short-lived threads (like the
+    background refreshes) don't leave a shard behind.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: number of values
+        """
+
+        self.size = size
+        self.local = threading.local()
+        self.shards = []  # Values of each live thread
+        self.finished = [0] * size  # Sum of the values of the threads ended
+        self.lock = threading.Lock()
+
+    def get_shard(self):
+        """
+        :return: list with the values of the current thread
+        """
+
+        try:
+            return self.local.shard.values
+        except AttributeError:
+            shard = self.local.shard = Shard(self.size)
+            with self.lock:
+                self.shards.append(shard.values)
+            # The thread-local Shard is released when the thread ends
+            weakref.finalize(shard, self.fold, shard.values)
+            return shard.values
+
+    def fold(self, values):
+        """
+        Add the values of a thread ended to the ones of the finished threads
+        """
+
+        with self.lock:
+            self.shards = [shard for shard in self.shards if shard is not values]
+            self.finished = [total + value for total, value in zip(self.finished, values)]
+
+    def get_values(self):
+        """
+        :return: list with the sums of the values of all the threads
+        """
+
+        with self.lock:
+            shards = self.shards + [self.finished]
+
+        return [sum(values) for values in zip(*shards)]
+
+
+class CounterValue(ShardedValues):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        self.get_shard()[0] += amount
+
+    def collect(self, name, labels):
+        return ["%s%s %s" % (name, labels, format_value(self.get_values()[0]))]
+
+
+class GaugeValue(CounterValue):
+    # A thread can decrement what other thread incremented: only the sum of the shards matters
+    def dec(self, amount=1):
+        self.get_shard()[0] -= amount
+
+
+class HistogramValue(ShardedValues):
+    def __init__(self, buckets):
+        """
+        :param buckets: sorted upper bounds of the buckets, without +Inf
+        """
+
+        # Counts of each bucket, of +Inf and the sum of the observations
+        super().__init__(len(buckets) + 2)
+        self.buckets = buckets
+
+    def observe(self, value):
+        shard = self.get_shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def collect(self, name, labels):
+        values = self.get_values()
+        # The bucket label goes after the labels of the metric
+        prefix = labels[:-1] + "," if labels else "{"
+        lines = []
+        count = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), values):
+            count += bucket_count
+            lines.append('%s_bucket%sle="%s"} %d' % (name, prefix, format_value(float(bound)), count))
+        lines.append("%s_sum%s %s" % (name, labels, format_value(values[-1])))
+        lines.append("%s_count%s %d" % (name, labels, count))
+
+        return lines
+
+
+class Metric():
+    """
+    Metric with a value for each combination of the values of its labels. It is safe to
+    share it between threads.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        :param name: name of the metric
+        :param documentation: help of the metric
+        :param labels: names of the labels
+        """
+
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}  # Value by the values of the labels
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        :param values: values of the labels, in order
+        :return: the value of the metric for them, to be updated
+        """
+
+        value = self.values.get(values)
+        if value is None:
+            with self.lock:
+                value = self.values.setdefault(values, self.create_value())
+
+        return value
+
+    def create_value(self):
+        raise NotImplementedError
+
+    def collect(self):
+        """
+        :return: list with the lines of the metric
+        """
+
+        with self.lock:
+            values = sorted(self.values.items())
+
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+        for label_values, value in values:
+            lines += value.collect(self.name, format_labels(self.label_names, label_values))
+
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def create_value(self):
+        return CounterValue()
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def create_value(self):
+        return GaugeValue()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: sorted upper bounds of the buckets, without +Inf
+        """
+
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def create_value(self):
+        return HistogramValue(self.buckets)
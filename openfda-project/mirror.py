@@ -0,0 +1,547 @@
+# Local mirror of the OpenFDA drug labels loaded from its downloadable archives
+#
+# usage: mirror.py [--db openfda_mirror.db] [--replace] drug-label-0001-of-0012.json.zip ...
+#
+# The archives are listed in https://api.fda.gov/download.json
+
+
+import argparse
+import array
+import collections
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import urllib.request
+import zipfile
+from bisect import bisect_left
+
+from jsonstream import JSONItemsDecoder
+from records import CompanyCount, DrugRecord
+
+MIRROR_DB = "openfda_mirror.db"  # SQLite file with the mirrored labels
+READ_SIZE = 64 * 1024  # Bytes of an archive read at once
+BATCH_SIZE = 1000  # Labels inserted at once
+BLOCK_SIZE = 512  # Labels of a posting list stored together in the index
+MATCHES = ('words', 'exact', 'prefix')  # Ways to match the searched names
+COUNT_SORTS = ('labels', 'name')  # Orders of the companies counts
+WORD = re.compile(r'\w+')
+
+
+def normalize(value):
+    """
+    :param value: active ingredient or manufacturer name, stored or searched
+    :return: the value as it is indexed: lower case, without quotes and extra spaces
+    """
+
+    return " ".join(value.replace('"', ' ').casefold().split())
+
+
+class LabelMirror():
+    """
+    Drug labels stored in a SQLite file to answer the lists and the searches without
+    asking OpenFDA. Only the fields used by the server are stored, plus all the active
+    ingredients and manufacturer names of each label to search them.
+    The searches use an inverted index stored in the same file: for each normalized name,
+    and for each word of the names, the sorted list of labels (rowids) with it.
+    It is safe to share it between threads.
+    """
+
+    def __init__(self, path=MIRROR_DB):
+        """
+        :param path: path of the SQLite file
+        """
+
+        self.path = path
+        self.local = threading.local()  # A SQLite connection for each thread
+        self.lock = threading.Lock()
+        self.queries = 0
+
+        conn = self.get_connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS labels (id TEXT PRIMARY KEY, active_ingredient TEXT, "
+                     "manufacturer_name TEXT, warnings TEXT, active_ingredients TEXT, manufacturer_names TEXT)")
+        # field is ingredient or company (whole names) or ingredient_word or company_word.
+        # The posting list of a term is split in blocks of labels, by the first label of each block
+        conn.execute("CREATE TABLE IF NOT EXISTS postings (field TEXT, term TEXT, first INTEGER, labels BLOB, "
+                     "PRIMARY KEY (field, term, first)) WITHOUT ROWID")
+        # The first label and the number of labels of each term
+        conn.execute("CREATE TABLE IF NOT EXISTS terms (field TEXT, term TEXT, first INTEGER, labels INTEGER, "
+                     "PRIMARY KEY (field, term)) WITHOUT ROWID")
+        conn.execute("CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value)")
+
+        counted = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'companies'").fetchone() is not None
+        # Number of labels of each manufacturer (the first name of each label), kept up to date
+        # by the triggers while the labels are loaded, so they are never grouped for a request
+        conn.execute("CREATE TABLE IF NOT EXISTS companies (name TEXT PRIMARY KEY, labels INTEGER) WITHOUT ROWID")
+        conn.execute("CREATE INDEX IF NOT EXISTS companies_labels ON companies (labels DESC, name)")
+        conn.execute("CREATE TRIGGER IF NOT EXISTS count_inserted AFTER INSERT ON labels "
+                     "WHEN new.manufacturer_name IS NOT NULL BEGIN "
+                     "INSERT INTO companies VALUES (new.manufacturer_name, 1) "
+                     "ON CONFLICT (name) DO UPDATE SET labels = labels + 1; END")
+        conn.execute("CREATE TRIGGER IF NOT EXISTS count_deleted AFTER DELETE ON labels "
+                     "WHEN old.manufacturer_name IS NOT NULL BEGIN "
+                     "UPDATE companies SET labels = labels - 1 WHERE name = old.manufacturer_name; "
+                     "DELETE FROM companies WHERE name = old.manufacturer_name AND labels = 0; END")
+        if not counted:
+            # Labels loaded by a version without counts
+            conn.execute("INSERT INTO companies SELECT manufacturer_name, count(*) FROM labels "
+                         "WHERE manufacturer_name IS NOT NULL GROUP BY manufacturer_name")
+
+        if not self.is_indexed():
+            # Labels loaded without index
+            if self.get_labels_version()[0]:
+                print("Indexing the mirror", path)
+            self.build_index()
+
+    def get_connection(self):
+        """
+        :return: the SQLite connection for the current thread
+        """
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            # The server can read while the labels are loaded
+            conn.execute("PRAGMA journal_mode=WAL")
+            # The labels replaced are discounted by the delete trigger
+            conn.execute("PRAGMA recursive_triggers=ON")
+            self.local.conn = conn
+
+        return conn
+
+    @staticmethod
+    def get_row(drug):
+        """
+        :param drug: drug label from an OpenFDA archive
+        :return: tuple with the columns stored for the label
+        """
+
+        record = DrugRecord.from_result(drug)
+        openfda = drug.get('openfda') or {}
+
+        return (record.id, record.active_ingredient, record.manufacturer_name, record.warnings,
+                "\n".join(drug.get('active_ingredient') or []), "\n".join(openfda.get('manufacturer_name') or []))
+
+    def ingest(self, path, index=True):
+        """
+        Load the labels of a downloaded archive, replacing the stored labels with the same id
+
+        :param path: path of the archive (.json.zip or .json)
+        :param index: build the index once loaded (not needed if more archives are going to be loaded)
+        :return: number of labels loaded
+        """
+
+        labels = 0
+
+        if not zipfile.is_zipfile(path):
+            with open(path, 'rb') as stream:
+                labels += self.ingest_stream(stream)
+        else:
+            with zipfile.ZipFile(path) as archive:
+                for name in archive.namelist():
+                    if name.endswith('.json'):
+                        # Decompressed while it is read
+                        with archive.open(name) as stream:
+                            labels += self.ingest_stream(stream)
+
+        if index:
+            self.build_index()
+
+        return labels
+
+    def ingest_stream(self, stream):
+        """
+        Load the labels of an OpenFDA JSON document. It is read in pieces, so only
+        BATCH_SIZE labels are kept in memory.
+
+        :param stream: binary file with the document
+        :return: number of labels loaded
+        """
+
+        decoder = JSONItemsDecoder('results', self.get_row)
+        labels = 0
+
+        conn = self.get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                data = stream.read(READ_SIZE)
+                if not data:
+                    break
+                decoder.feed(data)
+                if len(decoder.items) >= BATCH_SIZE:
+                    labels += self.insert(conn, decoder.pop_items())
+            labels += self.insert(conn, decoder.close())
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return labels
+
+    @staticmethod
+    def insert(conn, rows):
+        conn.executemany("INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+        return len(rows)
+
+    def clear(self):
+        """
+        Remove all the stored labels
+        """
+
+        conn = self.get_connection()
+        conn.execute("DELETE FROM labels")
+        conn.execute("DELETE FROM postings")
+        conn.execute("DELETE FROM terms")
+        conn.execute("DELETE FROM info")
+        conn.execute("DELETE FROM companies")
+
+    def get_labels_version(self):
+        # Changes when labels are added or replaced
+        return self.get_connection().execute("SELECT count(*), ifnull(max(rowid), 0) FROM labels").fetchone()
+
+    def is_indexed(self):
+        """
+        :return: True if the index is up to date with the stored labels
+        """
+
+        row = self.get_connection().execute("SELECT value FROM info WHERE name = 'indexed_version'").fetchone()
+
+        return row is not None and row[0] == "%d %d" % self.get_labels_version()
+
+    def build_index(self):
+        """
+        Build the inverted index of the active ingredients and the manufacturer names of the stored labels.
+        The old index is replaced at once, so the searches go on using it while the new one is built.
+
+        :return: number of terms indexed
+        """
+
+        conn = self.get_connection()
+        postings = collections.defaultdict(lambda: array.array('I'))
+
+        version = self.get_labels_version()
+        rows = conn.execute("SELECT rowid, active_ingredients, manufacturer_names FROM labels ORDER BY rowid")
+        for rowid, active_ingredients, manufacturer_names in rows:
+            for field, names in (('ingredient', active_ingredients), ('company', manufacturer_names)):
+                terms = set()
+                for name in names.split("\n"):
+                    name = normalize(name)
+                    if name:
+                        terms.add((field, name))
+                        terms.update((field + '_word', word) for word in WORD.findall(name))
+                for term in terms:
+                    # The rowids are added in order, so the lists are sorted
+                    postings[term].append(rowid)
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM postings")
+            conn.execute("DELETE FROM terms")
+            conn.executemany("INSERT INTO terms VALUES (?, ?, ?, ?)",
+                             ((field, term, labels[0], len(labels)) for (field, term), labels in postings.items()))
+            conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)", (
+                (field, term, labels[start], labels[start:start + BLOCK_SIZE].tobytes())
+                for (field, term), labels in postings.items() for start in range(0, len(labels), BLOCK_SIZE)))
+            conn.execute("INSERT OR REPLACE INTO info VALUES ('indexed_version', ?)", ("%d %d" % version,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return len(postings)
+
+    def search(self, field, name, limit, match='words'):
+        """
+        Search the labels using the index. The names are matched ignoring the case.
+
+        :param field: ingredient or company
+        :param name: name searched
+        :param limit: max number of labels
+        :param match: words (labels with all the words of the name), exact (labels with the name)
+                      or prefix (labels with a name starting with the name)
+        :return: list of DrugRecord in the order they were loaded
+        """
+
+        conn = self.get_connection()
+        name = normalize(name)
+        limit = int(limit)
+
+        with self.lock:
+            self.queries += 1
+
+        if match == 'exact':
+            rowids = self.intersect([PostingList(conn, field, name)], limit)
+        elif match == 'prefix':
+            rowids = self.merge_prefix(conn, field, name, limit)
+        else:
+            words = set(WORD.findall(name))
+            if not words:
+                return []
+            rowids = self.intersect([PostingList(conn, field + '_word', word) for word in words], limit)
+
+        return self.get_records(rowids)
+
+    @staticmethod
+    def intersect(postings, limit):
+        """
+        :param postings: list of PostingList
+        :param limit: max number of rowids
+        :return: sorted list with the first limit rowids in all the lists
+        """
+
+        found = []
+        rowid = 0
+        while len(found) < limit:
+            # Each list skips to the candidate, until all of them have it
+            for labels in postings:
+                next_rowid = labels.seek(rowid)
+                if next_rowid is None:
+                    return found
+                if next_rowid != rowid:
+                    rowid = next_rowid
+                    break
+            else:
+                found.append(rowid)
+                rowid += 1
+
+        return found
+
+    @staticmethod
+    def merge_prefix(conn, field, prefix, limit):
+        """
+        :param conn: SQLite connection
+        :param field: ingredient or company
+        :param prefix: normalized prefix of the names
+        :param limit: max number of rowids
+        :return: sorted list with the first limit rowids of the names starting with prefix
+        """
+
+        found = []
+        # The terms starting with prefix are together in the primary key. They are merged in
+        # the order of their first label, until the rest can't have labels before the ones found.
+        # The rows are read while they are needed
+        rows = conn.execute("SELECT term, first FROM terms WHERE field = ? AND term >= ? AND term < ? ORDER BY first",
+                            (field, prefix, prefix + "\U0010ffff"))
+        for term, rowid in rows:
+            if len(found) >= limit and rowid > found[-1]:
+                break
+            labels = PostingList(conn, field, term)
+            while True:
+                rowid = labels.seek(rowid)
+                if rowid is None or (len(found) >= limit and rowid > found[-1]):
+                    break
+                position = bisect_left(found, rowid)
+                # The same label can have several names with the prefix
+                if position == len(found) or found[position] != rowid:
+                    found.insert(position, rowid)
+                    del found[limit:]
+                rowid += 1
+
+        return found
+
+    def get_records(self, rowids):
+        """
+        :param rowids: rowids of the labels
+        :return: list of DrugRecord of the labels in the order they were loaded
+        """
+
+        if not len(rowids):
+            return []
+
+        sql = "SELECT id, active_ingredient, manufacturer_name, warnings FROM labels WHERE rowid IN (%s) ORDER BY rowid"
+        rows = self.get_connection().execute(sql % ",".join("?" * len(rowids)), list(rowids)).fetchall()
+
+        return [DrugRecord(*row) for row in rows]
+
+    def select(self, where, params, limit):
+        """
+        :param where: SQL condition of the labels or None for all of them
+        :param params: params of the condition
+        :param limit: max number of labels
+        :return: list of DrugRecord in the order they were loaded
+        """
+
+        sql = "SELECT id, active_ingredient, manufacturer_name, warnings FROM labels"
+        if where:
+            sql += " WHERE " + where
+        sql += " ORDER BY rowid LIMIT ?"
+
+        with self.lock:
+            self.queries += 1
+
+        rows = self.get_connection().execute(sql, params + (int(limit),)).fetchall()
+
+        return [DrugRecord(*row) for row in rows]
+
+    def list_drugs(self, limit=10):
+        """
+        :param limit: Number of items to be included in the list
+        :return: list of DrugRecord
+        """
+
+        return self.select(None, (), limit)
+
+    def search_drugs(self, active_ingredient, limit=10, match='words'):
+        """
+        :param active_ingredient: active ingredient to search
+        :param limit: Number of items to be included in the list
+        :param match: how to match the active ingredient (see search)
+        :return: list of DrugRecord with the active ingredient
+        """
+
+        return self.search('ingredient', active_ingredient, limit, match)
+
+    def search_companies(self, company_name, limit=10, match='words'):
+        """
+        :param company_name: name of the company to search
+        :param limit: Number of items to be included in the list
+        :param match: how to match the company name (see search)
+        :return: list of DrugRecord made by the company
+        """
+
+        return self.search('company', company_name, limit, match)
+
+    def count_companies(self, limit=10, sort='labels'):
+        """
+        :param limit: Number of companies, the ones with more labels
+        :param sort: labels (more labels first) or name
+        :return: list of CompanyCount
+        """
+
+        sql = "SELECT name, labels FROM companies ORDER BY labels DESC, name LIMIT ?"
+        if sort == 'name':
+            sql = "SELECT * FROM (%s) ORDER BY name" % sql
+
+        with self.lock:
+            self.queries += 1
+
+        rows = self.get_connection().execute(sql, (int(limit),)).fetchall()
+
+        return [CompanyCount(*row) for row in rows]
+
+    def stats(self):
+        """
+        :return: dict with the counters of the mirror
+        """
+
+        try:
+            labels = self.get_connection().execute("SELECT count(*) FROM labels").fetchone()[0]
+        except sqlite3.Error:
+            labels = None
+
+        try:
+            terms = self.get_connection().execute("SELECT count(*) FROM terms").fetchone()[0]
+        except sqlite3.Error:
+            terms = None
+
+        return {
+            'path': self.path,
+            'labels': labels,
+            'terms': terms,
+            'queries': self.queries
+        }
+
+
+class PostingList():
+    """
+    Sorted rowids of the labels with a term of the index. Only the blocks of the list
+    needed to find the rowids asked are read.
+    """
+
+    def __init__(self, conn, field, term):
+        """
+        :param conn: SQLite connection of the mirror
+        :param field: field of the index
+        :param term: normalized term
+        """
+
+        self.conn = conn
+        self.field = field
+        self.term = term
+        self.labels = array.array('I')  # Block read
+        self.position = 0  # Position in the block of the last rowid found
+
+    def load(self, condition, rowid):
+        """
+        Read the block matching condition
+
+        :return: False if there is none
+        """
+
+        row = self.conn.execute("SELECT labels FROM postings WHERE field = ? AND term = ? AND " + condition,
+                                (self.field, self.term, rowid)).fetchone()
+        self.labels = array.array('I')
+        self.position = 0
+        if row is None:
+            return False
+        self.labels.frombytes(row[0])
+
+        return True
+
+    def seek(self, rowid):
+        """
+        :param rowid: rowid, not lower than the ones asked before
+        :return: the first rowid of the list not lower than rowid, or None if there are none
+        """
+
+        if not self.labels or self.labels[-1] < rowid:
+            # The block starting before rowid, or the next one if rowid is not in it
+            if not self.load("first <= ? ORDER BY first DESC LIMIT 1", rowid) or self.labels[-1] < rowid:
+                if not self.load("first > ? ORDER BY first LIMIT 1", rowid):
+                    return None
+
+        self.position = bisect_left(self.labels, rowid, self.position)
+
+        return self.labels[self.position]
+
+
+def download(url):
+    """
+    Download an archive to a temporary file without keeping it in memory
+
+    :param url: url of the archive
+    :return: the temporary file
+    """
+
+    archive = tempfile.NamedTemporaryFile(suffix=".zip")
+    with urllib.request.urlopen(url) as response:
+        shutil.copyfileobj(response, archive, READ_SIZE)
+    archive.flush()
+
+    return archive
+
+
+def get_params():
+    parser = argparse.ArgumentParser(usage="usage:mirror.py [options] archive ...",
+                                     description="Load the OpenFDA drug label archives into a local mirror")
+    parser.add_argument("archives", nargs='+',
+                        help="Paths or urls of the drug label archives (.json.zip) downloaded from OpenFDA")
+    parser.add_argument("--db", default=MIRROR_DB, help="SQLite file of the mirror")
+    parser.add_argument("--replace", action='store_true', help="Remove the labels loaded before")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = get_params()
+
+    mirror = LabelMirror(args.db)
+    if args.replace:
+        mirror.clear()
+
+    for archive in args.archives:
+        print("Loading", archive)
+        if archive.startswith(('http://', 'https://')):
+            with download(archive) as downloaded:
+                labels = mirror.ingest(downloaded.name, index=False)
+        else:
+            labels = mirror.ingest(archive, index=False)
+        print(labels, "labels loaded")
+
+    print("Indexing", args.db)
+    terms = mirror.build_index()
+    print(mirror.stats()['labels'], "labels and", terms, "terms indexed in", args.db)
@@ -0,0 +1,163 @@
+# Pre-fork mode: several worker processes serving the same port, each with its own GIL
+
+
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+RESTART_DELAY = 1  # Seconds to wait before restarting a worker that crashed just after starting
+DRAIN_TIMEOUT = 30  # Seconds the workers have to finish their requests when the server is stopped
+WATCH_INTERVAL = 1  # Seconds between the checks of a worker that its supervisor is alive
+REUSE_PORT = hasattr(socket, 'SO_REUSEPORT')  # Each worker can listen on the port with its own socket
+
+
+def create_listening_socket(port, backlog, reuse_port=False):
+    """
+    :param port: port to listen on, in all the interfaces
+    :param backlog: size of the accept backlog
+    :param reuse_port: other sockets can listen on the same port, and the kernel balances
+                       the connections between them
+    :return: the listening socket
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        sock.bind(("", port))
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+
+    return sock
+
+
+class PreforkServer():
+    """
+    Supervisor of the worker processes. Each worker accepts the connections of the port
+    using its own SO_REUSEPORT socket or, where it is not available, the socket of the
+    supervisor it inherits. The workers that die are restarted, and when the supervisor
+    gets SIGTERM or SIGINT it asks the workers to drain (SIGTERM): stop accepting, finish
+    the requests in progress and exit.
+    """
+
+    def __init__(self, serve, port, processes, backlog, reuse_port=REUSE_PORT):
+        """
+        :param serve: function run by each worker with its listening socket. It must serve until
+                      the worker gets SIGTERM and then return once its requests are finished.
+        :param port: port to listen on
+        :param processes: number of worker processes
+        :param backlog: size of the accept backlog of each listening socket
+        :param reuse_port: each worker listens with its own socket
+        """
+
+        self.serve = serve
+        self.port = port
+        self.processes = processes
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.socket = None  # Listening socket inherited by the workers
+        self.workers = {}  # Start time of each worker by pid
+        self.stopping = False
+        self.restarts = 0
+
+    def serve_forever(self):
+        """
+        Start the workers and keep them running until the supervisor is stopped
+        """
+
+        if self.reuse_port:
+            # Fail here if the port is busy, instead of in each worker
+            create_listening_socket(self.port, self.backlog, True).close()
+        else:
+            self.socket = create_listening_socket(self.port, self.backlog)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+
+        for _ in range(self.processes):
+            self.start_worker()
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.workers.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            print("worker", pid, "exited with status", os.waitstatus_to_exitcode(status), "restarting it",
+                  file=sys.stderr)
+            if time.monotonic() - started < RESTART_DELAY:
+                # Don't restart in a loop a worker that can't start
+                time.sleep(RESTART_DELAY)
+            if not self.stopping:
+                self.restarts += 1
+                self.start_worker()
+
+        signal.alarm(0)
+        if self.socket is not None:
+            self.socket.close()
+
+    def start_worker(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return
+
+        # In the worker: the supervisor decides when it stops
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        threading.Thread(target=self.watch_supervisor, args=(os.getppid(),), daemon=True).start()
+
+        code = 0
+        try:
+            sock = self.socket
+            if sock is None:
+                sock = create_listening_socket(self.port, self.backlog, True)
+            self.serve(sock)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    @staticmethod
+    def watch_supervisor(supervisor):
+        # Drain the worker if its supervisor has been killed, so it does not keep the port
+        while os.getppid() == supervisor:
+            time.sleep(WATCH_INTERVAL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def stop(self, signum=None, frame=None):
+        """
+        Drain the workers, killing them if they have not finished after DRAIN_TIMEOUT seconds
+        """
+
+        if self.stopping:
+            return
+        self.stopping = True
+        print("stopping the workers", file=sys.stderr)
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        signal.alarm(DRAIN_TIMEOUT)
+
+    def kill(self, signum=None, frame=None):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
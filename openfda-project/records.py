@@ -0,0 +1,155 @@
+# Compact records with the fields of the OpenFDA results used by the server
+
+
+import sys
+
+
+def get_first(values):
+    """
+    :param values: list of values of a OpenFDA field or None
+    :return: the first value or None if there are none
+    """
+
+    if values:
+        return values[0]
+
+    return None
+
+
+class DrugRecord():
+    """
+    Fields of a drug label used by the server. The label text sections are not kept, so a
+    record uses a small fraction of the memory of the label it comes from.
+    """
+
+    __slots__ = ('id', 'active_ingredient', 'manufacturer_name', 'warnings')
+
+    def __init__(self, id=None, active_ingredient=None, manufacturer_name=None, warnings=None):
+        self.id = id
+        self.active_ingredient = active_ingredient
+        self.manufacturer_name = manufacturer_name
+        self.warnings = warnings
+
+    @classmethod
+    def from_result(cls, drug):
+        """
+        :param drug: drug from a call to OpenFDA drugs API
+        :return: the record with the fields of the drug
+        """
+
+        openfda = drug.get('openfda') or {}
+        manufacturer_name = get_first(openfda.get('manufacturer_name'))
+        if manufacturer_name is not None:
+            # A few companies make most of the drugs: share their names
+            manufacturer_name = sys.intern(manufacturer_name)
+
+        return cls(drug.get('id'), get_first(drug.get('active_ingredient')), manufacturer_name,
+                   get_first(drug.get('warnings')))
+
+    @classmethod
+    def from_json(cls, value):
+        """
+        :param value: record converted with to_json
+        :return: the record
+        """
+
+        return cls(*value)
+
+    def to_json(self):
+        """
+        :return: the record as a JSON serializable list
+        """
+
+        return [self.id, self.active_ingredient, self.manufacturer_name, self.warnings]
+
+    def get_size(self):
+        """
+        :return: approximate bytes of memory used by the record
+        """
+
+        size = sys.getsizeof(self)
+        for field in (self.id, self.active_ingredient, self.warnings):
+            if field is not None:
+                size += sys.getsizeof(field)
+
+        return size
+
+    def __repr__(self):
+        return "DrugRecord(%s)" % ", ".join(repr(field) for field in self.to_json())
+
+
+class CompanyCount():
+    """
+    Number of drug labels of a company, from an OpenFDA count query or from the mirror
+    """
+
+    __slots__ = ('name', 'labels')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    @classmethod
+    def from_result(cls, result):
+        """
+        :param result: result of a call to OpenFDA drugs API with count={field}
+        :return: the record with the term and the count of the result
+        """
+
+        return cls(result.get('term'), result.get('count'))
+
+    def to_json(self):
+        """
+        :return: the record as a JSON serializable dict, like the OpenFDA count results
+        """
+
+        return {'term': self.name, 'count': self.labels}
+
+    def get_size(self):
+        """
+        :return: approximate bytes of memory used by the record
+        """
+
+        return sys.getsizeof(self) + sys.getsizeof(self.name)
+
+    def __repr__(self):
+        return "CompanyCount(%r, %r)" % (self.name, self.labels)
+
+
+def record_from_json(value):
+    """
+    :param value: record converted with to_json
+    :return: the DrugRecord or the CompanyCount
+    """
+
+    if isinstance(value, dict) and 'count' in value:
+        return CompanyCount.from_result(value)
+
+    return DrugRecord.from_json(value)
+
+
+def records_to_json(records):
+    """
+    :param records: list of DrugRecord or CompanyCount
+    :return: the records as a JSON serializable list
+    """
+
+    return [record.to_json() for record in records]
+
+
+def records_from_json(value):
+    """
+    :param value: list converted with records_to_json
+    :return: list of DrugRecord or CompanyCount
+    """
+
+    return [record_from_json(item) for item in value]
+
+
+def get_records_size(records):
+    """
+    :param records: list of DrugRecord or CompanyCount
+    :return: approximate bytes of memory used by the records
+    """
+
+    return sys.getsizeof(records) + sum(record.get_size() for record in records)
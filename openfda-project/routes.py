@@ -0,0 +1,171 @@
+# Declarative routes of the server, with their params and their stats
+
+
+import threading
+import urllib.parse
+
+
+class BadRequest(ValueError):
+    """
+    The params of a request are missing or not valid
+    """
+
+
+class Param():
+    """
+    Param of the query string of a route
+    """
+
+    def __init__(self, name, kind=str, default=None, required=False, min_value=None, max_value=None,
+                 choices=None):
+        """
+        :param name: name of the param in the query string
+        :param kind: type of the value: str, int or list (comma separated values)
+        :param default: value used if the param is missing or empty
+        :param required: the param can't be missing or empty
+        :param min_value: min value of the int params
+        :param max_value: max value of the int params
+        :param choices: valid values of the str and list params
+        """
+
+        self.name = name
+        self.kind = kind
+        self.default = default
+        self.required = required
+        self.min_value = min_value
+        self.max_value = max_value
+        self.choices = choices
+
+    def parse(self, values):
+        """
+        :param values: list with the values of the param in the query string, already decoded
+        :return: the value of the param
+        """
+
+        if not values or not values[0]:
+            if self.required:
+                raise BadRequest("Missing param %s" % self.name)
+            return self.default
+
+        value = values[0]
+
+        if self.kind is list:
+            # Both fields=a,b and fields=a&fields=b
+            value = [item for item in ",".join(values).split(",") if item]
+            for item in value:
+                if self.choices is not None and item not in self.choices:
+                    raise BadRequest("Param %s must be some of %s" % (self.name, ",".join(self.choices)))
+        elif self.kind is int:
+            try:
+                value = int(value)
+            except ValueError:
+                raise BadRequest("Param %s must be an integer" % self.name) from None
+            if self.min_value is not None and value < self.min_value:
+                raise BadRequest("Param %s must be at least %d" % (self.name, self.min_value))
+            if self.max_value is not None and value > self.max_value:
+                raise BadRequest("Param %s must be at most %d" % (self.name, self.max_value))
+        elif self.choices is not None and value not in self.choices:
+            raise BadRequest("Param %s must be one of %s" % (self.name, ",".join(self.choices)))
+
+        return value
+
+
+class Route():
+    """
+    Path served by the server with the params it accepts. It counts the requests,
+    the errors and the time spent serving them. It is safe to share it between threads.
+    """
+
+    def __init__(self, path, action, params=(), client_method=None, parser_method=None):
+        """
+        :param path: path of the route, without the query string
+        :param action: name of the OpenFDARequest method that answers the requests
+        :param params: list with the Param accepted in the query string
+        :param client_method: OpenFDAClient method called with the values of the params, in order
+        :param parser_method: OpenFDAParser method to parse each item returned by the client_method
+        """
+
+        self.path = path
+        self.action = action
+        self.params = params
+        self.client_method = client_method
+        self.parser_method = parser_method
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def parse_params(self, query):
+        """
+        :param query: query string of the request
+        :return: list with the values of the params, in the order of the route params
+        """
+
+        values = urllib.parse.parse_qs(query, keep_blank_values=True)
+
+        return [param.parse(values.get(param.name)) for param in self.params]
+
+    def record(self, elapsed, error=False):
+        """
+        Count a request served
+
+        :param elapsed: seconds spent serving it
+        :param error: it failed
+        """
+
+        with self.lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def stats(self):
+        """
+        :return: dict with the counters of the route
+        """
+
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'avg_time': self.total_time / self.requests if self.requests else 0.0,
+                'max_time': self.max_time
+            }
+
+
+class RouteTable():
+    """
+    Routes of the server by path, so finding the route of a request doesn't depend on the number of routes
+    """
+
+    def __init__(self, routes, not_found):
+        """
+        :param routes: list with the Route served
+        :param not_found: Route for the paths without route
+        """
+
+        self.routes = {route.path: route for route in routes}
+        self.not_found = not_found
+
+    def match(self, path):
+        """
+        :param path: path of the request, with its query string
+        :return: tuple (Route, query string)
+        """
+
+        path, _, query = path.partition("?")
+
+        return self.routes.get(urllib.parse.unquote(path), self.not_found), query
+
+    def stats(self):
+        """
+        :return: dict with the stats of each route
+        """
+
+        stats = {path: route.stats() for path, route in self.routes.items()}
+        stats[self.not_found.path] = self.not_found.stats()
+
+        return stats
@@ -1,69 +1,271 @@
 # Project Final for PNE 2018
 
 
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import html
 import http.server
+import itertools
 import json
+import math
+import os
+import queue
+import select
+import signal
+import socket
 import socketserver
+import threading
+import time
+import urllib.parse
+
+from async_http import (IDLE_TIMEOUT, MAX_CONCURRENCY, MAX_LINE, MAX_QUEUE, MAX_REQUESTS, SHED_RETRY_AFTER,
+                        AsyncHTTPServer, AsyncHTTPSConnectionPool, AsyncSingleFlight, format_trailers)
+from cache import CACHE_SIZE, CACHE_TTL, DISK_CACHE_SIZE, MAX_STALE, DiskCache, QueryCache
+from compression import MIN_SIZE, CompressedStaticPage, aiter_compressed, choose_encoding, compress, iter_compressed
+from jsonstream import JSONItemsDecoder
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, SIZE_BUCKETS, Counter, Gauge, Histogram, format_samples
+from mirror import COUNT_SORTS, MATCHES, LabelMirror
+from prefork import PreforkServer
+from records import CompanyCount, DrugRecord, get_records_size, records_from_json, records_to_json
+from routes import BadRequest, Param, Route, RouteTable
+from timing import PROFILE_SORTS, STREAMED_SPANS, RequestProfiler, RequestTiming, current_timing, measure
+from upstream import (BACKGROUND, CONNECT_TIMEOUT, INTERACTIVE, OPENFDA_KEY_LIMITS, OPENFDA_LIMITS, READ_TIMEOUT,
+                      RETRIES, THROTTLED_PAUSE, CircuitBreaker, HTTPSConnectionPool, QuotaExceeded, RateLimiter,
+                      RetryPolicy, SingleFlight, UpstreamUnavailable)
 
 socketserver.TCPServer.allow_reuse_address = True
 
 PORT = 8000
+WORKERS = 16  # Threads serving requests at the same time (0 to serve one request at a time)
+BACKLOG = 128  # Connections waiting to be accepted by the server
+CACHE_DB = "openfda_cache.db"  # SQLite file with the OpenFDA results cached on disk
+FANOUT = 4  # Windows of a paged query fetched from OpenFDA at the same time
+CHUNK_SIZE = 16 * 1024  # Chars of a HTML list sent in each chunk
+PAGES_CACHE_SIZE = 16 * 1024 * 1024  # Max bytes of rendered pages kept in memory
+PAGES_CACHE_TTL = 60  # Seconds a rendered page is valid
+MAX_PAGE_SIZE = 1024 * 1024  # Bigger rendered pages are not cached
+IDLE_POLL_INTERVAL = 0.1  # Seconds between the checks of the waiting connections of an idle keep-alive one
+SLOW_REQUEST_TIME = 1  # Seconds serving a request to keep it in the slow requests log
+SLOW_LOG_SIZE = 100  # Slow requests kept in the log
+# Response to the connections rejected when the queue is full
+OVERLOADED_RESPONSE = ("HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Length: 0\r\n"
+                       "Connection: close\r\n\r\n" % SHED_RETRY_AFTER).encode("latin-1")
 
 OPENFDA_BASIC = False
 
 
 class OpenFDAClient():
-
-    def send_query(self, query):
+    OPENFDA_API_URL = "api.fda.gov"
+    OPENFDA_API_LABEL = "/drug/label.json"
+    MAX_LIMIT = 1000  # Max results OpenFDA returns for a query
+    MAX_SKIP = 25000  # Max results OpenFDA skips for a query
+
+    breaker = CircuitBreaker()  # State of OpenFDA shared by the pools of both engines
+    pool = HTTPSConnectionPool(OPENFDA_API_URL, breaker=breaker)  # Kept-alive connections shared by all the requests
+    cache = QueryCache()  # Results of the queries shared by all the requests
+    flights = SingleFlight()  # Queries in flight to OpenFDA
+    windows_executor = concurrent.futures.ThreadPoolExecutor(WORKERS)  # Threads getting the windows of paged queries
+    mirror = None  # LabelMirror to get the lists and the searches from instead of OpenFDA
+    limiter = RateLimiter(OPENFDA_LIMITS)  # Quota of requests to OpenFDA shared by all the requests
+    api_key = None  # OpenFDA API key sent with the queries, for a bigger quota
+    # Metrics of the requests to OpenFDA by kind of query
+    upstream_duration = Histogram('openfda_upstream_request_duration_seconds',
+                                  "Time of the requests to OpenFDA, retries included", ['call'])
+    upstream_responses = Counter('openfda_upstream_responses_total',
+                                 "Responses of OpenFDA by status code (error if there was none)", ['call', 'status'])
+    upstream_in_flight = Gauge('openfda_upstream_requests_in_flight', "Requests to OpenFDA in progress")
+
+    def send_query(self, query, stale=False):
         """
         Send a query to the OpenFDA API
 
         :param query: query to be sent
+        :param stale: return at once a cached result even if it has expired (up to the
+                      max staleness of the cache), refreshing it in background
         :return: the result of the query in JSON format
         """
 
-        headers = {'User-Agent': 'http-client'}
+        key = self.cache.get_key(query)
+
+        items, expired = self.cache.get_stale(query, stale)
+        if items is not None:
+            if expired:
+                # Only one refresh for each query at the same time, after the requests of the clients
+                self.flights.do_in_background(key, self.fetch_query, query, BACKGROUND)
+            return items
+
+        try:
+            # The same query sent by other requests at the same time is sent only once
+            with measure('upstream'):
+                return self.flights.do(key, self.fetch_query, query)
+        except UpstreamUnavailable as error:
+            return self.get_fallback(query, error)
+
+    def fetch_query(self, query, priority=INTERACTIVE):
+        """
+        Get the results of a query from OpenFDA and cache them
 
-        conn = http.client.HTTPSConnection("api.fda.gov")
+        :param query: query to be sent
+        :param priority: INTERACTIVE or BACKGROUND, to wait for the quota of requests
+        :return: the result of the query in JSON format
+        """
+
+        headers = {'User-Agent': 'http-client'}
 
         # Get a  https://api.fda.gov/drug/label.json drug label from this URL and
         # extract what is the id,
         # the purpose of the drug and the manufacturer_name
 
-        query_url = "/drug/label.json"
+        query_url = self.get_query_url(query)
+
+        print("Sending to OpenFDA the query", query_url)
+
+        # The results are decoded while they are received, without keeping the whole response,
+        # and only the fields used are kept of each one
+        decoder = JSONItemsDecoder('results', self.get_record_type(query).from_result, self.get_timing(priority))
+        self.upstream_in_flight.labels().inc()
+        start = time.monotonic()
+        status = 'error'
+        try:
+            # Each attempt the circuit breaker lets through takes its own token from the quota
+            status, reason, _ = self.pool.request(self.add_api_key(query_url), headers, decoder,
+                                                  functools.partial(self.limiter.acquire, priority))
+        finally:
+            self.record_upstream(query, status, time.monotonic() - start)
+        print(status, reason)
+        self.check_throttled(status)
+
+        items = decoder.close()
+        self.cache_items(query, status, items, get_records_size(items))
+
+        return items
+
+    @staticmethod
+    def get_timing(priority):
+        """
+        :param priority: INTERACTIVE or BACKGROUND
+        :return: RequestTiming of the request a query is sent for, None for the background refreshes
+        """
+
+        return current_timing.get() if priority == INTERACTIVE else None
+
+    def record_upstream(self, query, status, elapsed):
+        """
+        Count a request to OpenFDA in the metrics
+
+        :param query: query sent
+        :param status: status code of the response, or 'error' if there was none
+        :param elapsed: seconds it took
+        """
+
+        if query.startswith("count="):
+            call = 'count'
+        elif "search=" in query:
+            call = 'search'
+        else:
+            call = 'list'
+
+        self.upstream_in_flight.labels().dec()
+        self.upstream_duration.labels(call).observe(elapsed)
+        self.upstream_responses.labels(call, str(status)).inc()
+
+    @staticmethod
+    def get_record_type(query):
+        """
+        :param query: query to be sent
+        :return: class of the records kept of its results: the count queries return terms and counts
+        """
+
+        return CompanyCount if query.startswith("count=") else DrugRecord
+
+    def get_query_url(self, query):
+        """
+        :param query: query to be sent
+        :return: the url to get from OpenFDA
+        """
+
+        query_url = self.OPENFDA_API_LABEL
 
         if query:
             query_url += "?" + query
 
-        print("Sending to OpenFDA the query", query_url)
+        return query_url
 
-        conn.request("GET", query_url, None, headers)
-        r1 = conn.getresponse()
-        print(r1.status, r1.reason)
-        res_raw = r1.read().decode("utf-8")
-        conn.close()
+    def add_api_key(self, query_url):
+        """
+        :param query_url: url of a query
+        :return: the url with the API key, if there is one
+        """
 
-        res = json.loads(res_raw)
+        if not self.api_key:
+            return query_url
 
-        if 'results' in res:
-            items = res['results']
-        else:
-            items = []
+        return query_url + ("&" if "?" in query_url else "?") + "api_key=" + urllib.parse.quote(self.api_key)
+
+    def check_throttled(self, status):
+        """
+        Stop sending queries for a while if OpenFDA has rejected one for going over the quota.
+        Its response is not a result, so it must not be shown as an empty list.
+
+        :param status: status code of the OpenFDA response
+        :raise QuotaExceeded: if it was rejected
+        """
+
+        if status == 429:
+            self.limiter.pause(THROTTLED_PAUSE)
+            raise QuotaExceeded("OpenFDA quota exceeded", THROTTLED_PAUSE)
+
+    def get_fallback(self, query, error):
+        """
+        Get the expired result of a query that can't be got from OpenFDA, while it is failing
+
+        :param query: query sent
+        :param error: UpstreamUnavailable raised getting it
+        :return: the cached result, if it expired less than the max staleness ago
+        :raise UpstreamUnavailable: if there is not such result
+        """
+
+        items, _ = self.cache.get_stale(query, True)
+        if items is None:
+            raise error
 
         return items
 
-    def search_drugs(self, active_ingredient, limit=10):
+    def cache_items(self, query, status, items, size):
+        """
+        Cache the results of a query. Only found (200) and not found (404) results are cached.
+
+        :param query: query sent
+        :param status: status code of the OpenFDA response
+        :param items: results of the query
+        :param size: memory used by the results
+        """
+
+        if status in (200, 404):
+            self.cache.put(query, items, size)
+
+    def search_drugs(self, active_ingredient, limit=10, match='words'):
         """
         Search for drugs given an active ingredient drug_name
 
         :param drug_name: name of the drug to search
         :param limit: Number of items to be included in the list
+        :param match: words, exact or prefix, how the mirror matches the name (OpenFDA does its own matching)
         :return: a JSON list with the results
         """
 
         # drug_name for example: acetylsalicylic
 
-        query = 'search=active_ingredient:"%s"' % active_ingredient
+        if self.mirror is not None:
+            return self.send_mirror_query('search_drugs', active_ingredient, limit, match)
+
+        query = 'search=active_ingredient:"%s"' % urllib.parse.quote(active_ingredient)
+
+        if self.is_paged(limit):
+            return self.send_paged_query(query, int(limit))
 
         if limit:
             query += "&limit=" + str(limit)
@@ -80,21 +282,35 @@ class OpenFDAClient():
         :return: a JSON list with the results
         """
 
+        if self.mirror is not None:
+            return self.send_mirror_query('list_drugs', limit)
+
+        # Listing is fine with a slightly old result if the user doesn't need to wait for OpenFDA
+        if self.is_paged(limit):
+            return self.send_paged_query("", int(limit), stale=True)
+
         query = "limit=" + str(limit)
 
-        drugs = self.send_query(query)
+        drugs = self.send_query(query, stale=True)
 
         return drugs
 
-    def search_companies(self, company_name, limit=10):
+    def search_companies(self, company_name, limit=10, match='words'):
         """
         Search for companies given a company_name
 
         :param company_name: name of the company to search
+        :param match: words, exact or prefix, how the mirror matches the name (OpenFDA does its own matching)
         :return: a JSON list with the results
         """
 
-        query = 'search=openfda.manufacturer_name:"%s"' % company_name
+        if self.mirror is not None:
+            return self.send_mirror_query('search_companies', company_name, limit, match)
+
+        query = 'search=openfda.manufacturer_name:"%s"' % urllib.parse.quote(company_name)
+
+        if self.is_paged(limit):
+            return self.send_paged_query(query, int(limit))
 
         if limit:
             query += "&limit=" + str(limit)
@@ -103,8 +319,269 @@ class OpenFDAClient():
 
         return drugs
 
+    def count_companies(self, limit=10, sort='labels'):
+        """
+        Count the drug labels of each company
+
+        :param limit: Number of companies, the ones with more labels
+        :param sort: labels (more labels first) or name
+        :return: a list of CompanyCount
+        """
+
+        if self.mirror is not None:
+            return self.send_mirror_query('count_companies', limit, sort)
+
+        # OpenFDA groups the labels, sorted by count. The counts change slowly, so a
+        # slightly old result is fine
+        query = "count=openfda.manufacturer_name.exact&limit=" + str(limit)
+
+        return self.send_count_query(query, sort)
+
+    def send_count_query(self, query, sort):
+        """
+        :param query: count query to be sent
+        :param sort: labels (as OpenFDA sorts them) or name
+        :return: a list of CompanyCount
+        """
+
+        return self.sort_counts(self.send_query(query, stale=True), sort)
+
+    @staticmethod
+    def sort_counts(counts, sort):
+        if sort == 'name':
+            return sorted(counts, key=lambda count: count.name)
+
+        return counts
+
+    def send_mirror_query(self, method, *args):
+        """
+        Get the drugs from the local mirror
+
+        :param method: LabelMirror method to call
+        :return: list of DrugRecord
+        """
+
+        with measure('mirror'):
+            return getattr(self.mirror, method)(*args)
+
+    def is_paged(self, limit):
+        """
+        :param limit: Number of items to be included in the list
+        :return: True if the limit is over the max one OpenFDA returns for a query
+        """
+
+        return str(limit).isdigit() and int(limit) > self.MAX_LIMIT
+
+    def get_windows(self, query, limit):
+        """
+        Split a query with a big limit in skip/limit windows OpenFDA can answer
+
+        :param query: query without limit
+        :param limit: Number of items to be included in the list
+        :return: list with the queries for each window
+        """
+
+        windows = []
+        for skip in range(0, min(limit, self.MAX_SKIP + self.MAX_LIMIT), self.MAX_LIMIT):
+            window = "skip=%d&limit=%d" % (skip, min(self.MAX_LIMIT, limit - skip))
+            windows.append(query + "&" + window if query else window)
+
+        return windows
+
+    def send_paged_query(self, query, limit, stale=False):
+        """
+        Send a query with a limit over the max one, getting FANOUT windows at the same time
+
+        :param query: query without limit
+        :param limit: Number of items to be included in the list
+        :param stale: accept stale results (see send_query)
+        :return: an iterator with the results in order. Only FANOUT windows are
+                 kept in memory at the same time.
+        """
+
+        return itertools.chain.from_iterable(self.fetch_windows(self.get_windows(query, limit), stale))
+
+    def fetch_windows(self, windows, stale):
+        """
+        Generator with the results of each window, in order
+        """
+
+        windows = iter(windows)
+        futures = collections.deque()
+
+        try:
+            for window in itertools.islice(windows, FANOUT):
+                futures.append(self.windows_executor.submit(self.send_query, window, stale))
+
+            while futures:
+                with measure('upstream'):
+                    items = futures.popleft().result()
+                if len(items) < self.MAX_LIMIT:
+                    # No more results after this window
+                    yield items
+                    return
+                for window in itertools.islice(windows, 1):
+                    futures.append(self.windows_executor.submit(self.send_query, window, stale))
+                yield items
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+class AsyncOpenFDAClient(OpenFDAClient):
+    """
+    OpenFDAClient for the asyncio engine: send_query is a coroutine, so the search and
+    list methods inherited from OpenFDAClient return awaitables
+    """
+
+    pool = None  # AsyncHTTPSConnectionPool shared by all the requests of the event loop
+    async_flights = AsyncSingleFlight()  # Queries in flight to OpenFDA
+
+    async def send_query(self, query, stale=False):
+        """
+        Send a query to the OpenFDA API without blocking the event loop
+
+        :param query: query to be sent
+        :param stale: return at once a cached result even if it has expired (up to the
+                      max staleness of the cache), refreshing it in background
+        :return: the result of the query in JSON format
+        """
+
+        key = self.cache.get_key(query)
+
+        # The disk cache is read in a thread, like the mirror
+        items, expired = await self.cache.get_stale_async(query, stale, self.windows_executor)
+        if items is not None:
+            if expired:
+                # Only one refresh for each query at the same time, after the requests of the clients
+                self.async_flights.do_in_background(key, self.fetch_query, query, BACKGROUND)
+            return items
+
+        try:
+            # The same query sent by other requests at the same time is sent only once
+            with measure('upstream'):
+                return await self.async_flights.do(key, self.fetch_query, query)
+        except UpstreamUnavailable as error:
+            return await self.get_fallback(query, error)
+
+    async def send_count_query(self, query, sort):
+        """
+        :param query: count query to be sent
+        :param sort: labels (as OpenFDA sorts them) or name
+        :return: a list of CompanyCount
+        """
+
+        return self.sort_counts(await self.send_query(query, stale=True), sort)
+
+    async def send_mirror_query(self, method, *args):
+        """
+        Get the drugs from the local mirror in a thread, without blocking the event loop
+
+        :param method: LabelMirror method to call
+        :return: list of DrugRecord
+        """
+
+        with measure('mirror'):
+            return await asyncio.get_running_loop().run_in_executor(self.windows_executor,
+                                                                    getattr(self.mirror, method), *args)
+
+    async def send_paged_query(self, query, limit, stale=False):
+        """
+        Send a query with a limit over the max one, getting FANOUT windows at the same time
+
+        :param query: query without limit
+        :param limit: Number of items to be included in the list
+        :param stale: accept stale results (see send_query)
+        :return: an async iterator with the results of each window, in order. Only FANOUT
+                 windows are kept in memory at the same time.
+        """
+
+        return self.fetch_windows(self.get_windows(query, limit), stale)
+
+    async def fetch_windows(self, windows, stale):
+        """
+        Async generator with the results of each window, in order
+        """
+
+        windows = iter(windows)
+        tasks = collections.deque()
+
+        try:
+            for window in itertools.islice(windows, FANOUT):
+                tasks.append(asyncio.ensure_future(self.send_query(window, stale)))
+
+            while tasks:
+                with measure('upstream'):
+                    items = await tasks.popleft()
+                if len(items) < self.MAX_LIMIT:
+                    # No more results after this window
+                    yield items
+                    return
+                for window in itertools.islice(windows, 1):
+                    tasks.append(asyncio.ensure_future(self.send_query(window, stale)))
+                yield items
+        finally:
+            for task in tasks:
+                if not task.cancel() and not task.cancelled():
+                    # Already finished: its error is retrieved so it is not reported as lost
+                    task.exception()
+
+    async def fetch_query(self, query, priority=INTERACTIVE):
+        """
+        Get the results of a query from OpenFDA and cache them
+
+        :param query: query to be sent
+        :param priority: INTERACTIVE or BACKGROUND, to wait for the quota of requests
+        :return: the result of the query in JSON format
+        """
+
+        headers = {'User-Agent': 'http-client'}
+
+        query_url = self.get_query_url(query)
+
+        print("Sending to OpenFDA the query", query_url)
+
+        decoder = JSONItemsDecoder('results', self.get_record_type(query).from_result, self.get_timing(priority))
+        self.upstream_in_flight.labels().inc()
+        start = time.monotonic()
+        status = 'error'
+        try:
+            # Each attempt the circuit breaker lets through takes its own token from the quota
+            status, reason, _ = await self.pool.request(self.add_api_key(query_url), headers, decoder,
+                                                        functools.partial(self.limiter.acquire_async, priority))
+        finally:
+            self.record_upstream(query, status, time.monotonic() - start)
+        print(status, reason)
+        self.check_throttled(status)
+
+        items = decoder.close()
+        await self.cache_items(query, status, items, get_records_size(items))
+
+        return items
+
+    async def get_fallback(self, query, error):
+        """
+        Like OpenFDAClient.get_fallback, reading the disk cache in a thread
+        """
+
+        items, _ = await self.cache.get_stale_async(query, True, self.windows_executor)
+        if items is None:
+            raise error
+
+        return items
+
+    async def cache_items(self, query, status, items, size):
+        """
+        Like OpenFDAClient.cache_items, writing the disk cache in a thread
+        """
+
+        if status in (200, 404):
+            await self.cache.put_async(query, items, size, self.windows_executor)
+
 
 class OpenFDAHTML():
+    main_page = CompressedStaticPage("openfda.html")
+    not_found_page = CompressedStaticPage("not_found.html")
 
     def build_html_list(self, items):
         """
@@ -114,180 +591,1295 @@ class OpenFDAHTML():
         :return: string with the HTML list
         """
 
-        html_list = "<ul>"
+        return "".join(self.iter_html_list(items))
+
+    def iter_html_list(self, items, start=True, end=True):
+        """
+        Creates the HTML list with the items in chunks of about CHUNK_SIZE chars, so the
+        list can be sent while the items are still being parsed
+
+        :param items: iterable with the items to be included in the HTML list
+        :param start: the items are the first ones of the list (False for the next parts of a list)
+        :param end: the items are the last ones of the list
+        :return: generator with the chunks of the HTML list
+        """
+
+        if start:
+            # The first chunk goes out at once
+            yield "<ul>"
+
+        chunk = []
+        chunk_size = 0
         for item in items:
-            html_list += "<li>" + item + "</li>"
-        html_list += "</ul>"
+            html_item = "<li>" + item + "</li>"
+            chunk.append(html_item)
+            chunk_size += len(html_item)
+            if chunk_size >= CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+                chunk_size = 0
+        if end:
+            chunk.append("</ul>")
 
-        return html_list
+        if chunk:
+            yield "".join(chunk)
 
 
     def get_not_found_page(self):
-        with open("not_found.html") as html_file:
-            html = html_file.read()
+        return self.not_found_page.get().text
+
+class OpenFDAJSON():
+
+    def iter_json_list(self, items, start=True, end=True):
+        """
+        Creates the JSON array with the items in chunks of about CHUNK_SIZE chars, so the
+        array can be sent while the items are still being extracted
+
+        :param items: iterable with the JSON serializable items
+        :param start: the items are the first ones of the array (False for the next parts of
+                      an array, after some items)
+        :param end: the items are the last ones of the array
+        :return: generator with the chunks of the JSON array
+        """
+
+        if start:
+            yield "["
+
+        chunk = []
+        chunk_size = 0
+        separator = "" if start else ","
+        for item in items:
+            json_item = separator + json.dumps(item)
+            separator = ","
+            chunk.append(json_item)
+            chunk_size += len(json_item)
+            if chunk_size >= CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+                chunk_size = 0
+        if end:
+            chunk.append("]")
+
+        if chunk:
+            yield "".join(chunk)
 
-        return html
 
 class OpenFDAParser():
 
+    # Fields of the drugs that can be extracted for each list
+    DRUG_FIELDS = ('id', 'active_ingredient', 'manufacturer_name')
+    COMPANY_FIELDS = ('id', 'manufacturer_name')
+    WARNING_FIELDS = ('id', 'warnings')
+    COUNT_FIELDS = ('name', 'labels')
+
     def parse_companies(self, drugs):
         """
         Given a OpenFDA result, extract the drugs data
 
-        :param drugs: result form a call to OpenFDA drugs API
+        :param drugs: DrugRecord list from a call to OpenFDA drugs API
         :return: list with companies info
         """
 
-        companies = []
-        for drug in drugs:
-            if 'openfda' in drug and 'manufacturer_name' in drug['openfda']:
-                companies.append(drug['id'] + " "+ drug['openfda']['manufacturer_name'][0])
-            else:
-                companies.append("Unknown")
+        return [self.parse_company(drug) for drug in drugs]
+
+    def parse_company(self, drug):
+        """
+        :param drug: DrugRecord from a call to OpenFDA drugs API
+        :return: company info
+        """
+
+        if drug.manufacturer_name is not None:
+            return drug.id + " "+ drug.manufacturer_name
 
-        return companies
+        return "Unknown"
 
     def parse_drugs(self, drugs):
         """
 
-        :param drugs: result form a call to OpenFDA drugs API
+        :param drugs: DrugRecord list from a call to OpenFDA drugs API
         :return: list with drugs info
         """
 
-        drugs_labels = []
+        return [self.parse_drug(drug) for drug in drugs]
 
-        for drug in drugs:
-            drug_label = drug['id']
-            if 'active_ingredient' in drug:
-                drug_label += " " + drug['active_ingredient'][0]
-            if 'openfda' in drug and 'manufacturer_name' in drug['openfda']:
-                drug_label += " " + drug['openfda']['manufacturer_name'][0]
+    def parse_drug(self, drug):
+        """
+        :param drug: DrugRecord from a call to OpenFDA drugs API
+        :return: drug info
+        """
 
-            drugs_labels.append(drug_label)
+        drug_label = drug.id
+        if drug.active_ingredient is not None:
+            drug_label += " " + drug.active_ingredient
+        if drug.manufacturer_name is not None:
+            drug_label += " " + drug.manufacturer_name
 
-        return drugs_labels
+        return drug_label
 
     def parse_warnings(self, drugs):
         """
         Given a OpenFDA result, extract the warnings data
 
-        :param drugs: result form a call to OpenFDA drugs API
+        :param drugs: DrugRecord list from a call to OpenFDA drugs API
         :return: list with warnings info
         """
 
-        warnings = []
+        return [self.parse_warning(drug) for drug in drugs]
 
-        for drug in drugs:
-            if 'warnings' in drug and drug['warnings']:
-                warnings.append(drug['warnings'][0])
-            else:
-                warnings.append("None")
-        return warnings
+    def parse_warning(self, drug):
+        """
+        :param drug: DrugRecord from a call to OpenFDA drugs API
+        :return: warnings info
+        """
+
+        if drug.warnings is not None:
+            return drug.warnings
+
+        return "None"
+
+    def parse_company_count(self, count):
+        """
+        :param count: CompanyCount from a count call to OpenFDA drugs API
+        :return: company labels info
+        """
+
+        return "%s (%d labels)" % (count.name, count.labels)
+
+    def get_fields(self, drug, fields):
+        """
+        :param drug: DrugRecord from a call to OpenFDA drugs API
+        :param fields: names of the fields to extract
+        :return: dict with the fields of the drug, None for the missing ones
+        """
+
+        return {field: getattr(drug, field) for field in fields}
+
+
+class OpenFDARequest():
+    """
+    Decides how to answer a request path. It does not talk to OpenFDA itself, so the
+    same logic is shared by the threaded and the asyncio engines.
+
+    API to be supported
+
+    searchDrug?active_ingredient=<drug_name>&limit=<limit>&match=<words|exact|prefix>
+    searchCompany?company=<company_name>&limit=<limit>&match=<words|exact|prefix>
+    listDrugs?limit=<limit>
+    listCompanies?limit=<limit>
+    listWarnings?limit=<limit>
+    countCompanies?limit=<limit>&sort=<labels|name>
+    stats
+    metrics (Prometheus text format)
+    admin/profile?action=<start|stop|reset|stats>&requests=<requests>&sort=<cumulative|tottime|calls>&limit=<limit>
+    admin/slowRequests
+    (the admin routes only if the server is started with --admin)
+
+    and their JSON versions, with the fields=<field>,... to be included in the items:
+
+    api/searchDrug, api/searchCompany, api/listDrugs, api/listCompanies, api/listWarnings, api/countCompanies
+    """
+
+    # Number of items of the lists, up to the max a paged query can get
+    limit_param = Param('limit', int, 10, min_value=1, max_value=OpenFDAClient.MAX_SKIP + OpenFDAClient.MAX_LIMIT)
+    # Number of companies counted, up to the max OpenFDA groups
+    count_limit_param = Param('limit', int, 10, min_value=1, max_value=OpenFDAClient.MAX_LIMIT)
+    count_sort_param = Param('sort', str, COUNT_SORTS[0], choices=COUNT_SORTS)
+    # How the searched names are matched by the mirror
+    match_param = Param('match', str, MATCHES[0], choices=MATCHES)
+    # Fields of the items of the JSON lists
+    drug_fields_param = Param('fields', list, OpenFDAParser.DRUG_FIELDS, choices=OpenFDAParser.DRUG_FIELDS)
+    company_fields_param = Param('fields', list, OpenFDAParser.COMPANY_FIELDS, choices=OpenFDAParser.COMPANY_FIELDS)
+    warning_fields_param = Param('fields', list, OpenFDAParser.WARNING_FIELDS, choices=OpenFDAParser.WARNING_FIELDS)
+    count_fields_param = Param('fields', list, OpenFDAParser.COUNT_FIELDS, choices=OpenFDAParser.COUNT_FIELDS)
+    routes = RouteTable([
+        Route('/', 'send_main_page'),
+        Route('/stats', 'send_stats'),
+        Route('/metrics', 'send_metrics'),
+        Route('/admin/profile', 'send_profile', [
+            Param('action', str, 'stats', choices=('start', 'stop', 'reset', 'stats')),
+            Param('requests', int, 10, min_value=1, max_value=10000),
+            Param('sort', str, PROFILE_SORTS[0], choices=PROFILE_SORTS),
+            Param('limit', int, 50, min_value=1, max_value=1000)]),
+        Route('/admin/slowRequests', 'send_slow_requests'),
+        Route('/searchDrug', 'send_list', [Param('active_ingredient', required=True), limit_param, match_param],
+              'search_drugs', 'parse_drug'),
+        Route('/listDrugs', 'send_list', [limit_param], 'list_drugs', 'parse_drug'),
+        Route('/searchCompany', 'send_list', [Param('company', required=True), limit_param, match_param],
+              'search_companies', 'parse_company'),
+        Route('/listCompanies', 'send_list', [limit_param], 'list_drugs', 'parse_company'),
+        Route('/listWarnings', 'send_list', [limit_param], 'list_drugs', 'parse_warning'),
+        Route('/countCompanies', 'send_list', [count_limit_param, count_sort_param], 'count_companies',
+              'parse_company_count'),
+        Route('/api/searchDrug', 'send_json_list', [Param('active_ingredient', required=True), limit_param,
+                                                    match_param, drug_fields_param], 'search_drugs'),
+        Route('/api/listDrugs', 'send_json_list', [limit_param, drug_fields_param], 'list_drugs'),
+        Route('/api/searchCompany', 'send_json_list', [Param('company', required=True), limit_param,
+                                                       match_param, company_fields_param], 'search_companies'),
+        Route('/api/listCompanies', 'send_json_list', [limit_param, company_fields_param], 'list_drugs'),
+        Route('/api/listWarnings', 'send_json_list', [limit_param, warning_fields_param], 'list_drugs'),
+        Route('/api/countCompanies', 'send_json_list', [count_limit_param, count_sort_param, count_fields_param],
+              'count_companies'),
+        Route('/secret', 'send_secret'),
+        Route('/redirect', 'send_redirect')
+    ], Route('not_found', 'send_not_found'))
+
+    pages = QueryCache(PAGES_CACHE_SIZE, PAGES_CACHE_TTL, 0)  # (items, variants) of the rendered lists
+    server = None  # Server of the engine serving the requests, for its stats
+    # Metrics of the requests by route
+    request_duration = Histogram('openfda_http_request_duration_seconds',
+                                 "Time serving the requests, until their response is sent", ['route'])
+    response_size = Histogram('openfda_http_response_size_bytes', "Size of the bodies of the responses", ['route'],
+                              SIZE_BUCKETS)
+    responses = Counter('openfda_http_responses_total', "Responses by route and status code", ['route', 'code'])
+    in_flight = Gauge('openfda_http_requests_in_flight', "Requests being served")
+    profiler = RequestProfiler()  # Profiles of the requests sampled from the admin/profile route
+    slow_request_time = SLOW_REQUEST_TIME
+    admin = False  # Serve the admin routes
+    slow_requests = collections.deque(maxlen=SLOW_LOG_SIZE)  # The last slow requests, with their spans
+
+    def __init__(self, path, request_headers=None):
+        """
+        :param path: path of the HTTP request
+        :param request_headers: headers of the HTTP request
+        """
+
+        self.path = path
+        self.request_headers = request_headers or {}
+        self.start = time.monotonic()
+        self.route = None  # Route of the path
+        self.finished = False
+        self.http_response_code = 200
+        self.http_response = "<h1>Not supported</h1>"
+        self.content = None  # utf-8 data of the pages already encoded
+        self.variants = None  # or the content of the page for each encoding
+        self.encoding = choose_encoding(self.request_headers.get('accept-encoding'))
+        self.headers = []
+        self.content_type = 'text/html'
+        # OpenFDAClient method (and its params) to get the items, and OpenFDAParser method to parse each one
+        self.client_call = None
+        self.parser_method = None
+        self.fields = None  # or the fields of the items of a JSON list
+        self.size = 0  # Bytes of the body sent
+        self.profile = self.profiler.begin()
+        # The OpenFDAClient calls made for the request measure their spans in it too
+        self.timing = RequestTiming()
+        current_timing.set(self.timing)
+
+        self.in_flight.labels().inc()
+        self.timing.start('parse')
+        self.resolve()
+        self.timing.stop()
+
+    def resolve(self):
+        """
+        Find out the response code, the headers and the page for the request path
+        """
+
+        route, query = self.routes.match(self.path)
+        if route.path.startswith('/admin/') and not self.admin:
+            # Anyone reaching the port could profile the server or read the slow requests
+            route = self.routes.not_found
+        self.route = route
+
+        try:
+            params = route.parse_params(query)
+        except BadRequest as error:
+            self.set_error(400, "Bad request", str(error))
+        else:
+            getattr(self, route.action)(route, params)
+
+        # The normal headers
+        self.headers.append(('Content-type', self.content_type))
+
+    def set_error(self, code, title, message):
+        """
+        Answer with an error page, or with a JSON error for the JSON lists
+
+        :param code: HTTP response code
+        :param title: title of the error page
+        :param message: description of the error
+        """
+
+        self.http_response_code = code
+        if self.route.action == 'send_json_list':
+            self.http_response = json.dumps({'error': message})
+            self.content_type = 'application/json'
+        else:
+            self.http_response = "<h1>%s</h1><p>%s</p>" % (title, html.escape(message))
+
+    def set_unavailable(self, error):
+        """
+        Answer that the items can't be got from OpenFDA for now
+
+        :param error: UpstreamUnavailable with the seconds the client should wait
+        """
+
+        # The error can tell about the network of the server: it is only logged
+        print("OpenFDA is not available:", repr(error))
+        self.set_error(503, "Service unavailable", "OpenFDA is not available now. Please try again later.")
+        self.headers.append(('Retry-After', str(math.ceil(error.retry_after))))
+
+    def send_main_page(self, route, params):
+        # Return the HTML form for searching
+        self.set_static_page(OpenFDAHTML.main_page.get())
+
+    def send_stats(self, route, params):
+        self.http_response = json.dumps(self.get_stats(), indent=2)
+        self.content_type = 'application/json'
+
+    def send_metrics(self, route, params):
+        self.http_response = self.get_metrics()
+        self.content_type = METRICS_CONTENT_TYPE
+
+    def send_profile(self, route, params):
+        action, requests, sort, limit = params
+        if action == 'start':
+            self.profiler.start(requests)
+        elif action == 'stop':
+            self.profiler.stop()
+        elif action == 'reset':
+            self.profiler.reset()
+        self.http_response = self.profiler.dump(sort, limit)
+        self.content_type = 'text/plain'
+
+    def send_slow_requests(self, route, params):
+        self.http_response = json.dumps(list(self.slow_requests), indent=2)
+        self.content_type = 'application/json'
+
+    def send_list(self, route, params):
+        # The items are got by the engine from OpenFDA
+        self.client_call = (route.client_method, tuple(params))
+        self.parser_method = route.parser_method
+
+    def send_json_list(self, route, params):
+        # The last param are the fields to be included, the rest are for the client
+        self.client_call = (route.client_method, tuple(params[:-1]))
+        self.fields = params[-1]
+        self.content_type = 'application/json'
+
+    def send_secret(self, route, params):
+        self.http_response_code = 401
+        self.headers.append(('WWW-Authenticate', 'Basic realm="OpenFDA Private Zone"'))
+
+    def send_redirect(self, route, params):
+        self.http_response_code = 302
+        self.headers.append(('Location', 'http://localhost:8000/'))
+
+    def send_not_found(self, route, params):
+        self.http_response_code = 404
+        if not OPENFDA_BASIC:
+            self.set_static_page(OpenFDAHTML.not_found_page.get())
+
+    def finish(self, error=False):
+        """
+        Count the request in the stats of its route once its response has been sent
+
+        :param error: the response could not be sent
+        """
+
+        if not self.finished:
+            self.finished = True
+            elapsed = time.monotonic() - self.start
+            self.timing.close()
+            if self.profile is not None:
+                self.profiler.end(self.profile)
+            if elapsed >= self.slow_request_time:
+                self.log_slow_request(elapsed)
+            self.route.record(elapsed, error or self.http_response_code >= 500)
+            self.in_flight.labels().dec()
+            self.request_duration.labels(self.route.path).observe(elapsed)
+            self.response_size.labels(self.route.path).observe(self.size)
+            self.responses.labels(self.route.path, str(self.http_response_code)).inc()
+
+    def log_slow_request(self, elapsed):
+        """
+        Keep a request in the slow requests log
+
+        :param elapsed: seconds spent serving it
+        """
+
+        entry = {
+            'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'path': self.path,
+            'code': self.http_response_code,
+            'time': round(elapsed * 1000, 3),
+            'spans': self.timing.to_json()
+        }
+        self.slow_requests.append(entry)
+        print("Slow request", json.dumps(entry))
+
+    def iter_finished(self, chunks):
+        """
+        :param chunks: iterator with the content
+        :return: generator with the content that finishes the request once it is sent
+        """
+
+        error = True
+        # Rendering until a chunk is ready, and writing it while the engine has it
+        self.timing.start('render')
+        try:
+            for chunk in chunks:
+                self.size += len(chunk)
+                self.timing.start('write')
+                yield chunk
+                self.timing.stop()
+            error = False
+        finally:
+            self.finish(error)
+
+    async def aiter_finished(self, chunks):
+        """
+        iter_finished for the content generated by an async iterator
+
+        :param chunks: async iterator with the content
+        :return: async generator with the content that finishes the request once it is sent
+        """
+
+        error = True
+        self.timing.start('render')
+        try:
+            async for chunk in chunks:
+                self.size += len(chunk)
+                self.timing.start('write')
+                yield chunk
+                self.timing.stop()
+            error = False
+        finally:
+            self.finish(error)
+
+    def get_trailers(self):
+        """
+        :return: list with the (name, value) trailers sent after a chunked content: the time of
+                 the spans not sent in the Server-Timing header
+        """
+
+        return [('Server-Timing', self.timing.get_header())]
+
+    def set_static_page(self, page):
+        """
+        Answer with a static page, or with a 304 if the client already has its current version
+
+        :param page: CompressedPageVersion of the page to be sent
+        """
+
+        etag = page.get_etag(self.encoding)
+        self.headers.append(('ETag', etag))
+        # Browsers must check the ETag before using their copy
+        self.headers.append(('Cache-Control', 'no-cache'))
+
+        if self.http_response_code == 200 and page.is_not_modified(self.request_headers.get('if-none-match'), etag):
+            self.http_response_code = 304
+            self.content = b''
+        else:
+            self.variants = page.variants
+
+    def get_page_key(self):
+        """
+        :return: the key of the page in the rendered pages cache: the path with its params sorted
+        """
+
+        path, _, query = self.path.partition("?")
+
+        return path + "?" + self.pages.get_key(query)
+
+    def get_stats(self):
+        """
+        :return: dict with the counters of the server
+        """
+
+        stats = {
+            'process': os.getpid(),
+            'cache': OpenFDAClient.cache.stats(),
+            'pages_cache': self.pages.stats(),
+            'coalesced_queries': OpenFDAClient.flights.coalesced + AsyncOpenFDAClient.async_flights.coalesced,
+            'background_refreshes': OpenFDAClient.flights.background + AsyncOpenFDAClient.async_flights.background,
+            'rate_limiter': OpenFDAClient.limiter.stats(),
+            'upstream': (AsyncOpenFDAClient.pool or OpenFDAClient.pool).stats(),
+            'routes': self.routes.stats()
+        }
+        if self.server is not None:
+            stats['admission'] = self.server.stats()
+        if OpenFDAClient.cache.disk is not None:
+            stats['disk_cache'] = OpenFDAClient.cache.disk.stats()
+        if OpenFDAClient.mirror is not None:
+            stats['mirror'] = OpenFDAClient.mirror.stats()
+
+        return stats
+
+    def get_metrics(self):
+        """
+        :return: the metrics of the server in the Prometheus text format
+        """
+
+        lines = []
+        for metric in (self.in_flight, self.responses, self.request_duration, self.response_size,
+                       OpenFDAClient.upstream_in_flight, OpenFDAClient.upstream_responses,
+                       OpenFDAClient.upstream_duration):
+            lines += metric.collect()
+
+        cache = OpenFDAClient.cache.stats()
+        lookups = cache['hits'] + cache['stale_hits'] + cache['misses']
+        lines += format_samples('openfda_cache_lookups_total', 'counter', "Lookups of OpenFDA results in the cache",
+                                [({'result': 'hit'}, cache['hits']), ({'result': 'stale_hit'}, cache['stale_hits']),
+                                 ({'result': 'miss'}, cache['misses'])])
+        lines += format_samples('openfda_cache_hit_ratio', 'gauge', "Lookups in the cache that found a result",
+                                [({}, (cache['hits'] + cache['stale_hits']) / lookups if lookups else 0.0)])
+        lines += format_samples('openfda_cache_size_bytes', 'gauge', "Memory used by the cached results",
+                                [({}, cache['size'])])
+
+        upstream = (AsyncOpenFDAClient.pool or OpenFDAClient.pool).stats()
+        breaker = upstream['circuit_breaker']
+        lines += format_samples('openfda_upstream_circuit_state', 'gauge', "State of the circuit breaker of OpenFDA",
+                                [({'state': state}, int(breaker['state'] == state))
+                                 for state in ('closed', 'half_open', 'open')])
+        lines += format_samples('openfda_upstream_short_circuited_total', 'counter',
+                                "Requests to OpenFDA not sent because the circuit was open",
+                                [({}, breaker['short_circuited'])])
+        lines += format_samples('openfda_upstream_retries_total', 'counter', "Requests to OpenFDA retried",
+                                [({}, upstream['retried'])])
+        limiter = OpenFDAClient.limiter.stats()
+        lines += format_samples('openfda_rate_limiter_rejected_total', 'counter',
+                                "Requests to OpenFDA rejected for going over the quota",
+                                [({}, limiter['rejected'])])
+
+        if self.server is not None:
+            admission = self.server.stats()
+            lines += format_samples('openfda_admission_queued', 'gauge', "Requests waiting to be served",
+                                    [({}, admission.get('queued', 0))])
+            lines += format_samples('openfda_admission_rejected_total', 'counter',
+                                    "Requests rejected because the queue was full",
+                                    [({}, admission.get('rejected', 0))])
+            lines += format_samples('openfda_admission_disconnected_total', 'counter',
+                                    "Requests dropped because their client was gone",
+                                    [({}, admission['disconnected'])])
+
+        return "\n".join(lines) + "\n"
+
+    def iter_content(self, items, start=True, end=True):
+        """
+        Build the HTML page, or the JSON list, with the items returned by the OpenFDAClient
+        call while they are parsed
+
+        :param items: result of the client_call
+        :param start: the items are the first ones of the list (False for the next windows of a paged query)
+        :param end: the items are the last ones of the list
+        :return: generator with the page in utf-8 chunks
+        """
+
+        parser = OpenFDAParser()
+
+        if self.fields is not None:
+            # Only the fields asked for are extracted and serialized
+            extracted_items = self.timing.map('extract', lambda item: parser.get_fields(item, self.fields), items)
+            chunks = OpenFDAJSON().iter_json_list(extracted_items, start, end)
+        else:
+            parsed_items = self.timing.map('extract', getattr(parser, self.parser_method), items)
+            chunks = OpenFDAHTML().iter_html_list(parsed_items, start, end)
+
+        for chunk in chunks:
+            yield bytes(chunk, "utf8")
+
+    def get_body(self, items=None):
+        """
+        Get the body of the response, compressed if the client accepts it and it is not too small.
+        It adds the headers about the encoding, so call it before sending the headers.
+
+        :param items: result of the client_call, if it has been done
+        :return: the body as bytes or, for the lists streamed while rendered, an iterator with its chunks
+        """
+
+        self.timing.start('render')
+        body = self.build_body(items)
+        self.timing.stop()
+
+        if isinstance(body, bytes):
+            # The streamed ones are measured while they are sent
+            self.size = len(body)
+            self.headers.append(('Server-Timing', self.timing.get_header()))
+        else:
+            # Most clients ignore the trailers: the spans measured before streaming go in a header,
+            # and the ones measured while streaming in the trailer
+            self.headers.append(('Server-Timing', self.timing.get_header(STREAMED_SPANS)))
+            self.headers.append(('Trailer', 'Server-Timing'))
+
+        return body
+
+    async def get_windows_body(self, windows):
+        """
+        get_body for the windows of a paged query got by the asyncio engine: each window is rendered
+        once it arrives, so only FANOUT windows are kept in memory at the same time
+
+        :param windows: async iterator with the results of each window, in order
+        :return: the body as bytes or, for the lists streamed, an async iterator with its chunks
+        """
+
+        try:
+            items = await windows.__anext__()
+        except StopAsyncIteration:
+            items = []
+        if len(items) < OpenFDAClient.MAX_LIMIT:
+            # The only window: sent like the lists that are not paged
+            await windows.aclose()
+            return self.get_body(items)
+
+        self.headers.append(('Vary', 'Accept-Encoding'))
+        if self.encoding:
+            self.headers.append(('Content-Encoding', self.encoding))
+        self.headers.append(('Server-Timing', self.timing.get_header(STREAMED_SPANS)))
+        self.headers.append(('Trailer', 'Server-Timing'))
+
+        chunks = self.aiter_windows_content(items, windows)
+        if self.encoding:
+            chunks = aiter_compressed(chunks, self.encoding)
+
+        return chunks
+
+    async def aiter_windows_content(self, items, windows):
+        """
+        :param items: results of the first window
+        :param windows: async iterator with the results of the next windows
+        :return: async generator with the page in utf-8 chunks
+        """
+
+        try:
+            for chunk in self.iter_content(items, end=False):
+                yield chunk
+            async for items in windows:
+                for chunk in self.iter_content(items, start=False, end=False):
+                    yield chunk
+            for chunk in self.iter_content((), start=False):
+                yield chunk
+        finally:
+            # The windows still in flight are cancelled if the client is gone
+            await windows.aclose()
+
+    def build_body(self, items=None):
+        """
+        :param items: result of the client_call, if it has been done
+        :return: the body as bytes or an iterator with its chunks (see get_body)
+        """
+
+        if items is None:
+            if self.variants is None:
+                self.variants = {None: self.get_content()}
+            return self.select_variant(self.variants)
+
+        if isinstance(items, list):
+            # The same items from the OpenFDAClient cache are rendered (and compressed) only once
+            rendered = self.pages.get(self.get_page_key())
+            if rendered is not None and rendered[0] is items:
+                return self.select_variant(rendered[1])
+
+        chunks = self.iter_content(items)
+
+        # Small lists are not streamed: they are sent with their length
+        head = []
+        head_size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            head_size += len(chunk)
+            if head_size >= MIN_SIZE:
+                break
+        else:
+            return self.select_variant({None: b"".join(head)})
+
+        self.headers.append(('Vary', 'Accept-Encoding'))
+        if self.encoding:
+            self.headers.append(('Content-Encoding', self.encoding))
+
+        return self.iter_cached_chunks(items, itertools.chain(head, chunks))
+
+    def select_variant(self, variants):
+        """
+        Choose the content to be sent, compressing it if the client accepts it and it is big enough
+
+        :param variants: dict with the content for each encoding (None for not compressed)
+        :return: the content to be sent
+        """
+
+        content = variants[None]
+
+        if self.encoding and self.encoding not in variants and len(content) >= MIN_SIZE:
+            # Kept so the next clients with the same encoding get it already compressed
+            variants[self.encoding] = compress(content, self.encoding)
+
+        self.headers.append(('Vary', 'Accept-Encoding'))
+        if self.encoding is not None and self.encoding in variants:
+            self.headers.append(('Content-Encoding', self.encoding))
+            return variants[self.encoding]
+
+        return content
+
+    def iter_cached_chunks(self, items, chunks):
+        """
+        Send the chunks, compressed if needed, keeping the page to store it in the rendered pages cache
+
+        :param items: result of the client_call rendered in the chunks
+        :param chunks: iterator with the page in utf-8 chunks
+        :return: generator with the chunks to be sent
+        """
+
+        page = []
+        sent_page = []
+
+        sent_chunks = self.iter_kept_chunks(chunks, page)
+        if self.encoding:
+            sent_chunks = iter_compressed(sent_chunks, self.encoding)
+
+        for chunk in sent_chunks:
+            if self.encoding and page:
+                sent_page.append(chunk)
+            yield chunk
+
+        if page and isinstance(items, list):
+            variants = {None: b"".join(page)}
+            size = len(variants[None])
+            if self.encoding:
+                variants[self.encoding] = b"".join(sent_page)
+                size += len(variants[self.encoding])
+            self.pages.put(self.get_page_key(), (items, variants), size)
+
+    @staticmethod
+    def iter_kept_chunks(chunks, page):
+        # Keep the chunks in page while the page is small enough to be cached
+        page_size = 0
+        for chunk in chunks:
+            page_size += len(chunk)
+            if page_size <= MAX_PAGE_SIZE:
+                page.append(chunk)
+            elif page:
+                page.clear()
+            yield chunk
+
+    def get_content(self):
+        """
+        :return: the page as utf-8 data
+        """
+
+        if self.content is not None:
+            return self.content
+
+        return bytes(self.http_response, "utf8")
 
 
 # HTTPRequestHandler class
 class testHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
 
+    # Keep-alive connections and chunked responses
+    protocol_version = "HTTP/1.1"
+    # The headers and the content are written separately: don't wait for the ACK of the headers
+    disable_nagle_algorithm = True
+    timeout = IDLE_TIMEOUT  # Seconds to wait for the data of a request
+    idle_timeout = IDLE_TIMEOUT  # Seconds a kept-alive connection waits for its next request
+    max_requests = MAX_REQUESTS  # Requests served using a connection before closing it
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+
+    def handle(self):
+        """
+        Serve the requests of the connection, also the pipelined ones, until it is closed
+        """
+
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_next_request():
+            self.handle_one_request()
+
+    def wait_next_request(self):
+        """
+        Wait for the next request of a kept-alive connection without holding its worker thread
+        when other connections are waiting for one
+
+        :return: False if the connection must be closed
+        """
+
+        if self.is_pipelined():
+            return True
+
+        deadline = time.monotonic() + self.idle_timeout
+        while time.monotonic() < deadline and not self.server.draining:
+            readable, _, _ = select.select([self.connection], [], [], IDLE_POLL_INTERVAL)
+            if readable:
+                return True
+            if self.are_clients_waiting():
+                # They are more important than an idle connection
+                return False
+
+        return False
+
+    def are_clients_waiting(self):
+        """
+        :return: True if other connections are waiting to be served
+        """
+
+        requests = getattr(self.server, 'requests', None)
+        if requests is not None:
+            # Accepted connections waiting for a worker
+            return not requests.empty()
+
+        # Serving one connection at a time: the rest are waiting to be accepted
+        readable, _, _ = select.select([self.server.socket], [], [], 0)
+        return bool(readable)
+
+    def is_pipelined(self):
+        """
+        :return: True if the next request has already been read with the previous one
+        """
+
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def is_client_gone(self):
+        """
+        :return: True if the client has reset the connection after sending the request. Its end of
+                 file is not enough: a client that has only shut down its side waits for the response.
+        """
+
+        self.connection.settimeout(0)
+        try:
+            self.connection.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            pass
+        except OSError:
+            return True
+        finally:
+            self.connection.settimeout(self.timeout)
+
+        return False
+
     # GET
     def do_GET(self):
+
+        if not self.requests_served and self.server.has_waited() and self.is_client_gone():
+            # It gave up while its connection was waiting: nobody would get the response
+            self.server.count_disconnected()
+            self.close_connection = True
+            return
+
+        request = OpenFDARequest(self.path, self.headers)
+
+        try:
+            self.send_openfda_response(request)
+        except BaseException:
+            request.finish(error=True)
+            raise
+        request.finish()
+
+    def send_openfda_response(self, request):
         """
-        API to be supported
+        Get the items of the request, if it needs them, and send its response
 
-        searchDrug?drug=<drug_name>
-        searchCompany?company=<company_name>
-        listDrugs
-        listCompanies
-        listWarnings
+        :param request: OpenFDARequest to be answered
         """
 
-        client = OpenFDAClient()
-        html_vis = OpenFDAHTML()
-        parser = OpenFDAParser()
+        try:
+            items = None
+            if request.client_call:
+                client_method, client_params = request.client_call
+                items = getattr(OpenFDAClient(), client_method)(*client_params)
+            content = request.get_body(items)
+        except UpstreamUnavailable as error:
+            request.set_unavailable(error)
+            content = request.get_body()
 
-        http_response_code = 200
-        http_response = "<h1>Not supported</h1>"
-
-        if self.path == "/":
-            # Return the HTML form for searching
-            with open("openfda.html") as file_form:
-                form = file_form.read()
-                http_response = form
-        elif 'searchDrug' in self.path:
-            active_ingredient = None
-            limit = 10
-            params = self.path.split("?")[1].split("&")
-            for param in params:
-                param_name = param.split("=")[0]
-                param_value = param.split("=")[1]
-                if param_name == 'active_ingredient':
-                    active_ingredient = param_value
-                elif param_name == 'limit':
-                    limit = param_value
-            items = client.search_drugs(active_ingredient, limit)
-            http_response = html_vis.build_html_list(parser.parse_drugs(items))
-        elif 'listDrugs' in self.path:
-            limit = None
-            if len(self.path.split("?")) > 1:
-                limit = self.path.split("?")[1].split("=")[1]
-            items = client.list_drugs(limit)
-            http_response = html_vis.build_html_list(parser.parse_drugs(items))
-        elif 'searchCompany' in self.path:
-            company_name = None
-            limit = 10
-            params = self.path.split("?")[1].split("&")
-            for param in params:
-                param_name = param.split("=")[0]
-                param_value = param.split("=")[1]
-                if param_name == 'company':
-                    company_name = param_value
-                elif param_name == 'limit':
-                    limit = param_value
-            items = client.search_companies(company_name, limit)
-            http_response = html_vis.build_html_list(parser.parse_companies(items))
-        elif 'listCompanies' in self.path:
-            limit = None
-            if len(self.path.split("?")) > 1:
-                limit = self.path.split("?")[1].split("=")[1]
-            items = client.list_drugs(limit)
-            http_response = html_vis.build_html_list(parser.parse_companies(items))
-        elif 'listWarnings' in self.path:
-            limit = None
-            if len(self.path.split("?")) > 1:
-                limit = self.path.split("?")[1].split("=")[1]
-            items = client.list_drugs(limit)
-            http_response = html_vis.build_html_list(parser.parse_warnings(items))
-        elif 'secret' in self.path:
-            http_response_code = 401
-        elif 'redirect' in self.path:
-            http_response_code = 302
+        # Send response status code
+        self.send_response(request.http_response_code)
+
+        # Send the headers
+        for header in request.headers:
+            self.send_header(*header)
+        self.requests_served += 1
+        if self.requests_served >= self.max_requests or self.server.draining:
+            # It also makes handle() close the connection
+            self.send_header('Connection', 'close')
+        elif self.request_version == 'HTTP/1.0' and not self.close_connection and isinstance(content, bytes):
+            # HTTP/1.0 clients asking for keep-alive need to know they got it
+            self.send_header('Connection', 'keep-alive')
+
+        if isinstance(content, bytes):
+            if request.http_response_code != 304:
+                self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            # Write content as utf-8 data
+            self.wfile.write(content)
         else:
-            http_response_code = 404
-            if not OPENFDA_BASIC:
-                url_found = False
-                http_response = html_vis.get_not_found_page()
+            # Finished once the last chunk is sent
+            self.send_chunked(request.iter_finished(content), request.get_trailers)
 
-        # Send response status code
-        self.send_response(http_response_code)
+    def send_chunked(self, chunks, get_trailers=None):
+        """
+        Send the headers and the content as it is generated, without knowing its length
 
-        # Send extra headers headers
-        if 'secret' in self.path:
-            self.send_header('WWW-Authenticate', 'Basic realm="OpenFDA Private Zone"')
-        elif 'redirect' in self.path:
-            self.send_header('Location', 'http://localhost:8000/')
+        :param chunks: iterator with the content
+        :param get_trailers: function returning the list of (name, value) trailers, called once the content is sent
+        """
 
-        # Send the normal headers
-        self.send_header('Content-type', 'text/html')
+        chunked = self.request_version != 'HTTP/1.0'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            # For HTTP/1.0 clients, the end of the content is the end of the connection
+            self.close_connection = True
         self.end_headers()
 
-        # Write content as utf-8 data
-        self.wfile.write(bytes(http_response, "utf8"))
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if chunked:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            else:
+                self.wfile.write(chunk)
+
+        if chunked:
+            self.wfile.write(b"0\r\n" + format_trailers(get_trailers) + b"\r\n")
+
+
+class OpenFDAServer(socketserver.TCPServer):
+    """
+    TCP server that serves one connection at a time. It can be drained: stop accepting
+    connections and close the kept-alive ones once their current request is served.
+    """
+
+    draining = False
+    disconnected = 0
+
+    def __init__(self, server_address, handler_class, backlog=BACKLOG, sock=None):
+        """
+        :param server_address: (host, port) to listen on
+        :param handler_class: class used to handle the HTTP requests
+        :param backlog: size of the accept backlog of the listening socket
+        :param sock: listening socket to accept the connections from, instead of server_address
+        """
+
+        self.request_queue_size = backlog
+
+        super().__init__(server_address, handler_class, bind_and_activate=sock is None)
+
+        if sock is not None:
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+
+    def drain(self, signum=None, frame=None):
+        """
+        Make serve_forever return, to be called from a signal handler
+        """
+
+        self.draining = True
+        # shutdown() waits for serve_forever, that runs in the thread of the signal handler
+        threading.Thread(target=self.shutdown).start()
+
+    def count_disconnected(self):
+        # Only the thread serving the connections counts them
+        self.disconnected += 1
+
+    def has_waited(self):
+        """
+        :return: True if the connection served by the current thread may have waited to be served
+        """
+
+        # Any connection can wait in the accept backlog while another one is served
+        return True
+
+    def stats(self):
+        """
+        :return: dict with the limits, the requests served and waiting and the counters of the requests not served
+        """
+
+        return {
+            'concurrency': 1,
+            'disconnected': self.disconnected
+        }
+
+
+class OpenFDAThreadPoolServer(OpenFDAServer):
+    """
+    TCP server that serves the accepted connections with a fixed pool of worker threads
+    so a slow query to OpenFDA does not block the rest of the clients. When max_queue
+    connections are waiting for a worker the next ones are rejected at once with 503,
+    so a burst does not make all the clients time out.
+    """
+
+    def __init__(self, server_address, handler_class, workers=WORKERS, backlog=BACKLOG, sock=None,
+                 max_queue=MAX_QUEUE):
+        """
+        :param server_address: (host, port) to listen on
+        :param handler_class: class used to handle the HTTP requests
+        :param workers: number of worker threads
+        :param backlog: size of the accept backlog of the listening socket
+        :param sock: listening socket to accept the connections from, instead of server_address
+        :param max_queue: connections waiting for a worker before the next ones are rejected
+        """
+
+        self.requests = queue.Queue()
+        self.worker = threading.local()  # Connection served by each worker
+        self.workers = []
+        self.busy = [False] * workers  # Set by each worker while it serves a connection
+        self.max_queue = max_queue
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+        super().__init__(server_address, handler_class, backlog, sock)
+
+        for number in range(workers):
+            worker = threading.Thread(target=self.process_requests, args=(number,), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        # Called from the accept loop: just queue the connection for the workers
+        if self.requests.qsize() >= self.max_queue:
+            self.reject_request(request)
+            return
+        # Without an idle worker the connection waits in the queue
+        waited = not self.requests.empty() or all(self.busy)
+        self.requests.put((request, client_address, waited))
+
+    def reject_request(self, request):
+        """
+        Answer 503 to a connection without reading more than its request already received,
+        so the accept loop is never blocked
+        """
+
+        self.rejected += 1
+        try:
+            request.setblocking(False)
+            try:
+                # Closing the connection with its request unread would reset it, losing the response
+                request.recv(MAX_LINE)
+            except BlockingIOError:
+                pass
+            request.send(OVERLOADED_RESPONSE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def process_requests(self, number):
+        """
+        Worker loop: serve queued connections until a None is received
+
+        :param number: index of the worker in busy
+        """
+
+        while True:
+            work = self.requests.get()
+            if work is None:
+                break
+            request, client_address, self.worker.waited = work
+            self.busy[number] = True
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.busy[number] = False
+
+    def count_disconnected(self):
+        with self.lock:
+            self.disconnected += 1
+
+    def has_waited(self):
+        return self.worker.waited
+
+    def stats(self):
+        return {
+            'concurrency': len(self.workers),
+            'active': sum(self.busy),
+            'max_queue': self.max_queue,
+            'queued': self.requests.qsize(),
+            'rejected': self.rejected,
+            'disconnected': self.disconnected
+        }
+
+    def server_close(self):
+        # The connections already accepted are served
+        super().server_close()
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+async def handle_async_request(path, headers):
+    """
+    Serve a GET request in the asyncio engine
+
+    :param path: path of the HTTP request
+    :param headers: dict with the headers of the HTTP request
+    :return: tuple (code, headers, content, get_trailers) with the response. The content of the
+             big lists is an iterator with its chunks, or an async iterator for the paged ones.
+    """
+
+    request = OpenFDARequest(path, headers)
+
+    try:
+        try:
+            if request.client_call:
+                client_method, client_params = request.client_call
+                items = await getattr(AsyncOpenFDAClient(), client_method)(*client_params)
+                if hasattr(items, '__aiter__'):
+                    # The windows of a paged query
+                    content = await request.get_windows_body(items)
+                else:
+                    content = request.get_body(items)
+            else:
+                content = request.get_body()
+        except UpstreamUnavailable as error:
+            request.set_unavailable(error)
+            content = request.get_body()
+    except BaseException:
+        request.finish(error=True)
+        raise
+
+    if isinstance(content, bytes):
+        request.finish()
+    elif hasattr(content, '__aiter__'):
+        content = request.aiter_finished(content)
+    else:
+        # Finished once the last chunk is sent
+        content = request.iter_finished(content)
+
+    return request.http_response_code, request.headers, content, request.get_trailers
+
+
+async def serve_async(port, backlog, idle_timeout=IDLE_TIMEOUT, max_requests=MAX_REQUESTS, sock=None,
+                      connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES,
+                      max_concurrency=MAX_CONCURRENCY, max_queue=MAX_QUEUE):
+    """
+    Serve all the connections from one event loop, until SIGTERM drains the server
+    """
+
+    AsyncOpenFDAClient.pool = AsyncHTTPSConnectionPool(OpenFDAClient.OPENFDA_API_URL,
+                                                       connect_timeout=connect_timeout, read_timeout=read_timeout,
+                                                       retry=RetryPolicy(retries), breaker=OpenFDAClient.breaker)
+    server = AsyncHTTPServer(handle_async_request, idle_timeout, max_requests, max_concurrency, max_queue)
+    OpenFDARequest.server = server
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.drain)
+    await server.serve("", port, backlog, sock)
+
+
+def serve(args, sock=None):
+    """
+    Serve the requests with the engine chosen until SIGTERM. The requests in progress are finished.
+
+    :param args: command line params
+    :param sock: listening socket (None to listen on args.port)
+    """
+
+    # Opened here, so each worker process has its own SQLite connections
+    disk_cache = None
+    if args.cache_db:
+        # The still valid results of the previous runs are reused
+        disk_cache = DiskCache(args.cache_db, args.cache_db_size * 1024 * 1024, args.max_stale,
+                               records_to_json, records_from_json)
+    OpenFDAClient.cache = QueryCache(args.cache_size * 1024 * 1024, args.cache_ttl, args.max_stale, disk_cache)
+    if args.mirror:
+        OpenFDAClient.mirror = LabelMirror(args.mirror)
+    OpenFDAClient.api_key = args.api_key
+    # The processes share the quota
+    OpenFDAClient.limiter = RateLimiter(OPENFDA_KEY_LIMITS if args.api_key else OPENFDA_LIMITS, 1 / args.processes)
+    OpenFDAClient.pool = HTTPSConnectionPool(OpenFDAClient.OPENFDA_API_URL, connect_timeout=args.connect_timeout,
+                                             read_timeout=args.read_timeout, retry=RetryPolicy(args.retries),
+                                             breaker=OpenFDAClient.breaker)
+
+    OpenFDARequest.slow_request_time = args.slow_request_time
+    OpenFDARequest.admin = args.admin
+    Handler.idle_timeout = args.idle_timeout
+    Handler.max_requests = args.max_requests
+
+    if args.engine == 'asyncio':
+        print("serving at port", args.port, "with the asyncio engine")
+        asyncio.run(serve_async(args.port, args.backlog, args.idle_timeout, args.max_requests, sock,
+                                args.connect_timeout, args.read_timeout, args.retries, args.max_concurrency,
+                                args.max_queue))
         return
 
+    if args.workers > 0:
+        httpd = OpenFDAThreadPoolServer(("", args.port), Handler, args.workers, args.backlog, sock, args.max_queue)
+        print("serving at port", args.port, "with", args.workers, "workers")
+    else:
+        httpd = OpenFDAServer(("", args.port), Handler, args.backlog, sock)
+        print("serving at port", args.port)
+    OpenFDARequest.server = httpd
+    signal.signal(signal.SIGTERM, httpd.drain)
+    httpd.serve_forever()
+    httpd.server_close()
+
 
 Handler = testHTTPRequestHandler
 
-httpd = socketserver.TCPServer(("", PORT), Handler)
-print("serving at port", PORT)
-httpd.serve_forever()
+
+def get_params():
+    parser = argparse.ArgumentParser(usage="usage:server.py [options]",
+                                     description="OpenFDA web server")
+    parser.add_argument("-p", "--port", type=int, default=PORT, help="Port to listen on")
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS,
+                        help="Number of worker threads (0 to serve one request at a time)")
+    parser.add_argument("-b", "--backlog", type=int, default=BACKLOG,
+                        help="Number of connections waiting to be accepted")
+    parser.add_argument("-e", "--engine", choices=['threads', 'asyncio'], default='threads',
+                        help="Serve the requests with worker threads or with an asyncio event loop")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of worker processes serving the port, each one with the engine chosen")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY,
+                        help="Requests served at the same time by the asyncio engine")
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE,
+                        help="Requests waiting to be served (connections waiting for a worker with the threads "
+                             "engine) before the next ones are rejected with 503")
+    parser.add_argument("--idle-timeout", type=int, default=IDLE_TIMEOUT,
+                        help="Seconds a kept-alive connection waits for its next request")
+    parser.add_argument("--max-requests", type=int, default=MAX_REQUESTS,
+                        help="Requests served using a connection before closing it")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE // (1024 * 1024),
+                        help="MB of OpenFDA results cached in memory (0 to disable the cache)")
+    parser.add_argument("--cache-ttl", type=int, default=CACHE_TTL,
+                        help="Seconds an OpenFDA result is cached")
+    parser.add_argument("--max-stale", type=int, default=MAX_STALE,
+                        help="Seconds an expired list result is still served while it is refreshed in background")
+    parser.add_argument("--cache-db", default=CACHE_DB,
+                        help="SQLite file to keep the OpenFDA results between restarts (empty to disable it)")
+    parser.add_argument("--cache-db-size", type=int, default=DISK_CACHE_SIZE // (1024 * 1024),
+                        help="MB of OpenFDA results stored in the SQLite file")
+    parser.add_argument("--api-key", default=os.environ.get('OPENFDA_API_KEY'),
+                        help="OpenFDA API key, for a bigger quota of requests (default: $OPENFDA_API_KEY)")
+    parser.add_argument("--slow-request-time", type=float, default=SLOW_REQUEST_TIME,
+                        help="Seconds serving a request to keep it in the slow requests log (admin/slowRequests)")
+    parser.add_argument("--admin", action="store_true",
+                        help="Serve the admin routes, to profile the server and read the slow requests log. "
+                             "Use it only if the port can't be reached by the clients")
+    parser.add_argument("--connect-timeout", type=float, default=CONNECT_TIMEOUT,
+                        help="Seconds to connect to OpenFDA")
+    parser.add_argument("--read-timeout", type=float, default=READ_TIMEOUT,
+                        help="Seconds to wait for each piece of an OpenFDA response")
+    parser.add_argument("--retries", type=int, default=RETRIES,
+                        help="Times a failed OpenFDA request is retried")
+    parser.add_argument("--mirror",
+                        help="SQLite file with the drug labels loaded by mirror.py to get the lists and the searches "
+                             "from, instead of OpenFDA")
+
+    args = parser.parse_args()
+    if args.mirror and not os.path.exists(args.mirror):
+        parser.error("the mirror %s does not exist: load it with mirror.py" % args.mirror)
+
+    return args
+
+
+if __name__ == '__main__':
+
+    args = get_params()
+
+    if args.processes > 1:
+        print("serving at port", args.port, "with", args.processes, "processes")
+        PreforkServer(lambda sock: serve(args, sock), args.port, args.processes, args.backlog).serve_forever()
+    else:
+        serve(args)
 
 # https://github.com/joshmaker/simple-python-webserver/blob/master/server.py
@@ -0,0 +1,103 @@
+# Static pages kept in memory
+
+
+import hashlib
+import os
+import threading
+import time
+
+CHECK_INTERVAL = 1  # Seconds between the checks of the modification time of a page
+
+
+class PageVersion():
+    """
+    A version of a StaticPage as read from disk. It is never modified: a reload creates
+    a new one, so a request gets the ETag and the content of the same version.
+    """
+
+    __slots__ = ('text', 'content', 'etag', 'mtime')
+
+    def __init__(self, text, content, etag, mtime):
+        """
+        :param text: the page
+        :param content: the page as utf-8 data
+        :param etag: ETag of the content
+        :param mtime: modification time of the file read
+        """
+
+        self.text = text
+        self.content = content
+        self.etag = etag
+        self.mtime = mtime
+
+    def is_not_modified(self, if_none_match, etag=None):
+        """
+        :param if_none_match: value of the If-None-Match header of the request
+        :param etag: ETag sent for the page, if it is not the page one
+        :return: True if the client already has this version of the page
+        """
+
+        if not if_none_match:
+            return False
+
+        if if_none_match.strip() == '*':
+            return True
+
+        etag = etag or self.etag
+
+        # Weak comparison, as required for If-None-Match
+        etags = [if_none_match_etag.strip() for if_none_match_etag in if_none_match.split(",")]
+        return etag in etags or 'W/' + etag in etags
+
+
+class StaticPage():
+    """
+    HTML page read once from disk and kept in memory as utf-8 data with its ETag.
+    It is read again only if the modification time of the file changes.
+    """
+
+    version_class = PageVersion  # Class of the versions of the page
+
+    def __init__(self, path, check_interval=CHECK_INTERVAL):
+        """
+        :param path: path of the HTML file
+        :param check_interval: seconds between the checks of the modification time
+        """
+
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.version = None  # PageVersion read last, replaced as a whole when the file changes
+
+    def get(self):
+        """
+        :return: the PageVersion of the page, reloaded if the file has changed
+        """
+
+        version = self.version
+        now = time.monotonic()
+        if version is not None and now - self.checked < self.check_interval:
+            return version
+
+        with self.lock:
+            self.checked = now
+            mtime = os.stat(self.path).st_mtime_ns
+            if self.version is None or mtime != self.version.mtime:
+                self.version = self.load(mtime)
+
+            return self.version
+
+    def load(self, mtime):
+        """
+        :param mtime: modification time of the file
+        :return: a PageVersion with the page read from the file
+        """
+
+        # Read the same way the pages were read before: as text, sent as utf-8
+        with open(self.path) as html_file:
+            text = html_file.read()
+
+        content = bytes(text, "utf8")
+
+        return self.version_class(text, content, '"%s"' % hashlib.sha1(content).hexdigest(), mtime)
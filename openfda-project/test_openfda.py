@@ -18,17 +18,39 @@
 # Authors:
 #     Alvaro del Castillo <acs@bitergia.com>
 
+import asyncio
+import http.client
+import json
 import os
+import signal
+import socket
+import sqlite3
+import struct
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 import unittest
+import zipfile
+import zlib
 
 import requests
 
 from html.parser import HTMLParser
 
+from async_http import AsyncHTTPServer, AsyncHTTPSConnectionPool
+from cache import LAST_USED_PRECISION, DiskCache, QueryCache
+from compression import CompressedStaticPage
+from jsonstream import JSONItemsDecoder
+from metrics import Counter, Histogram
+from mirror import LabelMirror
+from records import CompanyCount, DrugRecord, records_from_json, records_to_json
+from server import FANOUT, AsyncOpenFDAClient, OpenFDARequest
+from timing import RequestTiming
+from upstream import (BACKGROUND, INTERACTIVE, CircuitBreaker, CircuitOpen, HTTPSConnectionPool, QuotaExceeded,
+                      RateLimiter, RetryPolicy, UpstreamUnavailable)
+
 PYTHON_CMD = os.path.abspath(sys.executable)
 
 class OpenFDAHTMLParser(HTMLParser):
@@ -60,24 +82,59 @@ class OpenFDAHTMLParser(HTMLParser):
         pass
 
 
+def server_command(cache_dir, *args):
+    """ Command to start the web server with its disk cache in <cache_dir>, not reusing the results of other runs """
+    return [PYTHON_CMD, 'server.py', '--cache-db', os.path.join(cache_dir, 'openfda_cache.db')] + list(args)
+
+
+def reset_connection(sock):
+    """ Close a socket sending a reset, like a client that aborts its request """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    sock.close()
+
+
+def build_synthetic_archive(path, labels_number=300):
+    """ Build an archive like the OpenFDA drug label ones with <labels_number> labels """
+    ingredients = ['Aspirin 81 mg', 'Ibuprofen 200 mg', 'Acetaminophen 500 mg']
+    companies = ['Bayer HealthCare LLC', 'Pfizer Laboratories', 'Generic Inc']
+    labels = []
+    for number in range(labels_number):
+        labels.append({
+            'id': 'synthetic-%05d' % number,
+            'active_ingredient': [ingredients[number % 3]],
+            'openfda': {'manufacturer_name': [companies[number % 3]]},
+            'warnings': ['Warning of the label %d' % number],
+            'description': ['Text not stored by the mirror ' * 20]
+        })
+    doc = {'meta': {'results': {'skip': 0, 'limit': labels_number, 'total': labels_number}}, 'results': labels}
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('drug-label-0001-of-0001.json', json.dumps(doc, indent=1))
+
+
 class WebServer(threading.Thread):
     """ Thread to start the web server """
 
+    def __init__(self, test_class):
+        super().__init__()
+        self.test_class = test_class
+
     def run(self):
         # Start the web server in a thread. It will be killed once tests have finished
-        cmd = [PYTHON_CMD, 'server.py']
-        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
-        TestOpenFDA.WEBSERVER_PROC = proc
-        outs, errs = proc.communicate()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cmd = server_command(cache_dir, '--admin', *self.test_class.SERVER_ARGS)
+            proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+            self.test_class.WEBSERVER_PROC = proc
+            outs, errs = proc.communicate()
         errs_str = errs.decode("utf8")
-        if 'Address already in use' in errs_str:
-            TestOpenFDA.PORT_BUSY = True
+        if 'address already in use' in errs_str.lower():
+            self.test_class.PORT_BUSY = True
             return
 
 class TestOpenFDA(unittest.TestCase):
     """ Automatic testing for OpenFDA web server main features """
     WEBSERVER_PROC = None
     PORT_BUSY = False
+    SERVER_ARGS = []
     TEST_PORT = 8000
     TEST_DRUG = 'Aspirin'
     TEST_COMPANY = 'Bayer'
@@ -86,7 +143,7 @@ class TestOpenFDA(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         """ Start the web server to be tested """
-        WebServer().start()
+        WebServer(cls).start()
         # Wait for web sever init code
         time.sleep(1)
         if cls.PORT_BUSY:
@@ -96,6 +153,7 @@ class TestOpenFDA(unittest.TestCase):
     def tearDownClass(cls):
         """ Shutdown the webserver """
         cls.WEBSERVER_PROC.kill()
+        cls.WEBSERVER_PROC.wait()
 
     def test_web_server_init(self):
         resp = requests.get('http://localhost:' + str(self.TEST_PORT))
@@ -174,6 +232,133 @@ class TestOpenFDA(unittest.TestCase):
         parser.feed(resp.text)
         self.assertEqual(parser.items_number, 10)
 
+    def test_api_list_companies(self):
+        # The JSON lists include only the fields asked for
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        url += '/api/listCompanies?limit=10&fields=manufacturer_name'
+        resp = requests.get(url)
+        self.assertEqual(resp.headers['Content-type'], 'application/json')
+        companies = resp.json()
+        self.assertEqual(len(companies), 10)
+        self.assertEqual(set(companies[0]), {'manufacturer_name'})
+
+    def test_count_companies(self):
+        # Distinct companies with their labels, the ones with more labels first
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        counts = requests.get(url + '/api/countCompanies?limit=3').json()
+        self.assertTrue(0 < len(counts) <= 3)
+        self.assertEqual(set(counts[0]), {'name', 'labels'})
+        labels = [count['labels'] for count in counts]
+        self.assertEqual(labels, sorted(labels, reverse=True))
+        by_name = requests.get(url + '/api/countCompanies?limit=3&sort=name&fields=name').json()
+        self.assertEqual(by_name, [{'name': name} for name in sorted(count['name'] for count in counts)])
+        resp = requests.get(url + '/countCompanies?limit=3')
+        self.assertEqual(resp.text.count("<li>"), len(counts))
+
+    def test_concurrent_requests(self):
+        # An idle client must not block the requests from the rest of the clients
+        with socket.create_connection(('localhost', self.TEST_PORT)):
+            resp = requests.get('http://localhost:' + str(self.TEST_PORT), timeout=5)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_keep_alive(self):
+        # The same connection is used for several requests
+        conn = http.client.HTTPConnection('localhost', self.TEST_PORT)
+        conn.request('GET', '/listDrugs?limit=2')
+        resp = conn.getresponse()
+        resp.read()
+        sock = conn.sock
+        self.assertIsNotNone(sock)
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        resp.read()
+        self.assertEqual(resp.status, 200)
+        self.assertIs(conn.sock, sock)
+        conn.close()
+
+    def test_stats_cache(self):
+        # The second time the same query is served from the cache
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        requests.get(url + '/listDrugs?limit=3')
+        hits = requests.get(url + '/stats').json()['cache']['hits']
+        requests.get(url + '/listDrugs?limit=3')
+        resp = requests.get(url + '/stats')
+        self.assertEqual(resp.headers['Content-type'], 'application/json')
+        self.assertEqual(resp.json()['cache']['hits'], hits + 1)
+
+    def test_stats_routes(self):
+        # Each route counts its requests
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        requests_number = requests.get(url + '/stats').json()['routes']['/listWarnings']['requests']
+        requests.get(url + '/listWarnings?limit=2')
+        routes = requests.get(url + '/stats').json()['routes']
+        self.assertEqual(routes['/listWarnings']['requests'], requests_number + 1)
+
+    def test_metrics(self):
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        requests.get(url + '/listWarnings?limit=2')
+        resp = requests.get(url + '/metrics')
+        self.assertTrue(resp.headers['Content-type'].startswith('text/plain; version=0.0.4'))
+        samples = dict(line.rsplit(' ', 1) for line in resp.text.splitlines() if not line.startswith('#'))
+        self.assertGreaterEqual(int(samples['openfda_http_responses_total{route="/listWarnings",code="200"}']), 1)
+        self.assertEqual(samples['openfda_http_request_duration_seconds_count{route="/listWarnings"}'],
+                         samples['openfda_http_request_duration_seconds_bucket{route="/listWarnings",le="+Inf"}'])
+        self.assertIn('openfda_cache_hit_ratio', samples)
+
+    def test_server_timing(self):
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        resp = requests.get(url + '/searchDrug?active_ingredient=' + self.TEST_DRUG + '&limit=2')
+        spans = dict(span.split(';dur=') for span in resp.headers['Server-Timing'].split(', '))
+        self.assertIn('parse', spans)
+        self.assertIn('render', spans)
+        self.assertEqual(requests.get(url + '/admin/slowRequests').status_code, 200)
+
+    def test_server_timing_streamed(self):
+        # The big lists are streamed: the spans measured before are sent in a header too
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        resp = requests.get(url + '/listWarnings?limit=300')
+        self.assertEqual(resp.headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(resp.headers['Trailer'], 'Server-Timing')
+        spans = dict(span.split(';dur=') for span in resp.headers['Server-Timing'].split(', '))
+        self.assertIn('parse', spans)
+        self.assertNotIn('render', spans)
+
+    def test_profile(self):
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        requests.get(url + '/admin/profile?action=reset')
+        requests.get(url + '/admin/profile?action=start&requests=2')
+        for _ in range(3):
+            requests.get(url + '/listDrugs?limit=3')
+        resp = requests.get(url + '/admin/profile?sort=tottime&limit=5')
+        self.assertTrue(resp.text.startswith("Requests profiled: 2, to be profiled: 0"))
+        self.assertIn("function calls", resp.text)
+        self.assertEqual(requests.get(url + '/admin/profile?action=pause').status_code, 400)
+
+    def test_bad_request(self):
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        resp = requests.get(url + '/listDrugs?limit=many')
+        self.assertEqual(resp.status_code, 400)
+        resp = requests.get(url + '/searchCompany?limit=10')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_main_page_not_modified(self):
+        # The main page is not sent again if the client already has it
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        etag = requests.get(url).headers['ETag']
+        resp = requests.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.text, '')
+
+    def test_list_drugs_compressed(self):
+        # Big pages are compressed for the clients that accept it
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        url += '/listDrugs?limit=100'
+        resp = requests.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        parser = OpenFDAHTMLParser()
+        parser.feed(resp.text)
+        self.assertEqual(parser.items_number, 100)
+
     def test_not_found(self):
         url = 'http://localhost:' + str(self.TEST_PORT)
         url += '/not_exists_resource'
@@ -193,5 +378,824 @@ class TestOpenFDA(unittest.TestCase):
         self.assertEqual(resp.status_code, 401)
 
 
+class TestOpenFDAAsyncio(TestOpenFDA):
+    """ The same tests for the asyncio engine of the web server """
+    SERVER_ARGS = ['--engine', 'asyncio']
+
+
+class TestOpenFDAMirror(TestOpenFDA):
+    """ The same tests with the drugs served from a mirror of a synthetic archive, without OpenFDA """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.MIRROR_DIR = tempfile.TemporaryDirectory()
+        archive = os.path.join(cls.MIRROR_DIR.name, 'drug-label.json.zip')
+        build_synthetic_archive(archive)
+        mirror_db = os.path.join(cls.MIRROR_DIR.name, 'mirror.db')
+        subprocess.check_call([PYTHON_CMD, 'mirror.py', '--db', mirror_db, archive], stdout=subprocess.DEVNULL)
+        cls.SERVER_ARGS = ['--mirror', mirror_db]
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.MIRROR_DIR.cleanup()
+
+    def test_stats_cache(self):
+        # The drugs come from the mirror instead of the cache of the OpenFDA results
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        queries = requests.get(url + '/stats').json()['mirror']['queries']
+        requests.get(url + '/listDrugs?limit=3')
+        mirror = requests.get(url + '/stats').json()['mirror']
+        self.assertEqual(mirror['labels'], 300)
+        self.assertEqual(mirror['queries'], queries + 1)
+
+    def test_search_match(self):
+        url = 'http://localhost:' + str(self.TEST_PORT)
+        resp = requests.get(url + '/api/searchCompany?company=bayer&match=prefix&limit=200&fields=id')
+        self.assertEqual(len(resp.json()), 100)
+        resp = requests.get(url + '/searchCompany?company=bayer&match=like')
+        self.assertEqual(resp.status_code, 400)
+
+
+class TestOpenFDAPrefork(unittest.TestCase):
+    """ Worker processes of the pre-fork mode started, restarted and stopped by their supervisor """
+    TEST_PORT = 8000
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        cmd = server_command(self.cache_dir.name, '--processes', '2')
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(1)
+
+    def tearDown(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        self.cache_dir.cleanup()
+
+    def get_process(self):
+        return requests.get('http://localhost:' + str(self.TEST_PORT) + '/stats').json()['process']
+
+    def test_restart_worker(self):
+        process = self.get_process()
+        os.kill(process, signal.SIGKILL)
+        time.sleep(0.5)
+        processes = {self.get_process() for _ in range(10)}
+        self.assertNotIn(process, processes)
+        resp = requests.get('http://localhost:' + str(self.TEST_PORT) + '/listDrugs?limit=3')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_stop(self):
+        # The workers finish and the supervisor exits
+        process = self.get_process()
+        self.proc.terminate()
+        self.assertEqual(self.proc.wait(10), 0)
+        self.assertRaises(ProcessLookupError, os.kill, process, 0)
+
+
+class TestOpenFDAAdmission(unittest.TestCase):
+    """ Requests rejected when the queue is full and dropped when their client is gone """
+    TEST_PORT = 8000
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        cmd = server_command(self.cache_dir.name, '--workers', '1', '--max-queue', '1')
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(1)
+
+    def tearDown(self):
+        self.proc.kill()
+        self.proc.wait()
+        self.cache_dir.cleanup()
+
+    def connect(self, data):
+        sock = socket.create_connection(('localhost', self.TEST_PORT))
+        sock.sendall(data)
+        time.sleep(0.2)
+        return sock
+
+    def test_shed_load(self):
+        url = 'http://localhost:' + str(self.TEST_PORT) + '/stats'
+        # The only worker waits for the end of the request, and the next connection for the worker
+        busy = self.connect(b'GET /stats HTTP/1.1\r\n')
+        queued = self.connect(b'GET /stats HTTP/1.1\r\n\r\n')
+        resp = requests.get(url)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        # The queued client gives up before its request is served
+        reset_connection(queued)
+        busy.sendall(b'\r\n')
+        self.assertTrue(busy.recv(1024).startswith(b'HTTP/1.1 200'))
+        busy.close()
+        time.sleep(0.2)
+        admission = requests.get(url).json()['admission']
+        self.assertEqual((admission['rejected'], admission['disconnected']), (1, 1))
+
+    def test_half_close(self):
+        # A client that has shut down its side after its request still gets the response
+        busy = self.connect(b'GET /stats HTTP/1.1\r\n')
+        queued = self.connect(b'GET /stats HTTP/1.1\r\n\r\n')
+        queued.shutdown(socket.SHUT_WR)
+        busy.sendall(b'\r\n')
+        self.assertTrue(busy.recv(1024).startswith(b'HTTP/1.1 200'))
+        busy.close()
+        self.assertTrue(queued.recv(1024).startswith(b'HTTP/1.1 200'))
+        queued.close()
+        resp = requests.get('http://localhost:' + str(self.TEST_PORT) + '/stats')
+        self.assertEqual(resp.json()['admission']['disconnected'], 0)
+
+
+class TestAsyncHTTPServer(unittest.TestCase):
+    """ Admission control of the asyncio engine """
+
+    def test_shed_load(self):
+        async def shed_load():
+            release = asyncio.Event()
+
+            async def handler(path, headers):
+                await release.wait()
+                return 200, [], b'ok'
+
+            server = AsyncHTTPServer(handler, max_concurrency=1, max_queue=1)
+            sock = socket.create_server(('127.0.0.1', 0))
+            serving = asyncio.create_task(server.serve('', 0, sock=sock))
+
+            async def get():
+                reader, writer = await asyncio.open_connection(*sock.getsockname())
+                writer.write(b'GET / HTTP/1.1\r\n\r\n')
+                await asyncio.sleep(0.1)
+                return reader, writer
+
+            served, queued, rejected = await get(), await get(), await get()
+            rejected_status = await rejected[0].readline()
+            self.assertEqual(server.stats()['queued'], 1)
+            queued[1].get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                                           struct.pack('ii', 1, 0))
+            queued[1].transport.abort()
+            await asyncio.sleep(0.1)
+            release.set()
+            served_status = await served[0].readline()
+            await asyncio.sleep(0.1)
+            server.drain()
+            served[1].close()
+            rejected[1].close()
+            await serving
+            return rejected_status, served_status, server.stats()
+
+        rejected_status, served_status, stats = asyncio.run(shed_load())
+        self.assertTrue(rejected_status.startswith(b'HTTP/1.1 503'))
+        self.assertTrue(served_status.startswith(b'HTTP/1.1 200'))
+        self.assertEqual((stats['active'], stats['rejected'], stats['disconnected']), (0, 1, 1))
+
+    def test_half_close(self):
+        # A client that has shut down its side after its request still gets the response
+        async def half_close():
+            release = asyncio.Event()
+
+            async def handler(path, headers):
+                await release.wait()
+                return 200, [], b'ok'
+
+            server = AsyncHTTPServer(handler, max_concurrency=1, max_queue=1)
+            sock = socket.create_server(('127.0.0.1', 0))
+            serving = asyncio.create_task(server.serve('', 0, sock=sock))
+            connections = []
+            for _ in range(2):
+                reader, writer = await asyncio.open_connection(*sock.getsockname())
+                writer.write(b'GET / HTTP/1.1\r\n\r\n')
+                connections.append((reader, writer))
+                await asyncio.sleep(0.1)
+            connections[1][1].write_eof()
+            await asyncio.sleep(0.1)
+            release.set()
+            statuses = [await reader.readline() for reader, _ in connections]
+            server.drain()
+            for _, writer in connections:
+                writer.close()
+            await serving
+            return statuses, server.stats()
+
+        statuses, stats = asyncio.run(half_close())
+        self.assertEqual(statuses, [b'HTTP/1.1 200 OK\r\n'] * 2)
+        self.assertEqual(stats['disconnected'], 0)
+
+
+    def test_slow_headers(self):
+        # The connection of a client that doesn't finish its headers is closed
+        async def slow_headers():
+            async def handler(path, headers):
+                return 200, [], b'ok'
+
+            server = AsyncHTTPServer(handler, idle_timeout=0.2)
+            sock = socket.create_server(('127.0.0.1', 0))
+            serving = asyncio.create_task(server.serve('', 0, sock=sock))
+            reader, writer = await asyncio.open_connection(*sock.getsockname())
+            writer.write(b'GET / HTTP/1.1\r\n')
+            start = time.monotonic()
+            data = None
+            # A header line before each read timeout, until the server closes the connection
+            while not reader.at_eof() and time.monotonic() - start < 1:
+                writer.write(b'X-Slow: 1\r\n')
+                try:
+                    data = await asyncio.wait_for(reader.read(), 0.05)
+                except asyncio.TimeoutError:
+                    continue
+            elapsed = time.monotonic() - start
+            server.drain()
+            writer.close()
+            await serving
+            return data, elapsed
+
+        data, elapsed = asyncio.run(slow_headers())
+        self.assertEqual(data, b'')
+        self.assertLess(elapsed, 1)
+
+
+class TestLabelMirror(unittest.TestCase):
+    """ Loading and searching the labels of the mirror """
+
+    def setUp(self):
+        self.mirror_dir = tempfile.TemporaryDirectory()
+        archive = os.path.join(self.mirror_dir.name, 'drug-label.json.zip')
+        build_synthetic_archive(archive, 2500)
+        self.mirror = LabelMirror(os.path.join(self.mirror_dir.name, 'mirror.db'))
+        self.assertEqual(self.mirror.ingest(archive), 2500)
+
+    def tearDown(self):
+        self.mirror_dir.cleanup()
+
+    def test_list_drugs(self):
+        drugs = self.mirror.list_drugs(2000)
+        self.assertEqual(len(drugs), 2000)
+        self.assertEqual(drugs[1].to_json(), ['synthetic-00001', 'Ibuprofen 200 mg', 'Pfizer Laboratories',
+                                              'Warning of the label 1'])
+
+    def test_search(self):
+        drugs = self.mirror.search_drugs('"aspirin"', 5)
+        self.assertEqual([drug.active_ingredient for drug in drugs], ['Aspirin 81 mg'] * 5)
+        drugs = self.mirror.search_companies('bayer', 1000)
+        self.assertEqual(len(drugs), 834)
+        self.assertEqual(self.mirror.search_companies('100%', 10), [])
+
+    def test_search_matches(self):
+        # Words in any order, ignoring the case
+        drugs = self.mirror.search_drugs('MG aspirin', 3)
+        self.assertEqual([drug.id for drug in drugs], ['synthetic-00000', 'synthetic-00003', 'synthetic-00006'])
+        self.assertEqual(self.mirror.search_drugs('aspirin 200', 3), [])
+        self.assertEqual(len(self.mirror.search_companies('pfizer laboratories', 1000, 'exact')), 833)
+        self.assertEqual(self.mirror.search_companies('pfizer', 10, 'exact'), [])
+        drugs = self.mirror.search_drugs('a', 4, 'prefix')
+        self.assertEqual([drug.active_ingredient for drug in drugs],
+                         ['Aspirin 81 mg', 'Acetaminophen 500 mg', 'Aspirin 81 mg', 'Acetaminophen 500 mg'])
+        self.assertEqual(len(self.mirror.search_companies('Generic I', 1000, 'prefix')), 833)
+
+    def test_count_companies(self):
+        counts = self.mirror.count_companies(2)
+        self.assertEqual([(count.name, count.labels) for count in counts],
+                         [('Bayer HealthCare LLC', 834), ('Generic Inc', 833)])
+        counts = self.mirror.count_companies(10, 'name')
+        self.assertEqual([count.name for count in counts], ['Bayer HealthCare LLC', 'Generic Inc', 'Pfizer Laboratories'])
+
+    def test_count_companies_updated(self):
+        # The labels loaded again replace the old ones, and are counted once
+        archive = os.path.join(self.mirror_dir.name, 'more.json.zip')
+        build_synthetic_archive(archive, 2600)
+        self.mirror.ingest(archive)
+        counts = self.mirror.count_companies(3)
+        self.assertEqual([count.labels for count in counts], [867, 867, 866])
+        self.mirror.clear()
+        self.assertEqual(self.mirror.count_companies(3), [])
+
+    def test_index_outdated(self):
+        # Labels loaded without building the index are indexed when the mirror is opened
+        archive = os.path.join(self.mirror_dir.name, 'more.json.zip')
+        build_synthetic_archive(archive, 2600)
+        self.mirror.ingest(archive, index=False)
+        self.assertFalse(self.mirror.is_indexed())
+        mirror = LabelMirror(self.mirror.path)
+        self.assertTrue(mirror.is_indexed())
+        self.assertEqual(len(mirror.search_drugs('aspirin', 1000)), 867)
+
+
+class TestStaticPage(unittest.TestCase):
+    """ Static pages reloaded when their file changes """
+
+    def test_reload(self):
+        # A version got before the reload keeps its ETag, content and variants
+        with tempfile.TemporaryDirectory() as page_dir:
+            path = os.path.join(page_dir, 'page.html')
+            with open(path, 'w') as page_file:
+                page_file.write('<p>Old</p>' * 200)
+            page = CompressedStaticPage(path, check_interval=0)
+            old = page.get()
+            with open(path, 'w') as page_file:
+                page_file.write('<p>New</p>' * 200)
+            os.utime(path, ns=(0, old.mtime + 1))
+            new = page.get()
+        self.assertIsNot(new, old)
+        self.assertNotEqual(new.etag, old.etag)
+        self.assertEqual(old.content, b'<p>Old</p>' * 200)
+        self.assertEqual(zlib.decompress(old.variants['deflate']), old.content)
+        self.assertEqual(zlib.decompress(new.variants['deflate']), new.content)
+        self.assertEqual(new.get_etag('gzip'), new.etag[:-1] + '-gzip"')
+
+
+class TestDiskCache(unittest.TestCase):
+    """ Results of the OpenFDA queries stored on disk """
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.cache_dir.name, 'cache.db')
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def get_length(self, cache):
+        return cache.get_connection().execute("SELECT total(length(value)) FROM results").fetchone()[0]
+
+    def test_usage(self):
+        # The usage kept by the triggers is the one of the results stored
+        cache = DiskCache(self.path, max_size=1000)
+        expiration = time.time() + 60
+        for number in range(5):
+            cache.put('limit=%d' % number, ['result %d' % number], 100, expiration)
+        cache.put('limit=0', ['result 0 replaced with a longer one'], 100, expiration)
+        self.assertEqual(cache.stats()['entries'], 5)
+        self.assertEqual(cache.stats()['size'], self.get_length(cache))
+        self.assertEqual(cache.get('limit=0')[0], ['result 0 replaced with a longer one'])
+
+    def test_evict(self):
+        cache = DiskCache(self.path, max_size=200, max_stale=10)
+        cache.put('limit=1', ['old'] * 10, 100, time.time() - 60)
+        for number in range(2, 40):
+            cache.put('limit=%d' % number, ['result %d' % number] * 10, 100, time.time() + 60)
+        # Expired more than max_stale ago or the least recently used
+        self.assertIsNone(cache.get('limit=1'))
+        self.assertIsNone(cache.get('limit=2'))
+        self.assertIsNotNone(cache.get('limit=39'))
+        self.assertLessEqual(cache.stats()['size'], 200)
+        self.assertEqual(cache.stats()['size'], self.get_length(cache))
+
+    def test_last_used(self):
+        # The last use time is only written when it is LAST_USED_PRECISION behind
+        cache = DiskCache(self.path)
+        cache.put('limit=1', ['result'], 100, time.time() + 60)
+        conn = cache.get_connection()
+        stored = conn.execute("SELECT last_used FROM results").fetchone()[0]
+        cache.get('limit=1')
+        self.assertEqual(conn.execute("SELECT last_used FROM results").fetchone()[0], stored)
+        conn.execute("UPDATE results SET last_used = ?", (stored - LAST_USED_PRECISION,))
+        cache.get('limit=1')
+        self.assertGreaterEqual(conn.execute("SELECT last_used FROM results").fetchone()[0], stored)
+
+    def test_corrupt(self):
+        # A result that can't be decoded is a miss and it is removed
+        cache = DiskCache(self.path, dump=records_to_json, load=records_from_json)
+        for key in ('limit=1', 'limit=2'):
+            cache.put(key, [DrugRecord('a1', 'Aspirin', 'Bayer', None)], 100, time.time() + 60)
+        conn = cache.get_connection()
+        conn.execute("UPDATE results SET value = substr(value, 1, 5) WHERE key = 'limit=1'")
+        conn.execute("UPDATE results SET value = ? WHERE key = 'limit=2'", (zlib.compress(b'[[1, 2, 3, 4, 5, 6]]'),))
+        for key in ('limit=1', 'limit=2'):
+            self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_query_cache_async(self):
+        # The results stored from the event loop are found on disk by other process
+        async def put_get():
+            await QueryCache(disk=DiskCache(self.path)).put_async('limit=2&skip=0', ['result'], 100)
+            cache = QueryCache(disk=DiskCache(self.path))
+            return await cache.get_stale_async('skip=0&limit=2'), cache.stats()['disk_hits']
+
+        self.assertEqual(asyncio.run(put_get()), ((['result'], False), 1))
+
+    def test_old_version(self):
+        # A file with the tables of an older version is emptied
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, expiration REAL, "
+                     "last_used REAL)")
+        conn.execute("INSERT INTO results VALUES ('limit=1', x'00', 100, 0, 0)")
+        conn.commit()
+        conn.close()
+        cache = DiskCache(self.path)
+        self.assertEqual(cache.stats()['entries'], 0)
+        cache.put('limit=1', ['result'], 100, time.time() + 60)
+        self.assertEqual(cache.get('limit=1')[0], ['result'])
+
+
+class WindowsClient(AsyncOpenFDAClient):
+    """ AsyncOpenFDAClient answering the windows without OpenFDA: <total> results and an error in <failing> """
+
+    def __init__(self, total, failing=None):
+        self.total = total
+        self.failing = failing
+        self.sent = []
+        self.finished = []
+
+    async def send_query(self, query, stale=False):
+        self.sent.append(query)
+        params = dict(param.split("=") for param in query.split("&"))
+        await asyncio.sleep(0.01 * len(self.sent))
+        if query == self.failing:
+            raise UpstreamUnavailable("OpenFDA is not available", 1)
+        self.finished.append(query)
+        skip = int(params['skip'])
+        return list(range(skip, min(self.total, skip + int(params['limit']))))
+
+
+class TestPagedQuery(unittest.TestCase):
+    """ Windows of the queries over the max limit sent by the asyncio engine """
+
+    @staticmethod
+    async def get_items(client, limit, in_flight=None):
+        # The results of all the windows, counting the windows requested and not got yet
+        items = []
+        async for window in await client.send_paged_query("", limit):
+            if in_flight is not None:
+                in_flight.append(len(client.sent) - len(items) // 1000 - 1)
+            items.extend(window)
+        return items
+
+    def test_short_window(self):
+        # No more windows are sent after the last results, and the ones in flight are cancelled
+        client = WindowsClient(2500)
+        items = asyncio.run(self.get_items(client, 10000))
+        self.assertEqual(items, list(range(2500)))
+        self.assertLessEqual(len(client.sent), 2 + FANOUT)
+        self.assertEqual(client.finished, ["skip=0&limit=1000", "skip=1000&limit=1000", "skip=2000&limit=1000"])
+
+    def test_fanout(self):
+        # The windows are got while the previous ones are used, FANOUT at most
+        client = WindowsClient(10000)
+        in_flight = []
+        items = asyncio.run(self.get_items(client, 10000, in_flight))
+        self.assertEqual(items, list(range(10000)))
+        self.assertLessEqual(max(in_flight), FANOUT)
+
+    def test_error(self):
+        # The rest of the windows are cancelled
+        client = WindowsClient(10000, failing="skip=1000&limit=1000")
+
+        async def get_items():
+            with self.assertRaises(UpstreamUnavailable):
+                await self.get_items(client, 10000)
+            await asyncio.sleep(0.2)
+
+        asyncio.run(get_items())
+        self.assertEqual(client.finished, ["skip=0&limit=1000"])
+
+    def test_streamed(self):
+        # Each window is rendered once it arrives, into the same list than rendered at once
+        drugs = [DrugRecord('id%d' % number, 'Aspirin', 'Bayer', None) for number in range(2500)]
+
+        async def windows():
+            for skip in range(0, len(drugs), 1000):
+                yield drugs[skip:skip + 1000]
+
+        async def get_body(path):
+            request = OpenFDARequest(path, {'accept-encoding': 'gzip'})
+            body = await request.get_windows_body(windows())
+            return b"".join([chunk async for chunk in request.aiter_finished(body)])
+
+        for path in ('/listDrugs?limit=2500', '/api/listDrugs?limit=2500'):
+            request = OpenFDARequest(path, {'accept-encoding': 'gzip'})
+            expected = b"".join(request.iter_finished(request.get_body(iter(drugs))))
+            self.assertEqual(zlib.decompress(asyncio.run(get_body(path)), 16 + zlib.MAX_WBITS),
+                             zlib.decompress(expected, 16 + zlib.MAX_WBITS))
+
+
+class TestRateLimiter(unittest.TestCase):
+    """ Quota of requests to OpenFDA shared by the requests """
+
+    def test_priority(self):
+        limiter = RateLimiter([(5, 1)])
+        for _ in range(5):
+            limiter.acquire()
+        # The bucket is empty: the waiting requests get the quota in order of priority
+        order = []
+        def acquire(priority, name):
+            limiter.acquire(priority, 3)
+            order.append(name)
+        threads = [threading.Thread(target=acquire, args=(BACKGROUND, 'background'))]
+        threads[0].start()
+        time.sleep(0.05)
+        threads += [threading.Thread(target=acquire, args=(INTERACTIVE, 'interactive%d' % number))
+                    for number in range(2)]
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive0', 'interactive1', 'background'])
+
+    def test_fail_fast(self):
+        limiter = RateLimiter([(1, 60)])
+        limiter.acquire()
+        start = time.monotonic()
+        with self.assertRaises(QuotaExceeded) as context:
+            limiter.acquire(timeout=1)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertGreater(context.exception.retry_after, 1)
+        self.assertEqual(limiter.stats()['rejected'], 1)
+
+    def test_pause(self):
+        limiter = RateLimiter([(100, 1)])
+        limiter.pause(30)
+        self.assertRaises(QuotaExceeded, limiter.acquire, INTERACTIVE, 1)
+        self.assertEqual(limiter.stats()['throttled'], 1)
+
+
+class TestUpstreamFailures(unittest.TestCase):
+    """ Timeouts, retries and circuit breaker of the requests to OpenFDA """
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(2, 0.1)
+        for _ in range(2):
+            breaker.check()
+            breaker.record(False)
+        # Open: the requests fail at once
+        self.assertRaises(CircuitOpen, breaker.check)
+        self.assertEqual(breaker.stats()['state'], 'open')
+        time.sleep(0.1)
+        # Half open: only one request is tried
+        breaker.check()
+        self.assertRaises(CircuitOpen, breaker.check)
+        breaker.record(True)
+        breaker.check()
+        self.assertEqual(breaker.stats()['state'], 'closed')
+        self.assertEqual(breaker.stats()['short_circuited'], 2)
+
+    def test_backoff(self):
+        retry = RetryPolicy(5, 0.25, 1)
+        for attempt in range(5):
+            self.assertLessEqual(retry.get_backoff(attempt), min(1, 0.25 * 2 ** attempt))
+
+    def test_retries_count(self):
+        # The retries of the requests sent from several threads are all counted
+        closed = socket.create_server(("127.0.0.1", 0))
+        address = "127.0.0.1:%d" % closed.getsockname()[1]
+        closed.close()
+        pool = HTTPSConnectionPool(address, retry=RetryPolicy(3, 0), breaker=CircuitBreaker(1000, 60))
+
+        def request():
+            for _ in range(2):
+                self.assertRaises(UpstreamUnavailable, pool.request, "/drug/label.json")
+
+        threads = [threading.Thread(target=request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = pool.stats()
+        self.assertEqual((stats['retried'], stats['failed']), (24, 8))
+
+    def test_read_timeout(self):
+        # Connections are accepted by the kernel but never answered
+        silent = socket.create_server(("127.0.0.1", 0))
+        pool = AsyncHTTPSConnectionPool("127.0.0.1", silent.getsockname()[1], use_ssl=False, read_timeout=0.2,
+                                        retry=RetryPolicy(1, 0.01), breaker=CircuitBreaker(1, 60))
+        start = time.monotonic()
+        with self.assertRaises(UpstreamUnavailable):
+            asyncio.run(pool.request("/drug/label.json"))
+        self.assertLess(time.monotonic() - start, 1)
+        # The circuit is open now, so the next request is not sent
+        self.assertRaises(CircuitOpen, asyncio.run, pool.request("/drug/label.json"))
+        stats = pool.stats()
+        self.assertEqual((stats['retried'], stats['failed'], stats['circuit_breaker']['state']), (1, 1, 'open'))
+        silent.close()
+
+
+    def test_idle_connections(self):
+        # The connections idle or open for too long are not reused
+        async def request():
+            connections = []
+
+            async def keep_alive(reader, writer):
+                connections.append(writer)
+                while await reader.readuntil(b"\r\n\r\n"):
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+
+            server = await asyncio.start_server(keep_alive, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            idle_pool = AsyncHTTPSConnectionPool("127.0.0.1", port, max_idle=0.1, use_ssl=False)
+            old_pool = AsyncHTTPSConnectionPool("127.0.0.1", port, max_lifetime=0.15, use_ssl=False)
+            try:
+                for pool in (idle_pool, old_pool):
+                    for pause in (0, 0.05, 0.05, 0.2):
+                        await asyncio.sleep(pause)
+                        self.assertEqual(await pool.request("/drug/label.json"), (200, 'OK', b'ok'))
+            finally:
+                for writer in connections:
+                    writer.close()
+                server.close()
+            return len(connections)
+
+        # Each pool reuses its connection twice and then replaces it: idle for 0.2 seconds, and open for 0.3
+        self.assertEqual(asyncio.run(request()), 4)
+
+    def test_retries_quota(self):
+        # Each attempt takes a token of the quota
+        async def failing(reader, writer):
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+
+        async def request():
+            server = await asyncio.start_server(failing, "127.0.0.1", 0)
+            pool = AsyncHTTPSConnectionPool("127.0.0.1", server.sockets[0].getsockname()[1], use_ssl=False,
+                                            retry=RetryPolicy(2, 0.01), breaker=CircuitBreaker(5, 60))
+            limiter = RateLimiter([(2, 60)])
+            try:
+                with self.assertRaises(QuotaExceeded):
+                    await pool.request("/drug/label.json", acquire=lambda: limiter.acquire_async(timeout=0.1))
+            finally:
+                server.close()
+            return limiter.stats()
+
+        stats = asyncio.run(request())
+        self.assertEqual((stats['granted'], stats['rejected']), (2, 1))
+
+    def test_short_circuit_quota(self):
+        # The requests the open circuit doesn't send don't take tokens of the quota
+        breaker = CircuitBreaker(1, 60)
+        breaker.check()
+        breaker.record(False)
+        limiter = RateLimiter([(5, 60)])
+        pool = HTTPSConnectionPool("127.0.0.1", breaker=breaker)
+        for _ in range(20):
+            self.assertRaises(CircuitOpen, pool.request, "/drug/label.json", acquire=limiter.acquire)
+        self.assertEqual(limiter.stats()['granted'], 0)
+
+        async def request():
+            apool = AsyncHTTPSConnectionPool("127.0.0.1", use_ssl=False, breaker=breaker)
+            with self.assertRaises(CircuitOpen):
+                await apool.request("/drug/label.json", acquire=limiter.acquire_async)
+
+        asyncio.run(request())
+        self.assertEqual(limiter.stats()['granted'], 0)
+
+    def test_quota_half_open(self):
+        # A probe rejected by the quota is not counted as a failure of OpenFDA
+        breaker = CircuitBreaker(1, 0)
+        breaker.check()
+        breaker.record(False)
+        limiter = RateLimiter([(1, 60)])
+        limiter.acquire()
+        pool = HTTPSConnectionPool("127.0.0.1", breaker=breaker)
+        self.assertRaises(QuotaExceeded, pool.request, "/drug/label.json",
+                          acquire=lambda: limiter.acquire(timeout=0.1))
+        self.assertEqual(breaker.stats()['state'], 'half_open')
+        breaker.check()
+
+    def test_admin_routes(self):
+        # Not served unless the server is started with --admin
+        for path in ('/admin/profile?action=start&requests=10000', '/admin/slowRequests', '/admin/profile?action=x'):
+            request = OpenFDARequest(path)
+            self.assertEqual(request.http_response_code, 404)
+            request.finish()
+        self.assertEqual(OpenFDARequest.profiler.remaining, 0)
+
+    def test_unavailable_message(self):
+        # The details of the error are not sent to the clients
+        request = OpenFDARequest('/listDrugs?limit=2')
+        request.set_unavailable(UpstreamUnavailable("OpenFDA failed: gaierror(-3, 'Temporary failure')", 30))
+        body = request.get_body()
+        self.assertEqual(request.http_response_code, 503)
+        self.assertNotIn(b'gaierror', body)
+        self.assertIn(('Retry-After', '30'), request.headers)
+        request.finish()
+
+
+class TestMetrics(unittest.TestCase):
+    """ Metrics updated by several threads in the Prometheus text format """
+
+    def test_histogram(self):
+        histogram = Histogram('latency_seconds', "Latency", ['route'], [0.25, 1])
+
+        def observe():
+            for value in (0.125, 0.25, 0.5, 2) * 1000:
+                histogram.labels('/a"b').observe(value)
+        threads = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(histogram.collect(), [
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{route="/a\\"b",le="0.25"} 8000',
+            'latency_seconds_bucket{route="/a\\"b",le="1.0"} 12000',
+            'latency_seconds_bucket{route="/a\\"b",le="+Inf"} 16000',
+            'latency_seconds_sum{route="/a\\"b"} 11500.0',
+            'latency_seconds_count{route="/a\\"b"} 16000'])
+
+    def test_counter(self):
+        counter = Counter('requests_total', "Requests")
+        counter.labels().inc()
+        counter.labels().inc(2)
+        self.assertEqual(counter.collect()[-1], 'requests_total 3')
+
+    def test_finished_threads(self):
+        # The values of the threads ended are kept without keeping their shards
+        counter = Counter('refreshes_total', "Refreshes")
+        for _ in range(100):
+            thread = threading.Thread(target=counter.labels().inc)
+            thread.start()
+            thread.join()
+        self.assertEqual(counter.labels().shards, [])
+        self.assertEqual(counter.collect()[-1], 'refreshes_total 100')
+
+
+class TestRequestTiming(unittest.TestCase):
+    """ Time spent by a request in each phase """
+
+    def test_nested_spans(self):
+        start = time.perf_counter()
+        timing = RequestTiming()
+        timing.start('upstream')
+        time.sleep(0.02)
+        timing.start('decode')
+        time.sleep(0.01)
+        timing.stop()
+        timing.start('render')
+        # Left started by an error
+        timing.close()
+        elapsed = (time.perf_counter() - start) * 1000
+        spans = timing.to_json()
+        self.assertGreaterEqual(spans['upstream'], 20)
+        self.assertGreaterEqual(spans['decode'], 10)
+        # The time of the nested spans is not counted in the outer one
+        self.assertLessEqual(sum(spans.values()), elapsed + 0.01)
+        self.assertNotIn('write', spans)
+        self.assertTrue(timing.get_header().startswith('upstream;dur='))
+
+    def test_header_parts(self):
+        # Each header has the time measured since the previous one
+        timing = RequestTiming()
+        for name in ('upstream', 'render'):
+            timing.start(name)
+            time.sleep(0.01)
+            timing.stop()
+        header = timing.get_header(exclude=('render',))
+        self.assertEqual([span.split(';')[0] for span in header.split(', ')], ['upstream'])
+        timing.start('write')
+        time.sleep(0.01)
+        timing.stop()
+        self.assertEqual([span.split(';')[0] for span in timing.get_header().split(', ')], ['render', 'write'])
+
+    def test_decoder_spans(self):
+        timing = RequestTiming()
+        decoder = JSONItemsDecoder('results', DrugRecord.from_result, timing)
+        decoder.feed(json.dumps({'results': [{'id': 'a'}, {'id': 'b'}]}).encode("utf8"))
+        self.assertEqual(len(decoder.close()), 2)
+        self.assertEqual(set(timing.to_json()), {'decode', 'extract'})
+        self.assertEqual(timing.stack, [])
+
+
+class TestJSONItemsDecoder(unittest.TestCase):
+    """ Decoding of the OpenFDA responses fed in pieces """
+
+    def test_decode_items(self):
+        doc = {'meta': {'results': {'skip': 0, 'limit': 3}}, 'results': [{'id': 'a]}'}, None, 12.5]}
+        data = json.dumps(doc, indent=2).encode("utf8")
+        for size in (1, 7, len(data)):
+            decoder = JSONItemsDecoder('results')
+            for pos in range(0, len(data) - 1, size):
+                decoder.feed(data[pos:min(pos + size, len(data) - 1)])
+            # The items are decoded before the end of the document
+            self.assertEqual(decoder.items, doc['results'])
+            decoder.feed(data[-1:])
+            self.assertEqual(decoder.close(), doc['results'])
+            self.assertEqual(decoder.size, len(data))
+
+    def test_decode_truncated(self):
+        decoder = JSONItemsDecoder('results')
+        decoder.feed(b'{"results": [{"id": "a"}, {"id"')
+        self.assertRaises(ValueError, decoder.close)
+
+
+class TestDrugRecord(unittest.TestCase):
+    """ Fields kept of the drug labels """
+
+    def test_from_result(self):
+        drug = {'id': 'a1', 'active_ingredient': ['Aspirin 81 mg'], 'openfda': {'manufacturer_name': ['Bayer']},
+                'warnings': ['Reye syndrome', 'Allergy'], 'description': ['Long text'] * 100}
+        record = DrugRecord.from_result(drug)
+        self.assertEqual(record.to_json(), ['a1', 'Aspirin 81 mg', 'Bayer', 'Reye syndrome'])
+        self.assertEqual(DrugRecord.from_json(record.to_json()).to_json(), record.to_json())
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_missing_fields(self):
+        record = DrugRecord.from_result({'id': 'a2', 'warnings': []})
+        self.assertEqual(record.to_json(), ['a2', None, None, None])
+
+    def test_records_json(self):
+        # Both kinds of records are stored in the disk cache
+        records = [DrugRecord('a1', 'Aspirin', 'Bayer', None), CompanyCount.from_result({'term': 'Bayer', 'count': 3})]
+        loaded = records_from_json(json.loads(json.dumps(records_to_json(records))))
+        self.assertEqual([type(record) for record in loaded], [DrugRecord, CompanyCount])
+        self.assertEqual((loaded[1].name, loaded[1].labels), ('Bayer', 3))
+
+
 if __name__ == "__main__":
     unittest.main(warnings='ignore')
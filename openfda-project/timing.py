@@ -0,0 +1,223 @@
+# Time spent by the requests: in each phase of the request and in each function when profiled
+
+
+import contextlib
+import contextvars
+import cProfile
+import io
+import pstats
+import threading
+import time
+
+SPANS = ('parse', 'mirror', 'upstream', 'decode', 'extract', 'render', 'write')  # Phases of a request
+STREAMED_SPANS = ('extract', 'render', 'write')  # Spans that go on while a list is streamed
+PROFILE_SORTS = ('cumulative', 'tottime', 'calls')
+
+# RequestTiming of the request served by the current thread or task, for the code that does not get the request
+current_timing = contextvars.ContextVar('current_timing', default=None)
+
+
+class RequestTiming():
+    """
+    Time spent by a request in each of its phases (spans). The spans can be nested, and the
+    time of a span excludes the spans nested in it, so a request is only in one span at a
+    time. A span can be measured several times, like the render of each chunk of a list,
+    and its times are added up.
+    """
+
+    __slots__ = ('spans', 'sent', 'stack', 'mark')
+
+    def __init__(self):
+        self.spans = dict.fromkeys(SPANS, 0.0)  # Seconds spent in each span
+        self.sent = dict.fromkeys(SPANS, 0.0)  # Seconds of each span already in a header
+        self.stack = []  # Spans started and not stopped, the current one at the end
+        self.mark = time.perf_counter()  # Last time a span was started or stopped
+
+    def start(self, name):
+        """
+        Start a span nested in the current one, if there is one
+
+        :param name: name of the span (see SPANS)
+        """
+
+        now = time.perf_counter()
+        if self.stack:
+            self.spans[self.stack[-1]] += now - self.mark
+        self.stack.append(name)
+        self.mark = now
+
+    def stop(self):
+        """
+        Stop the current span, going back to the one it is nested in
+        """
+
+        now = time.perf_counter()
+        self.spans[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def close(self):
+        """
+        Stop all the spans, also the ones left started by an error
+        """
+
+        while self.stack:
+            self.stop()
+
+    def map(self, name, function, items):
+        """
+        Like map, measuring each call to the function as a span
+
+        :param name: name of the span
+        :param function: function called with each item
+        :param items: iterable with the items
+        :return: generator with the results
+        """
+
+        start, stop = self.start, self.stop
+        for item in items:
+            start(name)
+            result = function(item)
+            stop()
+            yield result
+
+    def get_header(self, exclude=()):
+        """
+        :param exclude: names of the spans left for a later header, like the ones still being measured
+        :return: the value of a Server-Timing header with the time of the spans measured since
+                 the previous header, in milliseconds
+        """
+
+        durations = []
+        for name, seconds in self.spans.items():
+            seconds -= self.sent[name]
+            if seconds and name not in exclude:
+                durations.append("%s;dur=%.3f" % (name, seconds * 1000))
+                self.sent[name] += seconds
+
+        return ", ".join(durations)
+
+    def to_json(self):
+        """
+        :return: dict with the milliseconds spent in the spans measured
+        """
+
+        return {name: round(seconds * 1000, 3) for name, seconds in self.spans.items() if seconds}
+
+
+@contextlib.contextmanager
+def measure(name):
+    """
+    Measure the code of the with statement as a span of the current request, if there is one
+
+    :param name: name of the span
+    """
+
+    timing = current_timing.get()
+    if timing is None:
+        yield
+        return
+
+    timing.start(name)
+    try:
+        yield
+    finally:
+        timing.stop()
+
+
+class RequestProfiler():
+    """
+    Profile the next requests with cProfile, adding up their stats. The requests are
+    profiled one at a time: the ones starting while another one is profiled are not, so
+    the profiles of the threads don't get mixed. With the asyncio engine the profile of a
+    request includes the rest of the requests served by the event loop meanwhile.
+    It is safe to share it between threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = 0  # Requests to be profiled
+        self.profiling = False  # A request is being profiled
+        self.profiled = 0
+        self.stats = None  # pstats.Stats of the requests profiled
+
+    def start(self, requests):
+        """
+        Profile the next requests
+
+        :param requests: number of requests to profile
+        """
+
+        with self.lock:
+            self.remaining = requests
+
+    def stop(self):
+        """
+        Don't profile more requests
+        """
+
+        with self.lock:
+            self.remaining = 0
+
+    def reset(self):
+        """
+        Drop the stats of the requests profiled
+        """
+
+        with self.lock:
+            self.profiled = 0
+            self.stats = None
+
+    def begin(self):
+        """
+        Start profiling the current request, if it has to be profiled
+
+        :return: its cProfile.Profile or None if it is not profiled
+        """
+
+        if not self.remaining:
+            return None
+
+        with self.lock:
+            if not self.remaining or self.profiling:
+                return None
+            self.remaining -= 1
+            self.profiling = True
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+        return profile
+
+    def end(self, profile):
+        """
+        Stop profiling a request and add its stats to the rest
+
+        :param profile: cProfile.Profile returned by begin for the request
+        """
+
+        profile.disable()
+
+        with self.lock:
+            self.profiling = False
+            self.profiled += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def dump(self, sort=PROFILE_SORTS[0], limit=50):
+        """
+        :param sort: key to sort the functions by (see PROFILE_SORTS)
+        :param limit: number of functions included
+        :return: the stats of the requests profiled as text
+        """
+
+        stream = io.StringIO()
+
+        with self.lock:
+            stream.write("Requests profiled: %d, to be profiled: %d\n" % (self.profiled, self.remaining))
+            if self.stats is not None:
+                self.stats.stream = stream
+                self.stats.sort_stats(sort).print_stats(limit)
+
+        return stream.getvalue()
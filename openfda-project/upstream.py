@@ -0,0 +1,703 @@
+# Helpers to talk to the OpenFDA API shared by all the request handlers
+
+
+import asyncio
+import heapq
+import http.client
+import itertools
+import random
+import select
+import threading
+import time
+
+POOL_SIZE = 10  # Max idle connections kept open
+MAX_IDLE = 30  # Seconds an idle connection is kept before closing it
+MAX_LIFETIME = 300  # Seconds a connection is reused before replacing it
+READ_SIZE = 64 * 1024  # Bytes of a response read at once when they are fed to a decoder
+CONNECT_TIMEOUT = 5  # Seconds to connect to OpenFDA
+READ_TIMEOUT = 30  # Seconds to wait for each piece of a response
+RETRIES = 2  # Times a failed request is sent again
+BACKOFF = 0.25  # Seconds to wait before the first retry, doubled for each one, with jitter
+MAX_BACKOFF = 4  # Max seconds to wait before a retry
+FAILURE_THRESHOLD = 5  # Failed requests in a row that open the circuit
+RECOVERY_TIME = 30  # Seconds the circuit stays open before trying a request again
+# Requests allowed by OpenFDA as (requests, seconds), without and with an API key
+OPENFDA_LIMITS = ((240, 60), (1000, 24 * 3600))
+OPENFDA_KEY_LIMITS = ((240, 60), (120000, 24 * 3600))
+INTERACTIVE = 0  # Priority of the requests a client is waiting for
+BACKGROUND = 1  # Priority of the refreshes nobody is waiting for
+MAX_WAIT = 5  # Seconds a request waits for the quota before failing
+THROTTLED_PAUSE = 60  # Seconds without requests when OpenFDA answers 429 without Retry-After
+
+
+class UpstreamUnavailable(Exception):
+    """
+    OpenFDA can't answer a request for now
+    """
+
+    def __init__(self, message, retry_after):
+        """
+        :param retry_after: seconds until it could be sent
+        """
+
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(UpstreamUnavailable):
+    """
+    The requests are not sent while OpenFDA is failing
+    """
+
+
+class CircuitBreaker():
+    """
+    Stop sending requests to OpenFDA after FAILURE_THRESHOLD failed ones in a row, so the
+    requests don't wait for the timeouts and the retries while it is down. After RECOVERY_TIME
+    seconds (half open) one request is sent: if it works the circuit is closed again.
+    It is safe to share it between threads.
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, recovery_time=RECOVERY_TIME):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0  # In a row
+        self.opened_at = 0.0
+        self.probing = False  # A request is being tried in half open state
+        self.opened = 0
+        self.short_circuited = 0
+
+    def check(self):
+        """
+        Call before sending a request
+
+        :raise CircuitOpen: if the request must not be sent
+        """
+
+        with self.lock:
+            if self.state == 'open':
+                wait = self.opened_at + self.recovery_time - time.monotonic()
+                if wait <= 0:
+                    self.state = 'half_open'
+                else:
+                    self.short_circuited += 1
+                    raise CircuitOpen("OpenFDA is failing", wait)
+            if self.state == 'half_open':
+                if self.probing:
+                    self.short_circuited += 1
+                    raise CircuitOpen("OpenFDA is failing", 1)
+                self.probing = True
+
+    def cancel(self):
+        """
+        Call instead of record when a request allowed by check is not sent
+        """
+
+        with self.lock:
+            self.probing = False
+
+    def record(self, success):
+        """
+        Count the result of a request allowed by check
+
+        :param success: OpenFDA answered it
+        """
+
+        with self.lock:
+            self.probing = False
+            if success:
+                self.failures = 0
+                self.state = 'closed'
+                return
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.opened += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        """
+        :return: dict with the state and the counters of the breaker
+        """
+
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'retry_in': max(0.0, self.opened_at + self.recovery_time - time.monotonic())
+                if self.state == 'open' else 0.0,
+                'opened': self.opened,
+                'short_circuited': self.short_circuited
+            }
+
+
+class RetryPolicy():
+    """
+    Bounded retries with exponential backoff and full jitter for the GET requests, so the
+    requests failing at the same time don't retry at the same time
+    """
+
+    def __init__(self, retries=RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        """
+        :param retries: times a failed request is sent again
+        :param backoff: seconds to wait before the first retry
+        :param max_backoff: max seconds to wait before a retry
+        """
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @staticmethod
+    def is_retryable(status):
+        """
+        :return: True if a response with the status is a failure worth retrying
+        """
+
+        return status >= 500
+
+    def get_backoff(self, attempt):
+        """
+        :param attempt: number of the retry, from 0
+        :return: seconds to wait before it
+        """
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def stats(self):
+        return {
+            'retries': self.retries
+        }
+
+
+class HTTPSConnectionPool():
+    """
+    Pool of kept-alive HTTPS connections to a host, so the queries don't pay
+    for a TCP and TLS handshake each time. It is safe to share it between threads.
+    """
+
+    def __init__(self, host, size=POOL_SIZE, max_idle=MAX_IDLE, max_lifetime=MAX_LIFETIME,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retry=None, breaker=None):
+        """
+        :param host: host to connect to
+        :param size: max number of idle connections kept open
+        :param max_idle: seconds an idle connection is kept open
+        :param max_lifetime: seconds since its creation a connection is reused
+        :param connect_timeout: seconds to connect
+        :param read_timeout: seconds to wait for each piece of a response
+        :param retry: RetryPolicy of the failed requests
+        :param breaker: CircuitBreaker of the host, it can be shared with other pools
+        """
+
+        self.host = host
+        self.size = size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.lock = threading.Lock()
+        self.idle = []  # (connection, creation time, last use time), the last used at the end
+        self.retried = 0
+        self.failed = 0
+
+    def get_connection(self):
+        """
+        Get an idle connection or a new one if there are no valid idle connections
+
+        :return: tuple (connection, creation time, True if it is a reused connection)
+        """
+
+        now = time.monotonic()
+        expired = []
+        conn = None
+
+        with self.lock:
+            while self.idle:
+                idle_conn, created, last_used = self.idle.pop()
+                if now - last_used < self.max_idle and now - created < self.max_lifetime:
+                    conn = idle_conn
+                    break
+                expired.append(idle_conn)
+
+        for expired_conn in expired:
+            expired_conn.close()
+
+        if conn and self.is_broken(conn):
+            conn.close()
+            conn = None
+
+        if conn:
+            return conn, created, True
+
+        conn = http.client.HTTPSConnection(self.host, timeout=self.connect_timeout)
+        try:
+            conn.connect()
+        except Exception:
+            conn.close()
+            raise
+        # The connection is established: the rest of the timeouts are for the responses
+        conn.sock.settimeout(self.read_timeout)
+
+        return conn, now, False
+
+    def put_connection(self, conn, created):
+        """
+        Return a connection to the pool once its response has been read
+        """
+
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, created, time.monotonic()))
+                return
+
+        conn.close()
+
+    @staticmethod
+    def is_broken(conn):
+        """
+        An idle connection must not be readable: if it is, the server closed it
+        or sent unexpected data
+        """
+
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+
+        return bool(readable)
+
+    def request(self, url, headers=None, decoder=None, acquire=None):
+        """
+        Send a GET request using a pooled connection. The failed requests (errors, timeouts
+        and 5xx responses) are retried, unless part of the body has been fed to the decoder.
+
+        :param url: url (path and query) to get
+        :param headers: dict with the request headers
+        :param decoder: object with a feed(data) method and a size attribute (bytes fed). If
+                        it is passed, the body of the responses that are not failures is fed
+                        to it while it is read instead of returned.
+        :param acquire: function called before each attempt to wait for the quota of the host
+        :return: tuple (status, reason, body), body is None if it has been fed to the decoder
+        :raise UpstreamUnavailable: if the request failed, the circuit is open or there is no quota
+        """
+
+        self.breaker.check()
+        if acquire is not None:
+            try:
+                # Only the requests the breaker lets through take a token from the quota
+                acquire()
+            except BaseException:
+                self.breaker.cancel()
+                raise
+        success = False
+        try:
+            attempt = 0
+            while True:
+                try:
+                    result = self.send(url, headers, decoder)
+                    if not self.retry.is_retryable(result[0]):
+                        success = True
+                        return result
+                    error = "%d %s" % result[:2]
+                except (OSError, http.client.HTTPException) as exception:
+                    error = repr(exception)
+                if attempt >= self.retry.retries or (decoder is not None and decoder.size):
+                    break
+                time.sleep(self.retry.get_backoff(attempt))
+                attempt += 1
+                with self.lock:
+                    self.retried += 1
+                if acquire is not None:
+                    # A retry counts against the quota like any other request
+                    acquire()
+
+            with self.lock:
+                self.failed += 1
+            raise UpstreamUnavailable("OpenFDA failed: " + error, self.breaker.recovery_time)
+        finally:
+            self.breaker.record(success)
+
+    def send(self, url, headers=None, decoder=None):
+        """
+        Send a request once, and again if the kept-alive connection used was closed by the server
+
+        :return: tuple (status, reason, body)
+        """
+
+        while True:
+            conn, created, reused = self.get_connection()
+            try:
+                conn.request("GET", url, None, headers or {})
+                response = conn.getresponse()
+                body = self.read_body(response, None if self.retry.is_retryable(response.status) else decoder)
+            except (ConnectionError, http.client.BadStatusLine):
+                conn.close()
+                if reused and (decoder is None or not decoder.size):
+                    # The server closed the kept-alive connection: retry with a new one
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.put_connection(conn, created)
+
+            return response.status, response.reason, body
+
+    @staticmethod
+    def read_body(response, decoder=None):
+        """
+        :param response: HTTPResponse to read
+        :param decoder: feed the body to this decoder (see request)
+        :return: the body or None if it has been fed to the decoder
+        """
+
+        if decoder is None:
+            return response.read()
+
+        while True:
+            data = response.read(READ_SIZE)
+            if not data:
+                return None
+            decoder.feed(data)
+
+    def stats(self):
+        """
+        :return: dict with the settings and the counters of the requests to the host
+        """
+
+        stats = {
+            'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout,
+            'circuit_breaker': self.breaker.stats()
+        }
+        stats.update(self.retry.stats())
+        with self.lock:
+            stats.update(retried=self.retried, failed=self.failed)
+
+        return stats
+
+    def close(self):
+        """
+        Close all the idle connections
+        """
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for conn, _, _ in idle:
+            conn.close()
+
+
+class SingleFlight():
+    """
+    Coalesce identical calls in flight: while a call for a key is running, the
+    calls for the same key wait for it and get its result (or its exception)
+    instead of sending the same query to OpenFDA again
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> FlightCall running
+        self.coalesced = 0
+        self.background = 0
+
+    def do(self, key, function, *args):
+        """
+        Call function(*args) unless a call for the same key is already running
+
+        :param key: key identifying the call
+        :param function: function to call
+        :return: the result of the call
+        """
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = FlightCall()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        return self.run(key, call, function, *args)
+
+    def do_in_background(self, key, function, *args):
+        """
+        Call function(*args) in a new thread unless a call for the same key is already running
+
+        :param key: key identifying the call
+        :param function: function to call
+        :return: True if the call has been started
+        """
+
+        with self.lock:
+            if key in self.calls:
+                return False
+            call = self.calls[key] = FlightCall()
+            self.background += 1
+
+        thread = threading.Thread(target=self.run_in_background, args=(key, call, function) + args, daemon=True)
+        thread.start()
+
+        return True
+
+    def run(self, key, call, function, *args):
+        # Run the call for the key and wake up its waiters
+        try:
+            call.result = function(*args)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result
+
+    def run_in_background(self, key, call, function, *args):
+        try:
+            self.run(key, call, function, *args)
+        except Exception as error:
+            print("Background call failed for", key, repr(error))
+
+
+class FlightCall():
+    """
+    A call running in a SingleFlight
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class QuotaExceeded(UpstreamUnavailable):
+    """
+    A request can't be sent to OpenFDA without going over its quota
+    """
+
+
+class TokenBucket():
+    """
+    Quota of requests in a period: the bucket holds up to the requests of the period,
+    and is refilled continuously at requests / period
+    """
+
+    def __init__(self, requests, period):
+        """
+        :param requests: requests allowed in the period
+        :param period: seconds of the period
+        """
+
+        self.capacity = max(requests, 1)
+        self.rate = requests / period
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_wait(self, tokens):
+        """
+        :return: seconds until the bucket has the tokens
+        """
+
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+
+class RateLimiterWaiter():
+    """
+    Request waiting for the quota in a RateLimiter
+    """
+
+    __slots__ = ('priority', 'deadline', 'wake', 'granted')
+
+    def __init__(self, priority, deadline, wake):
+        self.priority = priority
+        self.deadline = deadline
+        self.wake = wake  # Function called when it gets the quota
+        self.granted = False
+
+
+class RateLimiter():
+    """
+    Token buckets with the quotas of OpenFDA shared by all the requests. The requests wait
+    for the quota in order of priority, so the clients go before the background refreshes,
+    but not longer than their deadline: the ones that can't get it in time fail at once.
+    It is safe to share it between threads, and it can be awaited from an event loop.
+    """
+
+    def __init__(self, limits=OPENFDA_LIMITS, share=1.0):
+        """
+        :param limits: list with the (requests, seconds) allowed
+        :param share: part of the quota for this limiter (several processes share it)
+        """
+
+        self.buckets = [TokenBucket(requests * share, period) for requests, period in limits]
+        self.lock = threading.Lock()
+        self.waiters = []  # Heap of (priority, arrival, RateLimiterWaiter)
+        self.arrivals = itertools.count()
+        self.paused_until = 0.0  # OpenFDA asked to wait until then
+        self.granted = 0
+        self.rejected = 0
+        self.throttled = 0
+
+    def acquire(self, priority=INTERACTIVE, timeout=MAX_WAIT):
+        """
+        Wait for the quota to send a request
+
+        :param priority: INTERACTIVE or BACKGROUND
+        :param timeout: max seconds to wait
+        :raise QuotaExceeded: if the quota is not available in time
+        """
+
+        event = threading.Event()
+        waiter = self.enqueue(priority, timeout, event.set)
+        try:
+            while True:
+                wait = self.poll(waiter)
+                if wait is None:
+                    return
+                event.wait(wait)
+                event.clear()
+        except BaseException:
+            self.remove(waiter)
+            raise
+
+    async def acquire_async(self, priority=INTERACTIVE, timeout=MAX_WAIT):
+        """
+        acquire without blocking the event loop
+        """
+
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = self.enqueue(priority, timeout, lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while True:
+                wait = self.poll(waiter)
+                if wait is None:
+                    return
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        except BaseException:
+            self.remove(waiter)
+            raise
+
+    def enqueue(self, priority, timeout, wake):
+        """
+        Queue a request, failing if it can't get the quota in timeout seconds
+
+        :return: its RateLimiterWaiter
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            # The requests with the same or higher priority get the quota first
+            ahead = sum(1 for queued, _, _ in self.waiters if queued <= priority)
+            wait = self.get_wait(ahead + 1, now)
+            if wait > timeout:
+                self.rejected += 1
+                raise QuotaExceeded("OpenFDA quota exceeded", wait)
+
+            waiter = RateLimiterWaiter(priority, now + timeout, wake)
+            heapq.heappush(self.waiters, (priority, next(self.arrivals), waiter))
+            self.dispatch(now)
+
+        return waiter
+
+    def poll(self, waiter):
+        """
+        :return: None if the waiter got the quota or the seconds to wait before polling again
+        :raise QuotaExceeded: if its deadline has passed
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.dispatch(now)
+            if waiter.granted:
+                return None
+            if now >= waiter.deadline:
+                self.rejected += 1
+                raise QuotaExceeded("OpenFDA quota exceeded", self.get_wait(len(self.waiters), now))
+
+            return min(waiter.deadline, now + self.get_wait(1, now)) - now
+
+    def remove(self, waiter):
+        with self.lock:
+            queued = [item for item in self.waiters if item[2] is not waiter]
+            if len(queued) != len(self.waiters):
+                heapq.heapify(queued)
+                self.waiters = queued
+
+    def refill(self, now):
+        for bucket in self.buckets:
+            bucket.refill(now)
+
+    def get_wait(self, tokens, now):
+        """
+        :return: seconds until all the buckets have the tokens
+        """
+
+        return max([self.paused_until - now] + [bucket.get_wait(tokens) for bucket in self.buckets])
+
+    def dispatch(self, now):
+        # Give the quota available to the waiters, in order
+        while self.waiters and now >= self.paused_until and all(bucket.tokens >= 1 for bucket in self.buckets):
+            _, _, waiter = heapq.heappop(self.waiters)
+            for bucket in self.buckets:
+                bucket.tokens -= 1
+            waiter.granted = True
+            self.granted += 1
+            waiter.wake()
+
+    def pause(self, seconds):
+        """
+        Stop sending requests for a while, because OpenFDA is rejecting them
+
+        :param seconds: seconds to wait
+        """
+
+        with self.lock:
+            self.throttled += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self):
+        """
+        :return: dict with the counters of the limiter
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            return {
+                'available': [int(bucket.tokens) for bucket in self.buckets],
+                'waiting': len(self.waiters),
+                'granted': self.granted,
+                'rejected': self.rejected,
+                'throttled': self.throttled,
+                'paused': max(0.0, self.paused_until - now)
+            }